@@ -1,20 +1,49 @@
 import json
+import time
 import uuid
 import logging
 import asyncio
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 import pytz
-from typing import List, Dict
+from collections import deque
+from itertools import islice
+from typing import Callable, List, Dict, Set, Deque, Tuple, Optional
 from jose import jwt
 from app.models.user import User
 from app.core.config import settings
 
 from fastapi import WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import desc, func, bindparam, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased
 
-from app.core.database import SessionLocal
+from app.core.database import AsyncSessionLocal
+from app.core.expiry import ExpiryEngine
+from app.core.event_log import ActivityEventWriter
+from app.core.backplane import Backplane, create_backplane
+from app.core.connections import Connection, ConnectionRegistry
+from app.core.commands import RecentCommands, CommandDebouncer
+from app.core.room_activity import RoomActivity
+from app.core.occupancy_snapshot import OccupancySnapshot
+from app.core.room_directory import ROOMS_RELOADED, room_directory
+from app.core.rollups import OccupancyRollups
+from app.core.principal_cache import principal_cache
 from app.models.occupancy import RoomOccupancy, RoomCount, ActivityEvent
+from app.models.building import Building, Room
+from app.schemas.websocket import (
+    CheckinMessage,
+    CheckoutMessage,
+    SubscriptionMessage,
+    SetUsernameMessage,
+    inbound_message
+)
+
+try:
+    import msgpack
+except ImportError:  # optional, clients just stay on JSON
+    msgpack = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,86 +55,350 @@ def get_edmonton_time():
     """Get current time in Edmonton (Mountain Time)"""
     return datetime.now(EDMONTON_TZ)
 
+# Close code used when a send to a client fails or times out
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Close code used when a client stopped answering heartbeats
+IDLE_CLOSE_CODE = 1001
+
+# Topic every client starts on: all events, for the campus-wide feed view
+CAMPUS_TOPIC = "campus"
+
+# Individual join/leave events only go to clients that subscribe to this topic;
+# everyone else gets aggregated presence counts
+PRESENCE_TOPIC = "presence"
+PRESENCE_EVENT_TYPES = ("connection", "disconnection")
+
+# A worker re-publishes its presence counts at least every this many intervals,
+# and other workers forget them after twice as long without a report
+PRESENCE_REPORT_EVERY = 15
+
+def building_for_room(room_name: str) -> str:
+    """Building a room belongs to (e.g. "ETLC 1-001" -> "ETLC"), from the room directory"""
+    return room_directory.building_for(room_name)
+
+def event_topics(event: Dict) -> List[str]:
+    """Topics an event is published on; events without a room only go campus-wide"""
+    if event.get("type") in PRESENCE_EVENT_TYPES:
+        return [PRESENCE_TOPIC]
+    room_name = event.get("room_name")
+    if not room_name:
+        return [CAMPUS_TOPIC]
+    return [CAMPUS_TOPIC, f"building:{building_for_room(room_name)}", f"room:{room_name}"]
+
+# ConnectionManager method handling each inbound message type
+INBOUND_HANDLERS = {
+    CheckinMessage: "submit_command",
+    CheckoutMessage: "submit_command",
+    SubscriptionMessage: "handle_subscription",
+    SetUsernameMessage: "handle_set_username"
+}
+
+# Reply to a frame that is not a valid inbound message, encoded once
+MALFORMED_MESSAGE = json.dumps({"type": "error", "message": "Malformed message"})
+
+# Number of feed events sent to a client when it connects (REQ-8)
+HISTORY_FEED_SIZE = 100
+# How far back the feed sent on connect reaches
+HISTORY_FEED_WINDOW = timedelta(hours=24)
+
+# Wire formats; "msgpack" is negotiated as a WebSocket subprotocol, JSON is the default
+JSON_CODEC = "json"
+MSGPACK_CODEC = "msgpack"
+
+async def send_message(websocket: WebSocket, message):
+    """Send a dict as JSON, or a pre-encoded JSON string as-is"""
+    if isinstance(message, str):
+        await websocket.send_text(message)
+    else:
+        await websocket.send_json(message)
+
+class Frame:
+    """
+    Outbound message shared by every recipient. It is encoded at most once
+    per wire format, however many sockets it is sent to.
+    """
+    __slots__ = ("message", "_text", "_text_size", "_binary")
+
+    def __init__(self, message: Dict = None, text: str = None):
+        self.message = message
+        self._text = text
+        self._text_size = None
+        self._binary = None
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.message, separators=(",", ":"), ensure_ascii=False)
+        return self._text
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            message = self.message if self.message is not None else json.loads(self._text)
+            self._binary = msgpack.packb(message)
+        return self._binary
+
+    async def send(self, websocket: WebSocket, codec: str) -> int:
+        """Send in the given wire format and return the payload size in bytes"""
+        if codec == MSGPACK_CODEC:
+            payload = self.binary()
+            await websocket.send_bytes(payload)
+            return len(payload)
+        text = self.text()
+        await websocket.send_text(text)
+        if self._text_size is None:
+            self._text_size = len(text.encode())
+        return self._text_size
+
+    @classmethod
+    def wrap(cls, message) -> "Frame":
+        """Frame for a dict, a pre-encoded JSON string or an existing frame"""
+        if isinstance(message, Frame):
+            return message
+        if isinstance(message, str):
+            return cls(text=message)
+        return cls(message)
+
+def negotiate_codec(websocket: WebSocket) -> str:
+    """Pick msgpack if the client offered it and it is installed, JSON otherwise"""
+    offered = getattr(websocket, "scope", {}).get("subprotocols") or []
+    if msgpack is not None and MSGPACK_CODEC in offered:
+        return MSGPACK_CODEC
+    return JSON_CODEC
+
+def batch_frame(events: List[Dict]) -> Frame:
+    """
+    One frame for events coalesced in a batch window. Room counts are
+    conflated into a single latest-value-per-room map instead of being
+    repeated on every event; a lone event is sent unwrapped.
+    """
+    if len(events) == 1:
+        return Frame(events[0])
+    occupancy = {}
+    batched = []
+    for event in events:
+        if "current_occupancy" in event:
+            occupancy[event["room_name"]] = event["current_occupancy"]
+            event = {key: value for key, value in event.items() if key != "current_occupancy"}
+        batched.append(event)
+    return Frame({"type": "batch", "events": batched, "occupancy": occupancy})
+
+class HistorySnapshot:
+    """
+    In-memory copy of what a client receives on connect: the latest feed
+    events, the active check-ins and the room counts. It is loaded from the
+    database once, then kept current from broadcast events and serialized
+    at most once per change, so a connect needs no database access.
+    """
+
+    def __init__(
+        self,
+        feed_size: int = HISTORY_FEED_SIZE,
+        feed_window: timedelta = HISTORY_FEED_WINDOW,
+        clock: Callable[[], datetime] = get_edmonton_time
+    ):
+        # Newest event first, like the history message
+        self.feed: Deque[Dict] = deque(maxlen=feed_size)
+        self.feed_window = feed_window
+        self.clock = clock
+        self.current_checkins: Dict[str, Dict] = {}
+        self.occupancy: Dict[str, int] = {}
+        self.loaded = False
+        self._body: Optional[str] = None
+
+    def load(self, feed: List[Dict], current_checkins: List[Dict], occupancy: Dict[str, int]):
+        self.feed.clear()
+        self.feed.extend(feed[:self.feed.maxlen])
+        self.current_checkins = {checkin["user_id"]: checkin for checkin in current_checkins}
+        self.occupancy = dict(occupancy)
+        self.loaded = True
+        self._body = None
+
+    def apply(self, event: Dict):
+        """Fold a broadcast event into the snapshot"""
+        if not self.loaded:
+            return
+        event_type = event.get("type")
+        if event_type not in ("checkin", "checkout"):
+            return
+
+        self.feed.appendleft(event)
+        if event_type == "checkin":
+            self.current_checkins[event["user_id"]] = {
+                "user_id": event["user_id"],
+                "username": event.get("username"),
+                "room_name": event["room_name"],
+                "study_topic": event.get("study_topic"),
+                "checkin_time": event["timestamp"],
+                "expiry_time": event["expiry_time"]
+            }
+        elif event_type == "checkout":
+            self.current_checkins.pop(event["user_id"], None)
+        if "current_occupancy" in event:
+            self.occupancy[event["room_name"]] = event["current_occupancy"]
+        self._body = None
+        self._prune()
+
+    def _prune(self):
+        """Drop feed events that have aged out of the window, oldest first"""
+        cutoff = self.clock() - self.feed_window
+        while self.feed:
+            timestamp = self.feed[-1].get("timestamp")
+            if timestamp is None or datetime.fromisoformat(timestamp) > cutoff:
+                break
+            self.feed.pop()
+            self._body = None
+
+    def rename(self, user_id: str, username: str):
+        """Reflect a username change on the user's active check-in"""
+        checkin = self.current_checkins.get(user_id)
+        if checkin is not None:
+            checkin["username"] = username
+            self._body = None
+
+    def body(self) -> str:
+        """JSON object shared by every history message, re-encoded only after a change"""
+        self._prune()
+        if self._body is None:
+            self._body = json.dumps({
+                "feed": list(self.feed),
+                "current_checkins": list(self.current_checkins.values()),
+                "occupancy_data": self.occupancy
+            })
+        return self._body
+
+    def render(self, user_id: str, username: Optional[str], stream: str = None, seq: int = None) -> str:
+        """History message for one client, spliced onto the shared body without re-encoding it"""
+        header = json.dumps({
+            "type": "history",
+            "user_id": user_id,
+            "username": username,
+            "stream": stream,
+            "seq": seq
+        })
+        return header[:-1] + ", " + self.body()[1:]
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.user_ids: Dict[WebSocket, str] = {}
-        self.usernames: Dict[WebSocket, str] = {}
-        # Keep in-memory activity feed for connectivity events that don't go to DB
-        self.activity_feed = []
-        
-    def _get_db(self):
-        db = SessionLocal()
-        try:
-            return db
-        finally:
-            db.close()
-            
-    def _clean_old_events(self):
-        """Remove events older than 24 hours from memory (REQ-7)"""
-        now = get_edmonton_time()
-        cutoff = now - timedelta(hours=24)
-        self.activity_feed = [
-            event for event in self.activity_feed 
-            if datetime.fromisoformat(event["timestamp"]).replace(tzinfo=EDMONTON_TZ) > cutoff
-        ]
+    def __init__(
+        self,
+        send_queue_size: int = None,
+        send_timeout: float = None,
+        slow_feed_cap: int = None,
+        replay_window: int = None,
+        batch_window_ms: int = None,
+        presence_interval: float = None,
+        heartbeat_interval: float = None,
+        idle_timeout: float = None,
+        command_debounce_ms: int = None
+    ):
+        # Every open connection with its own outbound queue and writer task, by socket and by user
+        self.connections = ConnectionRegistry()
+        # topic -> subscribed sockets; each connection keeps its own topics for cleanup
+        self.topics: Dict[str, Set[WebSocket]] = {}
+        self.send_queue_size = send_queue_size or settings.ws_send_queue_size
+        self.send_timeout = send_timeout or settings.ws_send_timeout
+        # Feed events held for a lagging client before it is told to resync instead
+        self.slow_feed_cap = slow_feed_cap or settings.ws_slow_feed_cap
+        self.evicted_count = 0
+        self.lagged_count = 0
+        # Fire-and-forget tasks (evicted socket closes, backplane publishes), kept referenced until they finish
+        self._background: Set[asyncio.Task] = set()
+        # Carries events to and from the other workers, None when running standalone
+        self.backplane: Optional[Backplane] = None
+        # Single expiry scheduler for every active check-in in this process
+        self.expiry = ExpiryEngine(self.expire_checkins)
+        # Check-in/check-out rows for activity_events, inserted in bulk off the request path
+        self.event_log = ActivityEventWriter(
+            AsyncSessionLocal,
+            batch_size=settings.activity_log_batch_size,
+            flush_interval=settings.activity_log_flush_ms / 1000,
+            max_pending=settings.activity_log_max_pending
+        )
+        # What a newly connected client gets, maintained incrementally
+        self.history = HistorySnapshot()
+        # Recent events per room for GET /occupancy/activity/{room_name}
+        self.room_activity = RoomActivity(settings.room_activity_size)
+        # Materialized responses of GET /occupancy/rooms and /occupancy/buildings
+        self.occupancy = OccupancySnapshot(room_directory)
+        # 5 minute, hourly and daily occupancy history behind GET /occupancy/history
+        self.rollups = OccupancyRollups(
+            AsyncSessionLocal,
+            lambda: get_edmonton_time().replace(tzinfo=None),
+            flush_interval=settings.rollup_flush_interval,
+            retention_days={
+                300: settings.rollup_5m_retention_days,
+                3600: settings.rollup_1h_retention_days
+            }
+        )
+        # Every event delivered by this process gets the next sequence number on
+        # this stream; recent events are retained so reconnects can resume
+        self.stream_id = str(uuid.uuid4())
+        self.seq = 0
+        self.replay_window: Deque[Dict] = deque(maxlen=replay_window or settings.ws_replay_window)
+        # Events delivered within the batch window go out together as one frame (0 disables batching)
+        if batch_window_ms is None:
+            batch_window_ms = settings.ws_batch_window_ms
+        self.batch_window = batch_window_ms / 1000
+        self._batch: List[Dict] = []
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        # Aggregated presence: the counts clients were last sent, and the
+        # latest (received at, counts) report from every other worker
+        self.presence_interval = presence_interval or settings.ws_presence_interval
+        self.presence: Dict = {"campus": 0, "buildings": {}}
+        self._remote_presence: Dict[str, Tuple[float, Dict]] = {}
+        self._reported_presence: Optional[Dict] = None
+        self._presence_ticks = 0
+        self._presence_task: Optional[asyncio.Task] = None
+        # Quiet clients are pinged every heartbeat interval and reaped once
+        # nothing has been heard from them for idle_timeout seconds
+        self.heartbeat_interval = settings.ws_heartbeat_interval if heartbeat_interval is None else heartbeat_interval
+        self.idle_timeout = idle_timeout or settings.ws_idle_timeout
+        self.reaped_count = 0
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # Check-in/check-out commands: client IDs already acted on, and a per-user
+        # window in which toggling after a command collapses into its net effect
+        self.recent_commands = RecentCommands(settings.ws_command_id_ttl)
+        if command_debounce_ms is None:
+            command_debounce_ms = settings.ws_command_debounce_ms
+        self.debouncer = CommandDebouncer(command_debounce_ms / 1000, self.run_command, self._record_commands)
         
-        # Also clean up old events in database
-        db = self._get_db()
-        try:
-            # Delete old events from the database
-            db.query(ActivityEvent).filter(
-                ActivityEvent.timestamp < cutoff.replace(tzinfo=None)
-            ).delete(synchronize_session=False)
-            db.commit()
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Error cleaning old events: {e}")
-        finally:
-            db.close()
+    def _get_db(self) -> AsyncSession:
+        return AsyncSessionLocal()
             
-    def _get_activity_feed(self, db: Session, limit: int = 100):
-        """Get combined activity feed from memory and database, sorted by newest first (REQ-8)"""
+    async def _get_activity_feed(self, db: AsyncSession, limit: int = 100):
+        """Get the check-in/check-out feed from the database, newest first (REQ-8)"""
         now = get_edmonton_time()
-        cutoff = now - timedelta(hours=24)
+        cutoff = now - HISTORY_FEED_WINDOW
         
-        # Get events from database (check-ins and check-outs)
-        db_events = db.query(ActivityEvent).filter(
+        # Get events from database (check-ins and check-outs), never more than we return
+        result = await db.execute(select(ActivityEvent).filter(
             ActivityEvent.timestamp > cutoff.replace(tzinfo=None)
-        ).order_by(desc(ActivityEvent.timestamp)).all()
+        ).order_by(desc(ActivityEvent.timestamp)).limit(limit))
+        db_events = result.scalars().all()
         
-        # Convert to dictionaries for JSON serialization
-        db_events_dict = [
+        # Convert to dictionaries for JSON serialization; times are stored as naive Edmonton time
+        return [
             {
                 "type": event.type,
                 "user_id": event.user_id,
                 "username": event.username,
                 "room_name": event.room_name,
                 "study_topic": event.study_topic,
-                "timestamp": event.timestamp.replace(tzinfo=timezone.utc).astimezone(EDMONTON_TZ).isoformat(),
-                "expiry_time": event.expiry_time.replace(tzinfo=timezone.utc).astimezone(EDMONTON_TZ).isoformat() if event.expiry_time else None,
+                "timestamp": EDMONTON_TZ.localize(event.timestamp).isoformat(),
+                "expiry_time": EDMONTON_TZ.localize(event.expiry_time).isoformat() if event.expiry_time else None,
                 "message": event.message
             }
             for event in db_events
         ]
         
-        # Combine with in-memory events (connections and disconnections)
-        combined_events = db_events_dict + self.activity_feed
-        
-        # Sort by timestamp with newest first
-        combined_events.sort(key=lambda x: x["timestamp"], reverse=True)
-        
-        # Return limited number of events
-        return combined_events[:limit]
-        
-    def _get_current_checkins(self, db: Session):
+    async def _get_current_checkins(self, db: AsyncSession):
         """Get all active check-ins from database"""
         now = get_edmonton_time()
         
-        checkins = db.query(RoomOccupancy).filter(
+        result = await db.execute(select(RoomOccupancy).filter(
             RoomOccupancy.is_active == True,
             RoomOccupancy.expiry_time > now.replace(tzinfo=None)
-        ).all()
+        ))
+        checkins = result.scalars().all()
         
         # Convert to dictionaries for JSON serialization
         return [
@@ -114,110 +407,238 @@ class ConnectionManager:
                 "username": checkin.username,
                 "room_name": checkin.room_name,
                 "study_topic": checkin.study_topic,
-                "checkin_time": checkin.checkin_time.replace(tzinfo=timezone.utc).astimezone(EDMONTON_TZ).isoformat(),
-                "expiry_time": checkin.expiry_time.replace(tzinfo=timezone.utc).astimezone(EDMONTON_TZ).isoformat()
+                "checkin_time": EDMONTON_TZ.localize(checkin.checkin_time).isoformat(),
+                "expiry_time": EDMONTON_TZ.localize(checkin.expiry_time).isoformat()
             }
             for checkin in checkins
         ]
         
-    def _increment_room_count(self, db: Session, room_name: str):
-        """Increment the occupant count for a room"""
-        room_count = db.query(RoomCount).filter(RoomCount.room_name == room_name).first()
-        
-        if room_count:
-            room_count.occupant_count += 1
-            room_count.last_updated = get_edmonton_time().replace(tzinfo=None)
-        else:
-            room_count = RoomCount(room_name=room_name, occupant_count=1, last_updated=get_edmonton_time().replace(tzinfo=None))
-            db.add(room_count)
-        
-        return room_count.occupant_count
-    
-    def _decrement_room_count(self, db: Session, room_name: str):
-        """Decrement the occupant count for a room"""
-        room_count = db.query(RoomCount).filter(RoomCount.room_name == room_name).first()
-        
-        if room_count:
-            # Prevent negative counts
-            if room_count.occupant_count > 0:
-                room_count.occupant_count -= 1
-            room_count.last_updated = get_edmonton_time().replace(tzinfo=None)
-            return room_count.occupant_count
-        else:
-            # Room not found, add it with count 0
-            room_count = RoomCount(room_name=room_name, occupant_count=0, last_updated=get_edmonton_time().replace(tzinfo=None))
-            db.add(room_count)
-            return 0
+    async def _update_room_count(self, db: AsyncSession, room_name: str, delta: int) -> int:
+        """
+        Add delta to a room's occupant count and return the new count, in one
+        upsert. The row lock taken by the update serializes concurrent
+        check-ins to the same room, and the count never drops below zero.
+        """
+        now = get_edmonton_time().replace(tzinfo=None)
+        statement = pg_insert(RoomCount).values(
+            room_name=room_name,
+            occupant_count=max(delta, 0),
+            last_updated=now
+        ).on_conflict_do_update(
+            index_elements=[RoomCount.room_name],
+            set_={
+                "occupant_count": func.greatest(RoomCount.occupant_count + bindparam("delta", delta), 0),
+                "last_updated": now
+            }
+        ).returning(RoomCount.occupant_count)
+        result = await db.execute(statement)
+        return result.scalar_one()
+
+    async def _get_active_expiries(self, db: AsyncSession):
+        """Get (user_id, expiry_time) for every active check-in, used to seed the expiry engine"""
+        result = await db.execute(select(RoomOccupancy.user_id, RoomOccupancy.expiry_time).filter(
+            RoomOccupancy.is_active == True
+        ))
+        rows = result.all()
+        return [
+            (user_id, EDMONTON_TZ.localize(expiry_time))
+            for user_id, expiry_time in rows
+        ]
 
-    def _get_all_room_occupancy(self, db: Session):
+    async def load_room_directory(self):
+        """(Re)load which building every room is in, with the buildings' coordinates"""
+        db = self._get_db()
+        try:
+            result = await db.execute(
+                select(Room.name, Building.name, Building.latitude, Building.longitude)
+                .join(Building, Room.building_id == Building.id)
+            )
+            room_directory.load(result.all())
+            logger.info(f"Loaded {len(room_directory)} buildings into the room directory")
+        except Exception as e:
+            logger.error(f"Error loading room directory: {e}")
+        finally:
+            await db.close()
+
+    async def _get_room_counts(self, db: AsyncSession) -> List[RoomCount]:
+        result = await db.execute(select(RoomCount))
+        return result.scalars().all()
+
+    async def _get_all_room_occupancy(self, db: AsyncSession, room_counts: List[RoomCount] = None):
         """Get all room occupancy counts from database"""
-        room_counts = db.query(RoomCount).all()
-        
+        if room_counts is None:
+            room_counts = await self._get_room_counts(db)
+
         # Convert to dictionary for JSON serialization
         return {
             room_count.room_name: room_count.occupant_count
             for room_count in room_counts
         }
 
-    async def connect(self, websocket: WebSocket, username: str = None, user_id: str = None):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    def _register(
+        self,
+        websocket: WebSocket,
+        codec: str = JSON_CODEC,
+        user_id: str = None,
+        username: str = None
+    ) -> Connection:
+        """Add a connection and start its outbound writer"""
+        connection = Connection(websocket, self.send_queue_size, self.send_timeout, codec, user_id, username)
+        self.connections.add(connection)
+        connection.start(self._on_send_failure, self._catch_up)
+        self.subscribe(websocket, [CAMPUS_TOPIC])
+        return connection
 
-        # Use provided user_id from authentication if available, otherwise generate a UUID
-        if user_id:
-            self.user_ids[websocket] = user_id
+    def subscribe(self, websocket: WebSocket, topics: List[str]):
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return
+        for topic in topics:
+            self.topics.setdefault(topic, set()).add(websocket)
+            connection.topics.add(topic)
+
+    def unsubscribe(self, websocket: WebSocket, topics: List[str]):
+        connection = self.connections.get(websocket)
+        subscribed = connection.topics if connection is not None else set()
+        for topic in topics:
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del self.topics[topic]
+            subscribed.discard(topic)
+
+    def _recipients(self, event: Dict) -> Set[WebSocket]:
+        """Connections subscribed to any topic the event is published on"""
+        recipients = set()
+        for topic in event_topics(event):
+            subscribers = self.topics.get(topic)
+            if subscribers:
+                recipients |= subscribers
+        return recipients
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        username: str = None,
+        user_id: str = None,
+        since: int = None,
+        stream: str = None
+    ):
+        """
+        Register a client and catch it up. A client reconnecting with the
+        stream and seq of the last event it saw only receives the events it
+        missed; otherwise (or if its cursor is too old) it gets the full history.
+        """
+        codec = negotiate_codec(websocket)
+        if codec == MSGPACK_CODEC:
+            await websocket.accept(subprotocol=MSGPACK_CODEC)
         else:
-            # Generate a user ID for this connection (only for unauthenticated connections)
-            self.user_ids[websocket] = str(uuid.uuid4())
-        
-        # Store username if provided
-        if username:
-            self.usernames[websocket] = username
+            await websocket.accept()
+        # Held events are already in the snapshot, send them before this client joins
+        self._flush_batch()
+        # Use provided user_id from authentication if available, otherwise generate
+        # a UUID for this connection (only for unauthenticated connections)
+        connection = self._register(websocket, codec, user_id or str(uuid.uuid4()), username)
+
+        # Catch the client up before any live event is queued behind it
+        missed = self._events_since(since) if stream == self.stream_id else None
+        if missed is not None:
+            await self.send_personal(websocket, {
+                "type": "replay",
+                "user_id": connection.user_id,
+                "username": username,
+                "stream": self.stream_id,
+                "seq": self.seq,
+                "events": missed
+            })
+        else:
+            # Only the first connect after startup reads from the database
+            if not self.history.loaded:
+                await self._load_history()
+
+            # Send activity feed history to the new client, including their user_id
+            if self.history.loaded:
+                await self.send_personal(
+                    websocket,
+                    self.history.render(connection.user_id, username, self.stream_id, self.seq)
+                )
+
+        # Current presence counts, kept up to date by the periodic deltas
+        await self.send_personal(websocket, self._presence_message(self.presence))
 
         # Create connection event with user_id (only in memory, not in DB)
         connection_event = {
             "type": "connection",
-            "user_id": self.user_ids[websocket],
+            "user_id": connection.user_id,
             "username": username,
             "timestamp": get_edmonton_time().isoformat(),
-            "message": f"User {username or self.user_ids[websocket]} has joined the feed!"
+            "message": f"User {username or connection.user_id} has joined the feed!"
         }
         
-        # Clean old events before adding new ones
-        self._clean_old_events()
-        
-        # Add to in-memory activity feed
-        self.activity_feed.append(connection_event)
-        
-        # Send connection event to all clients
+        # Only clients subscribed to presence receive it
         await self.broadcast(connection_event)
+        return connection
+
+    def _events_since(self, since: Optional[int]) -> Optional[List[Dict]]:
+        """Retained events after seq `since`, or None if some of them are no longer retained"""
+        if since is None or since > self.seq or since < 0:
+            return None
+        if since == self.seq:
+            return []
+        if not self.replay_window or self.replay_window[0]["seq"] > since + 1:
+            return None
+        # Sequence numbers are contiguous, so the first missed event sits at a known offset
+        start = since + 1 - self.replay_window[0]["seq"]
+        return list(islice(self.replay_window, start, None))
 
-        # Get full activity feed (DB + memory) and current check-ins
+    async def _load_history(self):
+        """Fill the history snapshot from the database"""
         db = self._get_db()
         try:
-            activity_feed = self._get_activity_feed(db)
-            current_checkins = self._get_current_checkins(db)
-            
+            # Get full activity feed (DB + memory) and current check-ins
+            activity_feed = await self._get_activity_feed(db, limit=HISTORY_FEED_SIZE)
+            current_checkins = await self._get_current_checkins(db)
+
             # Get all room occupancy data
-            occupancy_data = self._get_all_room_occupancy(db)
-            
-            # Send activity feed history to the new client, including their user_id
-            await websocket.send_json({
-                "type": "history",
-                "feed": activity_feed,
-                "user_id": self.user_ids[websocket],
-                "username": username,
-                "current_checkins": current_checkins,
-                "occupancy_data": occupancy_data  # Include occupancy data in history message
-            })
+            room_counts = await self._get_room_counts(db)
+            occupancy_data = await self._get_all_room_occupancy(db, room_counts)
+            self.history.load(activity_feed, current_checkins, occupancy_data)
+            self.occupancy.load(room_counts)
+            await self.rollups.load(db, room_counts)
+
+            self.room_activity.load(await self._get_room_activity(db))
         except Exception as e:
             logger.error(f"Error retrieving activity feed: {e}")
         finally:
-            db.close()
+            await db.close()
+
+    async def _get_room_activity(self, db: AsyncSession) -> List[ActivityEvent]:
+        """The newest events of every room, as many per room as the room rings hold"""
+        ranked = select(
+            ActivityEvent,
+            func.row_number().over(
+                partition_by=ActivityEvent.room_name,
+                order_by=desc(ActivityEvent.timestamp)
+            ).label("rank")
+        ).subquery()
+        event = aliased(ActivityEvent, ranked)
+        result = await db.execute(select(event).filter(
+            ranked.c.rank <= self.room_activity.size
+        ).order_by(event.room_name, desc(event.timestamp)))
+        return result.scalars().all()
 
     def disconnect(self, websocket: WebSocket):
-        user_id = self.user_ids.get(websocket, "Unknown")
-        username = self.usernames.get(websocket, None)
+        """
+        Remove a connection and return its disconnection event, or None if the
+        connection was already removed (e.g. evicted as a slow consumer)
+        """
+        connection = self.connections.remove(websocket)
+        if connection is None:
+            return None
+
+        user_id = connection.user_id or "Unknown"
+        username = connection.username
 
         # Users will remain checked in even if they disconnect
         # No automatic checkout on disconnect
@@ -231,35 +652,111 @@ class ConnectionManager:
             "message": f"User {username or user_id} has left the feed."
         }
 
-        # Clean old events
-        self._clean_old_events()
-        
-        # Add to in-memory activity feed
-        self.activity_feed.append(disconnection_event)
+        # Commands still held for this socket would run without a connection to answer
+        if connection.user_id is not None:
+            self.debouncer.discard(connection.user_id, websocket)
 
-        # Remove from active connections
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-            del self.user_ids[websocket]
-            if websocket in self.usernames:
-                del self.usernames[websocket]
+        # Stop its writer and drop its subscriptions
+        connection.stop()
+        for topic in connection.topics:
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del self.topics[topic]
 
         # Return the disconnection event
         return disconnection_event
 
-    async def handle_checkin(self, websocket: WebSocket, data):
-        """Handle a check-in event"""
-        user_id = self.user_ids.get(websocket, None)
-        username = self.usernames.get(websocket, None) or data.get("username")
-        room_name = data.get("room_name")
-        study_topic = data.get("study_topic")
+    def decode(self, connection: Connection, raw):
+        """
+        Parse and validate an inbound frame in one pass. Binary frames from
+        msgpack clients are unpacked first. Raises ValueError if the frame is
+        not a valid message.
+        """
+        if isinstance(raw, bytes) and connection.codec == MSGPACK_CODEC:
+            try:
+                return inbound_message.validate_python(msgpack.unpackb(raw))
+            except (ValidationError, msgpack.UnpackException, ValueError) as e:
+                raise ValueError(str(e))
+        try:
+            return inbound_message.validate_json(raw)
+        except ValidationError as e:
+            raise ValueError(str(e))
+
+    async def dispatch(self, websocket: WebSocket, message):
+        """Run the handler registered for a decoded message's type"""
+        await getattr(self, INBOUND_HANDLERS[type(message)])(websocket, message)
+
+    async def submit_command(self, websocket: WebSocket, data):
+        """
+        Entry point for check-in/check-out messages: ignore a command ID that
+        was already carried out, then run the command through the user's
+        debounce window
+        """
+        connection = self.connections.get(websocket)
+        user_id = connection.user_id if connection else None
+        if user_id and data.id and self.recent_commands.seen(user_id, data.id):
+            return
+        if user_id and self.debouncer.window:
+            await self.debouncer.submit(user_id, websocket, data)
+            return
+        if await self.run_command(websocket, data) and user_id:
+            self._record_commands(user_id, [data])
+
+    async def run_command(self, websocket: WebSocket, data) -> bool:
+        """Run a check-in or check-out, returning whether it succeeded"""
+        if isinstance(data, CheckinMessage):
+            return await self.handle_checkin(websocket, data)
+        return await self.handle_checkout(websocket, data)
+
+    def _record_commands(self, user_id: str, messages: List):
+        """Remember the IDs of commands that were carried out, so retries are ignored"""
+        for message in messages:
+            if message.id:
+                self.recent_commands.record(user_id, message.id)
+
+    async def handle_subscription(self, websocket: WebSocket, data: SubscriptionMessage):
+        """
+        Handle a subscribe/unsubscribe message, e.g.
+        {"type": "subscribe", "buildings": ["CAB"], "rooms": ["ETLC 1-001"], "campus": false}
+        "presence": true opts in to individual join/leave events.
+        """
+        topics = [f"building:{building}" for building in data.buildings]
+        topics += [f"room:{room_name}" for room_name in data.rooms]
+        if data.campus:
+            topics.append(CAMPUS_TOPIC)
+        if data.presence:
+            topics.append(PRESENCE_TOPIC)
+
+        if data.type == "subscribe":
+            self.subscribe(websocket, topics)
+            # Narrowing to buildings/rooms drops the campus-wide stream unless asked to keep it
+            if topics and data.campus is False:
+                self.unsubscribe(websocket, [CAMPUS_TOPIC])
+        else:
+            self.unsubscribe(websocket, topics)
+
+        connection = self.connections.get(websocket)
+        await self.send_personal(websocket, {
+            "type": "subscriptions",
+            "topics": sorted(connection.topics if connection is not None else ())
+        })
+
+    async def handle_checkin(self, websocket: WebSocket, data: CheckinMessage) -> bool:
+        """Handle a check-in event, returning False if it failed"""
+        connection = self.connections.get(websocket)
+        user_id = connection.user_id if connection else None
+        username = (connection.username if connection else None) or data.username
+        room_name = data.room_name
+        study_topic = data.study_topic
         
         if not user_id or not room_name:
-            await websocket.send_json({
+            await self.send_personal(websocket, {
                 "type": "error",
                 "message": "Missing user_id or room_name for check-in"
             })
-            return
+            return False
         
         db = self._get_db()
         try:
@@ -267,30 +764,27 @@ class ConnectionManager:
             user_id_str = str(user_id)
             
             # Check if user is already checked in somewhere (REQ-4)
-            existing_checkin = db.query(RoomOccupancy).filter(
+            result = await db.execute(select(RoomOccupancy).filter(
                 RoomOccupancy.user_id == user_id_str,
                 RoomOccupancy.is_active == True
-            ).first()
+            ))
+            existing_checkin = result.scalars().first()
             
-            already_checked_in = False
             if existing_checkin:
-                already_checked_in = True
-                old_room = existing_checkin.room_name
-                
                 # If checking into the same room, don't create duplicate events
                 if existing_checkin.room_name == room_name:
-                    await websocket.send_json({
+                    await self.send_personal(websocket, {
                         "type": "info",
                         "message": f"You are already checked into {room_name}"
                     })
-                    db.close()
-                    return
+                    await db.close()
+                    return True
                     
-                # Auto check-out from previous room
-                await self.handle_checkout(websocket, {
-                    "room_name": existing_checkin.room_name,
-                    "auto": True
-                })
+                # Auto check-out from previous room, which broadcasts its decremented count
+                await self.handle_checkout(websocket, CheckoutMessage(
+                    room_name=existing_checkin.room_name,
+                    auto=True
+                ))
             
             # Record the check-in in the database
             checkin_time = get_edmonton_time()
@@ -309,26 +803,27 @@ class ConnectionManager:
             db.add(new_checkin)
             
             # Increment room occupancy count
-            new_count = self._increment_room_count(db, room_name)
+            new_count = await self._update_room_count(db, room_name, 1)
             
-            # Create and store check-in event
+            # Create check-in event message
             message = f"@{username or user_id} started studying"
             if study_topic:
                 message += f" {study_topic}"
             message += f" at {room_name}"
             
-            new_event = ActivityEvent(
-                type="checkin",
-                user_id=user_id_str,
-                username=username,
-                room_name=room_name,
-                study_topic=study_topic,
-                timestamp=checkin_time.replace(tzinfo=None),
-                expiry_time=expiry_time.replace(tzinfo=None),
-                message=message
-            )
-            db.add(new_event)
-            db.commit()
+            await db.commit()
+
+            # Store check-in event
+            await self.event_log.add({
+                "type": "checkin",
+                "user_id": user_id_str,
+                "username": username,
+                "room_name": room_name,
+                "study_topic": study_topic,
+                "timestamp": checkin_time.replace(tzinfo=None),
+                "expiry_time": expiry_time.replace(tzinfo=None),
+                "message": message
+            })
             
             # Create check-in event for broadcasting
             checkin_event = {
@@ -345,51 +840,58 @@ class ConnectionManager:
             
             # Broadcast to all clients
             await self.broadcast(checkin_event)
+            return True
             
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error(f"Error during check-in: {e}")
-            await websocket.send_json({
+            await self.send_personal(websocket, {
                 "type": "error",
                 "message": f"Error processing check-in: {str(e)}"
             })
+            return False
         finally:
-            db.close()
-
-    async def handle_checkout(self, websocket: WebSocket, data):
-        """Handle a check-out event"""
-        user_id = self.user_ids.get(websocket, None)
-        username = self.usernames.get(websocket, None)
-        room_name = data.get("room_name")
-        auto_checkout = data.get("auto", False)
+            await db.close()
+
+    async def handle_checkout(self, websocket: WebSocket, data: CheckoutMessage) -> bool:
+        """Handle a check-out event, returning False if it failed"""
+        connection = self.connections.get(websocket)
+        user_id = connection.user_id if connection else None
+        username = connection.username if connection else None
+        room_name = data.room_name
+        auto_checkout = data.auto
         
         if not user_id:
             if not auto_checkout:  # Only send error for manual checkouts
-                await websocket.send_json({
+                await self.send_personal(websocket, {
                     "type": "error",
                     "message": "User ID not found"
                 })
-            return
+            return False
             
         db = self._get_db()
         try:
             # Convert user_id to string to ensure compatibility
             user_id_str = str(user_id)
             
-            # Find the active check-in for this user
-            active_checkin = db.query(RoomOccupancy).filter(
+            # Find the active check-in for this user, locked until we commit. If the
+            # expiry engine or another worker's check-out gets there first, this waits
+            # for it and then finds no active row, so the count is decremented once
+            result = await db.execute(select(RoomOccupancy).filter(
                 RoomOccupancy.user_id == user_id_str,
                 RoomOccupancy.is_active == True
-            ).first()
+            ).with_for_update())
+            active_checkin = result.scalars().first()
             
             if not active_checkin:
                 if not auto_checkout:  # Only send error for manual checkouts
-                    await websocket.send_json({
+                    await self.send_personal(websocket, {
                         "type": "error",
                         "message": "You are not checked in to any room"
                     })
-                db.close()
-                return
+                await db.close()
+                # Nothing to leave is what an automatic check-out wants
+                return auto_checkout
             
             # Use the room from the database if room_name not specified
             if not room_name:
@@ -397,12 +899,12 @@ class ConnectionManager:
             
             # Verify the room matches if provided
             if room_name and room_name != active_checkin.room_name:
-                await websocket.send_json({
+                await self.send_personal(websocket, {
                     "type": "error",
                     "message": f"You are not checked into {room_name}, but into {active_checkin.room_name}"
                 })
-                db.close()
-                return
+                await db.close()
+                return False
                 
             # Store room_name for use after DB update
             checkout_room_name = active_checkin.room_name
@@ -411,22 +913,21 @@ class ConnectionManager:
             active_checkin.is_active = False
             
             # Decrement room occupancy count
-            new_count = self._decrement_room_count(db, checkout_room_name)
+            new_count = await self._update_room_count(db, checkout_room_name, -1)
             
-            # Create and store check-out event
             checkout_time = get_edmonton_time()
             message = f"@{username or user_id} has checked out from {checkout_room_name}"
-            
-            new_event = ActivityEvent(
-                type="checkout",
-                user_id=user_id_str,
-                username=username,
-                room_name=checkout_room_name,
-                timestamp=checkout_time.replace(tzinfo=None),
-                message=message
-            )
-            db.add(new_event)
-            db.commit()
+            await db.commit()
+
+            # Store check-out event
+            await self.event_log.add({
+                "type": "checkout",
+                "user_id": user_id_str,
+                "username": username,
+                "room_name": checkout_room_name,
+                "timestamp": checkout_time.replace(tzinfo=None),
+                "message": message
+            })
             
             # Create check-out event for broadcasting
             checkout_event = {
@@ -441,53 +942,92 @@ class ConnectionManager:
             
             # Broadcast to all clients
             await self.broadcast(checkout_event)
+            return True
             
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error(f"Error during check-out: {e}")
             if not auto_checkout:  # Only send error for manual checkouts
-                await websocket.send_json({
+                await self.send_personal(websocket, {
                     "type": "error",
                     "message": f"Error processing check-out: {str(e)}"
                 })
+            return False
         finally:
-            db.close()
+            await db.close()
+
+    async def handle_set_username(self, websocket: WebSocket, data: SetUsernameMessage):
+        """Rename the user on every connection and on their active check-in"""
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return
+        user_id = connection.user_id
+        username = data.username
+        self.rename(user_id, username)
+
+        # Update any existing check-in in the database
+        db = self._get_db()
+        try:
+            result = await db.execute(select(RoomOccupancy).filter(
+                RoomOccupancy.user_id == user_id,
+                RoomOccupancy.is_active == True
+            ))
+            active_checkin = result.scalars().first()
 
-    async def expire_checkins(self):
-        """Check for and expire check-ins older than 4 hours"""
+            if active_checkin:
+                active_checkin.username = username
+                await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Error updating username: {e}")
+        finally:
+            await db.close()
+
+    async def expire_checkins(self, user_ids: List[str] = None):
+        """
+        Check for and expire check-ins older than 4 hours.
+        The expiry engine passes the batch of users it knows are due, so only
+        those rows are touched; without user_ids every active check-in is scanned.
+        """
         now = get_edmonton_time()
         db = self._get_db()
         
         try:
             # Find expired check-ins
-            expired_checkins = db.query(RoomOccupancy).filter(
+            filters = [
                 RoomOccupancy.is_active == True,
-                RoomOccupancy.expiry_time < now.replace(tzinfo=None)
-            ).all()
+                RoomOccupancy.expiry_time <= now.replace(tzinfo=None)
+            ]
+            if user_ids is not None:
+                filters.append(RoomOccupancy.user_id.in_(user_ids))
+            # Skip rows another worker is already expiring
+            result = await db.execute(select(RoomOccupancy).filter(*filters).with_for_update(skip_locked=True))
+            expired_checkins = result.scalars().all()
             
             # Process each expired check-in
+            expired_events = []
+            broadcast_events = []
             for checkin in expired_checkins:
                 # Mark as inactive
                 checkin.is_active = False
                 
                 # Decrement room occupancy count
-                new_count = self._decrement_room_count(db, checkin.room_name)
+                new_count = await self._update_room_count(db, checkin.room_name, -1)
                 
                 # Create expiry event
                 message = f"@{checkin.username or checkin.user_id}'s check-in at {checkin.room_name} has expired"
                 
-                new_event = ActivityEvent(
-                    type="checkout",
-                    user_id=checkin.user_id,
-                    username=checkin.username,
-                    room_name=checkin.room_name,
-                    timestamp=now.replace(tzinfo=None),
-                    message=message
-                )
-                db.add(new_event)
+                expired_events.append({
+                    "type": "checkout",
+                    "user_id": checkin.user_id,
+                    "username": checkin.username,
+                    "room_name": checkin.room_name,
+                    "timestamp": now.replace(tzinfo=None),
+                    "message": message
+                })
                 
                 # Create expiry event for broadcasting
-                expiry_event = {
+                broadcast_events.append({
                     "type": "checkout",
                     "user_id": checkin.user_id,
                     "username": checkin.username,
@@ -495,59 +1035,466 @@ class ConnectionManager:
                     "timestamp": now.isoformat(),
                     "message": message,
                     "current_occupancy": new_count  # Include current occupancy count
-                }
+                })
                 
-                # Broadcast to all clients
+            await db.commit()
+
+            # Only expirations that were committed reach clients and the replay window
+            for expiry_event in broadcast_events:
                 await self.broadcast(expiry_event)
-                
-            db.commit()
+
+            for row in expired_events:
+                await self.event_log.add(row)
             
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error(f"Error during check-in expiration: {e}")
+            raise
         finally:
-            db.close()
+            await db.close()
+
+    async def send_personal(self, websocket: WebSocket, message):
+        """Queue a message for a single client"""
+        connection = self.connections.get(websocket)
+        if connection is None:
+            # Not registered (yet), nothing else is writing to this socket
+            await send_message(websocket, message)
+            return
+        if not connection.offer(Frame.wrap(message)):
+            disconnect_event = self._evict(websocket, "Outbound queue full")
+            if disconnect_event:
+                await self.broadcast(disconnect_event)
+
+    async def send_to_user(self, user_id: str, message):
+        """Queue a message for every open connection of a user on this worker"""
+        frame = Frame.wrap(message)
+        for connection in list(self.connections.for_user(user_id)):
+            self._offer(connection, frame)
+
+    def rename(self, user_id: str, username: str):
+        """Apply a username change to all of a user's connections and their active check-in"""
+        for connection in self.connections.for_user(user_id):
+            connection.username = username
+        self.history.rename(user_id, username)
 
     async def broadcast(self, message):
-        disconnected = []
-        for connection in self.active_connections:
+        """
+        Publish an event: apply it to this process's in-memory state, queue it
+        for every local client and forward it to the other workers through the
+        backplane. This never waits on client sockets.
+        Join/leave events only go to this worker's presence subscribers; other
+        workers learn about them from the aggregated presence reports.
+        """
+        if message.get("type") in PRESENCE_EVENT_TYPES:
+            self._notify_presence(message)
+            return
+        self._deliver(message)
+        if self.backplane is not None:
+            await self.backplane.publish(message)
+
+    def _notify_presence(self, message: Dict):
+        """Queue a join/leave event for local presence subscribers, without a seq or replay"""
+        frame = Frame(message)
+        for websocket in list(self.topics.get(PRESENCE_TOPIC, ())):
+            self._offer(self.connections.get(websocket), frame)
+
+    def _on_remote_event(self, message):
+        """Called by the backplane with an event published by another worker"""
+        if message.get("type") == "presence_report":
+            self._remote_presence[message["node"]] = (time.monotonic(), message["counts"])
+            return
+        if message.get("type") == ROOMS_RELOADED:
+            self._spawn(self.load_room_directory())
+            return
+        self._deliver(message)
+
+    def _deliver(self, message):
+        """
+        Apply an event locally and queue it for every local client.
+        With a batch window, events are held and sent by _flush_batch instead.
+        """
+        self.seq += 1
+        message["seq"] = self.seq
+        self.replay_window.append(message)
+        self._apply_event(message)
+        if self.batch_window:
+            self._batch.append(message)
+            if self._batch_timer is None:
+                self._batch_timer = asyncio.get_running_loop().call_later(self.batch_window, self._flush_batch)
+            return
+        # Encoded lazily, once per wire format, and shared by every recipient
+        frame = Frame(message)
+        for websocket in self._recipients(message):
+            self._offer(self.connections.get(websocket), frame)
+
+    def _offer(self, connection: Connection, frame: Frame):
+        """
+        Queue a frame for a connection. A connection whose queue is full
+        starts lagging, and frames for it are conflated until it catches up.
+        """
+        if connection is None:
+            return
+        if connection.lagging:
+            self._conflate(connection, frame)
+        elif not connection.offer(frame):
+            self.lagged_count += 1
+            logger.warning(f"Client {connection.user_id} is lagging, conflating its updates")
+            connection.start_lagging()
+            self._conflate(connection, frame)
+
+    def _conflate(self, connection: Connection, frame: Frame):
+        """Fold a frame for a lagging connection into its catch-up state"""
+        message = frame.message if frame.message is not None else json.loads(frame.text())
+        message_type = message.get("type")
+        if message_type == "ping":
+            return
+        if message_type == "presence":
+            pending = connection.pending_presence or {"campus": 0, "buildings": {}}
+            pending["campus"] = message["campus"]
+            pending["buildings"].update(message["buildings"])
+            connection.pending_presence = pending
+            return
+        if message_type == "batch":
+            for event in message["events"]:
+                self._conflate_event(connection, event)
+            connection.pending_occupancy.update(message["occupancy"])
+            return
+        self._conflate_event(connection, message)
+
+    def _conflate_event(self, connection: Connection, event: Dict):
+        if "seq" in event:
+            connection.pending_seq = event["seq"]
+        # Only the newest count per room is kept
+        if "current_occupancy" in event:
+            connection.pending_occupancy[event["room_name"]] = event["current_occupancy"]
+            event = {key: value for key, value in event.items() if key != "current_occupancy"}
+        if connection.resync:
+            return
+        if len(connection.pending_events) >= self.slow_feed_cap:
+            # Too far behind to replay, the client reloads its feed instead
+            connection.pending_events = []
+            connection.resync = True
+            return
+        connection.pending_events.append(event)
+
+    def _catch_up(self, connection: Connection) -> Frame:
+        """The single frame a lagging connection gets once its queue has drained"""
+        message = {
+            "type": "catchup",
+            "seq": connection.pending_seq,
+            "events": connection.pending_events,
+            "occupancy": connection.pending_occupancy
+        }
+        if connection.resync:
+            message["resync"] = True
+        if connection.pending_presence is not None:
+            message["presence"] = connection.pending_presence
+        connection.stop_lagging()
+        return Frame(message)
+
+    def _flush_batch(self):
+        """
+        Send the events held during the batch window. Each client gets one
+        frame with the events it is subscribed to, and clients subscribed to
+        the same events share that frame.
+        """
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        events, self._batch = self._batch, []
+        if not events:
+            return
+
+        selections: Dict[WebSocket, List[int]] = {}
+        for index, event in enumerate(events):
+            for websocket in self._recipients(event):
+                selections.setdefault(websocket, []).append(index)
+
+        frames: Dict[tuple, Frame] = {}
+        for websocket, indices in selections.items():
+            key = tuple(indices)
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = batch_frame([events[index] for index in indices])
+            self._offer(self.connections.get(websocket), frame)
+
+    def _apply_event(self, event):
+        """Update in-memory state from an event, whether it happened here or on another worker"""
+        self.history.apply(event)
+        self.room_activity.apply(event)
+        self.occupancy.apply(event)
+        self.rollups.apply(event)
+        event_type = event.get("type")
+        if event_type == "checkin":
+            self.expiry.schedule(event["user_id"], datetime.fromisoformat(event["expiry_time"]))
+        elif event_type == "checkout":
+            self.expiry.cancel(event["user_id"])
+
+    def _local_presence(self) -> Dict:
+        """Distinct users connected to this worker, campus-wide and per subscribed building"""
+        buildings = {}
+        for topic, subscribers in self.topics.items():
+            if topic.startswith("building:"):
+                buildings[topic[len("building:"):]] = len({
+                    self.connections.get(ws).user_id for ws in subscribers
+                })
+        return {"campus": self.connections.user_count(), "buildings": buildings}
+
+    def _total_presence(self, local: Dict) -> Dict:
+        """This worker's counts plus the latest live report from every other worker"""
+        campus = local["campus"]
+        buildings = dict(local["buildings"])
+        stale_before = time.monotonic() - 2 * PRESENCE_REPORT_EVERY * self.presence_interval
+        for node, (received_at, counts) in list(self._remote_presence.items()):
+            if received_at < stale_before:
+                del self._remote_presence[node]
+                continue
+            campus += counts["campus"]
+            for building, count in counts["buildings"].items():
+                buildings[building] = buildings.get(building, 0) + count
+        return {"campus": campus, "buildings": {b: n for b, n in buildings.items() if n}}
+
+    @staticmethod
+    def _presence_message(counts: Dict, buildings: Dict = None) -> Dict:
+        return {
+            "type": "presence",
+            "campus": counts["campus"],
+            "buildings": counts["buildings"] if buildings is None else buildings
+        }
+
+    async def publish_presence(self):
+        """
+        Send every client what changed in the presence counts since the last
+        call, as a single message, and share this worker's counts with the others
+        """
+        local = self._local_presence()
+        if self.backplane is not None:
+            self._presence_ticks += 1
+            if local != self._reported_presence or self._presence_ticks % PRESENCE_REPORT_EVERY == 0:
+                self._reported_presence = local
+                await self.backplane.publish({
+                    "type": "presence_report",
+                    "node": self.backplane.node_id,
+                    "counts": local
+                })
+
+        totals = self._total_presence(local)
+        previous = self.presence["buildings"]
+        changed = {b: n for b, n in totals["buildings"].items() if previous.get(b) != n}
+        changed.update({b: 0 for b in previous if b not in totals["buildings"]})
+        if not changed and totals["campus"] == self.presence["campus"]:
+            return
+        self.presence = totals
+
+        frame = Frame(self._presence_message(totals, changed))
+        for connection in self.connections:
+            self._offer(connection, frame)
+
+    async def _presence_loop(self):
+        while True:
+            await asyncio.sleep(self.presence_interval)
             try:
-                await connection.send_json(message)
-            except WebSocketDisconnect:
-                disconnected.append(connection)
+                await self.publish_presence()
             except Exception as e:
-                logger.warning(f"Error sending message to client: {e}")
-                disconnected.append(connection)
+                logger.error(f"Error publishing presence: {e}")
+
+    def start_presence(self):
+        if self._presence_task is None or self._presence_task.done():
+            self._presence_task = asyncio.create_task(self._presence_loop())
+
+    async def stop_presence(self):
+        if self._presence_task:
+            self._presence_task.cancel()
+            try:
+                await self._presence_task
+            except asyncio.CancelledError:
+                pass
+            self._presence_task = None
+
+    async def heartbeat(self):
+        """
+        Reap connections the client has been silent on for idle_timeout, and
+        ping the ones that have been quiet for a heartbeat interval
+        """
+        reaped = []
+        for connection in self.connections.idle(self.idle_timeout):
+            disconnect_event = self.disconnect(connection.websocket)
+            if disconnect_event is None:
+                continue
+            self.reaped_count += 1
+            logger.info(f"Reaping idle client {disconnect_event['user_id']}")
+            self._spawn(self._close_quietly(connection.websocket, "Idle timeout", IDLE_CLOSE_CODE))
+            reaped.append(disconnect_event)
+
+        ping = Frame({"type": "ping"})
+        for connection in self.connections.idle(self.heartbeat_interval):
+            self._offer(connection, ping)
+        for event in reaped:
+            await self.broadcast(event)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Error in websocket heartbeat: {e}")
+
+    def start_heartbeat(self):
+        if self.heartbeat_interval and (self._heartbeat_task is None or self._heartbeat_task.done()):
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop_heartbeat(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+
+    def stats(self) -> Dict:
+        """Connection and traffic counters for /metrics"""
+        return {
+            **self.connections.stats(),
+            "evicted": self.evicted_count,
+            "lagged": self.lagged_count,
+            "reaped": self.reaped_count,
+            "duplicate_commands": self.recent_commands.duplicates,
+            "collapsed_commands": self.debouncer.collapsed
+        }
+
+    async def attach_backplane(self, backplane: Backplane):
+        await backplane.start(self._on_remote_event)
+        self.backplane = backplane
 
-        # Clean up disconnected clients after iteration
-        for conn in disconnected:
-            disconnect_event = self.disconnect(conn)
+    async def detach_backplane(self):
+        if self.backplane is not None:
+            backplane, self.backplane = self.backplane, None
+            await backplane.stop()
+
+    def _evict(self, websocket: WebSocket, reason: str):
+        """Drop a slow or dead client and close its socket in the background"""
+        disconnect_event = self.disconnect(websocket)
+        if disconnect_event is None:
+            return None
+
+        self.evicted_count += 1
+        logger.warning(f"Evicting client {disconnect_event['user_id']}: {reason}")
+        self._spawn(self._close_quietly(websocket, reason))
+        return disconnect_event
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _close_quietly(self, websocket: WebSocket, reason: str, code: int = SLOW_CONSUMER_CLOSE_CODE):
+        try:
+            await asyncio.wait_for(
+                websocket.close(code=code, reason=reason),
+                timeout=self.send_timeout
+            )
+        except Exception:
+            pass
+
+    async def _on_send_failure(self, connection: Connection, error: Exception):
+        """Called by a writer task when sending to its client fails or times out"""
+        if not isinstance(error, WebSocketDisconnect):
+            logger.warning(f"Error sending message to client: {error!r}")
+        disconnect_event = self._evict(connection.websocket, "Send failed")
+        if disconnect_event:
             await self.broadcast(disconnect_event)
 
 # Create a singleton instance of the connection manager
 manager = ConnectionManager()
 
 async def run_expiry_checker():
-    """Run once to expire check-ins (for scheduler)"""
+    """Run once to expire every overdue check-in (full scan)"""
     try:
         await manager.expire_checkins()
     except Exception as e:
         logger.error(f"Error in expiry checker: {e}")
-        
-        
-# For direct use with websocket, creates long-running task
-async def run_expiry_checker_task():
-    """Run a periodic check for expired check-ins"""
+
+
+async def start_expiry_engine():
+    """Catch up on check-ins that expired while we were down, then start the expiry engine"""
+    await run_expiry_checker()
+    db = manager._get_db()
     try:
-        while True:
-            # Check every minute for expired check-ins
-            await asyncio.sleep(60)
-            await manager.expire_checkins()
-    except asyncio.CancelledError:
-        # Task was cancelled, exit gracefully
-        pass
+        manager.expiry.load(await manager._get_active_expiries(db))
     except Exception as e:
-        logger.error(f"Error in expiry checker: {e}")
+        logger.error(f"Error loading active check-ins for expiry: {e}")
+    finally:
+        await db.close()
+    manager.expiry.start()
+
+
+async def load_room_directory():
+    """Load the room to building map once at startup; db_room.py triggers reloads"""
+    await manager.load_room_directory()
+
+
+async def load_history_snapshot():
+    """Load the connect-time history snapshot, per-room activity and room counts once at startup"""
+    await manager._load_history()
+
+
+async def stop_expiry_engine():
+    await manager.expiry.stop()
+
+
+def start_presence_updates():
+    manager.start_presence()
+
+
+async def stop_presence_updates():
+    await manager.stop_presence()
+
+
+def start_heartbeat():
+    manager.start_heartbeat()
+
+
+async def stop_heartbeat():
+    await manager.stop_heartbeat()
+
+
+def start_rollups():
+    manager.rollups.start()
+
+
+async def stop_rollups():
+    """Write the occupancy integrated so far before shutdown"""
+    await manager.rollups.stop()
+
+
+def start_event_log():
+    manager.event_log.start()
+
+
+async def stop_event_log():
+    """Flush buffered activity events before shutdown"""
+    await manager.event_log.stop()
+
+
+async def start_backplane():
+    """Connect the manager to the other workers through the configured backplane"""
+    try:
+        backplane = create_backplane(
+            settings.broadcast_backplane,
+            settings.database_url,
+            settings.broadcast_channel
+        )
+        if backplane is not None:
+            await manager.attach_backplane(backplane)
+    except Exception as e:
+        # Keep serving this worker's clients even if the backplane is unavailable
+        logger.error(f"Error starting broadcast backplane: {e}")
+
+
+async def stop_backplane():
+    await manager.detach_backplane()
 
 async def websocket_endpoint(websocket: WebSocket):
     # Extract the authentication token either from cookie header or query parameter
@@ -568,86 +1515,76 @@ async def websocket_endpoint(websocket: WebSocket):
         query_params = dict(websocket.query_params)
         token = query_params.get('token')
     
-    # Get the authenticated user
-    db = SessionLocal()
-    try:
-        user = None
-        if token:
-            try:
-                payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
-                email = payload.get("sub")
-                if email:
-                    user = db.query(User).filter(User.email == email).first()
-            except Exception as e:
-                logger.error(f"Authentication error: {e}")
-        
-        # If user is not authenticated, reject the connection
-        if not user:
-            await websocket.close(code=1008, reason="Unauthorized")
-            return
-            
-        # Connect with the authenticated user info
-        await manager.connect(websocket, username=user.username, user_id=str(user.id))
-        
-        # Set up a task to expire check-ins
-        expiry_task = asyncio.create_task(run_expiry_checker_task())
-        
+    # Get the authenticated user, from the shared principal cache when possible
+    user = None
+    if token:
+        db = manager._get_db()
         try:
-            while True:
-                # Wait for messages from the client
-                data_str = await websocket.receive_text()
-                
-                # Skip ping messages used to keep connection alive
-                if data_str == "ping":
-                    continue
-                    
-                try:
-                    # Parse the message as JSON
-                    data = json.loads(data_str)
-                    message_type = data.get("type")
-                    
-                    if message_type == "checkin":
-                        await manager.handle_checkin(websocket, data)
-                    elif message_type == "checkout":
-                        await manager.handle_checkout(websocket, data)
-                    elif message_type == "setUsername":
-                        # Update the username for this connection
-                        user_id = manager.user_ids.get(websocket)
-                        username = data.get("username")
-                        manager.usernames[websocket] = username
-                        
-                        # Update any existing check-in in the database
-                        db = manager._get_db()
-                        try:
-                            active_checkin = db.query(RoomOccupancy).filter(
-                                RoomOccupancy.user_id == user_id,
-                                RoomOccupancy.is_active == True
-                            ).first()
-                            
-                            if active_checkin:
-                                active_checkin.username = username
-                                db.commit()
-                        except Exception as e:
-                            db.rollback()
-                            logger.error(f"Error updating username: {e}")
-                        finally:
-                            db.close()
-                except json.JSONDecodeError:
-                    # Not JSON, treat as ping/keepalive
-                    pass
-                    
-        except WebSocketDisconnect:
-            # Clean up and notify other clients
-            disconnect_event = manager.disconnect(websocket)
-            await manager.broadcast(disconnect_event)
-            # Cancel the expiry task
-            expiry_task.cancel()
+            payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+            email = payload.get("sub")
+            if email:
+                user = principal_cache.get(email)
+                if user is None:
+                    result = await db.execute(select(User).filter(User.email == email))
+                    user = result.scalars().first()
+                    if user is not None:
+                        principal_cache.put(user)
         except Exception as e:
-            logger.error(f"Error in websocket endpoint: {e}")
-            # Make sure to clean up the task
+            logger.error(f"Authentication error: {e}")
+        finally:
+            await db.close()
+    
+    # If user is not authenticated, reject the connection
+    if not user:
+        await websocket.close(code=1008, reason="Unauthorized")
+        return
+        
+    # Reconnecting clients send the stream and seq of the last event they saw
+    query_params = dict(websocket.query_params)
+    try:
+        since = int(query_params["since"]) if "since" in query_params else None
+    except ValueError:
+        since = None
+
+    # Connect with the authenticated user info
+    connection = await manager.connect(
+        websocket,
+        username=user.username,
+        user_id=str(user.id),
+        since=since,
+        stream=query_params.get("stream")
+    )
+    
+    try:
+        while True:
+            # Wait for a text or binary frame from the client
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            raw = received.get("text")
+            if raw is None:
+                raw = received.get("bytes") or b""
+            connection.received(len(raw.encode()) if isinstance(raw, str) else len(raw))
+
+            # Keepalive pings and heartbeat replies only count as activity
+            if raw in ("ping", "pong"):
+                continue
+
             try:
-                expiry_task.cancel()
-            except:
-                pass
+                message = manager.decode(connection, raw)
+            except ValueError:
+                await manager.send_personal(websocket, MALFORMED_MESSAGE)
+                continue
+            await manager.dispatch(websocket, message)
+                
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Error in websocket endpoint: {e}")
     finally:
-        db.close()
\ No newline at end of file
+        # Run commands still held in the debounce window while the connection is registered
+        await manager.debouncer.flush(connection.user_id)
+        # Clean up and notify other clients, however the loop ended
+        disconnect_event = manager.disconnect(websocket)
+        if disconnect_event:
+            await manager.broadcast(disconnect_event)
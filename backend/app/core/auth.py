@@ -22,6 +22,7 @@ from app.crud.user import get_user_by_email, get_user_by_username
 from app.utils.response import success_response, error_response
 from app.models.user import User, Program, Cookie
 from app.utils.query import filter_query
+from app.core.principal_cache import principal_cache
 
 logging.getLogger("passlib").setLevel(logging.ERROR)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -117,11 +118,15 @@ def get_active_user(
         if email is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-        user = filter_query(db, model=User, filters=[User.email == email])
-        if not user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+        user = principal_cache.get(email)
+        if user is None:
+            users = filter_query(db, model=User, filters=[User.email == email])
+            if not users:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+            user = users[0]
+            principal_cache.put(user)
 
-        return user[0]
+        return user
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
 
@@ -288,6 +293,7 @@ def sign_out(
         active_cookie = get_active_cookie(db, user_id=current_user.id)
         if active_cookie:
             deactivate_cookie(db, active_cookie.access_token)
+            principal_cache.invalidate(current_user.email)
             response.delete_cookie("access_token")
             return success_response(
                 status_codes=200,
@@ -344,6 +350,7 @@ def update_password(
         db.add(current_user)
         db.commit()
         db.refresh(current_user)
+        principal_cache.invalidate(current_user.email)
         return success_response(
             status_codes=200,
             status=True,
@@ -410,6 +417,7 @@ def verify_email(
 
         user.active = True
         db.commit()
+        principal_cache.invalidate(user.email)
 
         return RedirectResponse(url=f"{settings.frontend_url}/signin")
 
@@ -589,6 +597,7 @@ async def reset_password(
         user.password = get_password_hash(data.password)
         db.commit()
         db.refresh(user)
+        principal_cache.invalidate(user.email)
 
         return success_response(
             status_codes=200,
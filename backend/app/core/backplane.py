@@ -0,0 +1,206 @@
+import json
+import uuid
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import psycopg2
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD = 7999
+
+class Backplane(ABC):
+    """
+    Carries ConnectionManager events between processes so that a check-in on
+    one uvicorn worker reaches the websockets held by every other worker.
+    Messages published by this node are never delivered back to it.
+    """
+
+    def __init__(self):
+        self.node_id = str(uuid.uuid4())
+        self.on_message: Optional[Callable[[Dict], None]] = None
+
+    @abstractmethod
+    async def start(self, on_message: Callable[[Dict], None]):
+        """Begin delivering messages from other nodes; implementations call this first"""
+        self.on_message = on_message
+
+    @abstractmethod
+    async def publish(self, message: Dict):
+        """Send a message to every other node"""
+
+    @abstractmethod
+    async def stop(self):
+        """Stop delivering messages; implementations call this too"""
+        self.on_message = None
+
+    def _encode(self, message: Dict) -> str:
+        return json.dumps({"origin": self.node_id, "event": message})
+
+    def _deliver(self, payload: str):
+        """Decode a payload from the wire and hand it to the manager unless we sent it"""
+        try:
+            envelope = json.loads(payload)
+        except json.JSONDecodeError:
+            logger.warning("Dropping malformed backplane payload")
+            return
+        if envelope.get("origin") == self.node_id or self.on_message is None:
+            return
+        try:
+            self.on_message(envelope["event"])
+        except Exception as e:
+            logger.error(f"Error handling backplane event: {e}")
+
+
+class InProcessBus:
+    """Shared medium for InProcessBackplane instances, stands in for Postgres in tests"""
+
+    def __init__(self):
+        self.members: List["InProcessBackplane"] = []
+
+
+class InProcessBackplane(Backplane):
+    """
+    Backplane that only reaches other InProcessBackplane instances on the same bus.
+    Payloads still go through JSON so nodes never share mutable event dicts.
+    """
+
+    def __init__(self, bus: InProcessBus = None):
+        super().__init__()
+        self.bus = bus or InProcessBus()
+
+    async def start(self, on_message: Callable[[Dict], None]):
+        await super().start(on_message)
+        self.bus.members.append(self)
+
+    async def publish(self, message: Dict):
+        payload = self._encode(message)
+        loop = asyncio.get_running_loop()
+        for member in list(self.bus.members):
+            if member is not self:
+                loop.call_soon(member._deliver, payload)
+
+    async def stop(self):
+        if self in self.bus.members:
+            self.bus.members.remove(self)
+        await super().stop()
+
+
+class PostgresBackplane(Backplane):
+    """
+    Backplane over Postgres LISTEN/NOTIFY.
+    A dedicated autocommit connection LISTENs on the channel and is polled
+    from the event loop when its socket becomes readable. NOTIFYs are sent
+    from a single worker thread so publishing never blocks the loop.
+    """
+
+    def __init__(self, database_url: str, channel: str, reconnect_delay: float = 5.0):
+        super().__init__()
+        # psycopg2 wants a plain libpq URL, without the SQLAlchemy driver suffix
+        self.dsn = make_url(database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._listen_conn = None
+        self._publish_conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane-notify")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+
+    async def start(self, on_message: Callable[[Dict], None]):
+        await super().start(on_message)
+        self._loop = asyncio.get_running_loop()
+        await self._listen()
+
+    async def _listen(self):
+        conn = await self._loop.run_in_executor(self._executor, psycopg2.connect, self.dsn)
+        conn.set_session(autocommit=True)
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        self._listen_conn = conn
+        self._loop.add_reader(conn.fileno(), self._on_readable)
+        logger.info(f"Backplane listening on channel {self.channel}")
+
+    def _on_readable(self):
+        conn = self._listen_conn
+        try:
+            conn.poll()
+        except Exception as e:
+            logger.error(f"Backplane connection lost: {e}")
+            self._drop_listener()
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+            return
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            self._deliver(notify.payload)
+
+    def _drop_listener(self):
+        if self._listen_conn is not None:
+            try:
+                self._loop.remove_reader(self._listen_conn.fileno())
+            except Exception:
+                pass
+            try:
+                self._listen_conn.close()
+            except Exception:
+                pass
+            self._listen_conn = None
+
+    async def _reconnect(self):
+        while self.on_message is not None:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._listen()
+                return
+            except Exception as e:
+                logger.error(f"Backplane reconnect failed: {e}")
+
+    def _notify(self, payload: str):
+        for attempt in range(2):
+            try:
+                if self._publish_conn is None or self._publish_conn.closed:
+                    self._publish_conn = psycopg2.connect(self.dsn)
+                    self._publish_conn.set_session(autocommit=True)
+                with self._publish_conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+                return
+            except psycopg2.OperationalError:
+                # Stale connection, reconnect once before giving up
+                self._publish_conn = None
+                if attempt:
+                    raise
+
+    async def publish(self, message: Dict):
+        payload = self._encode(message)
+        if len(payload.encode("utf-8")) > MAX_NOTIFY_PAYLOAD:
+            logger.warning(f"Backplane event of type {message.get('type')} too large to publish")
+            return
+        try:
+            await self._loop.run_in_executor(self._executor, self._notify, payload)
+        except Exception as e:
+            logger.error(f"Error publishing backplane event: {e}")
+
+    async def stop(self):
+        await super().stop()
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        self._drop_listener()
+        if self._publish_conn is not None:
+            self._publish_conn.close()
+            self._publish_conn = None
+        self._executor.shutdown(wait=False)
+
+
+def create_backplane(kind: str, database_url: str, channel: str) -> Optional[Backplane]:
+    """Build the backplane selected by BROADCAST_BACKPLANE ("postgres", "memory" or "none")"""
+    if kind == "postgres":
+        return PostgresBackplane(database_url, channel)
+    if kind == "memory":
+        return InProcessBackplane()
+    if kind == "none":
+        return None
+    raise ValueError(f"Unknown broadcast backplane: {kind}")
@@ -0,0 +1,149 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple, Callable, Awaitable
+
+from fastapi import WebSocket
+
+from app.schemas.websocket import CheckinMessage, CheckoutMessage
+
+logger = logging.getLogger(__name__)
+
+class RecentCommands:
+    """
+    Client command IDs that were carried out in the last ttl seconds, so a
+    frame the client retried (or a double tap that reused its ID) is only
+    acted on once. IDs are recorded after their command succeeded, so a
+    retry of a failed command still runs. Bounded to maxsize entries,
+    oldest first out.
+    """
+
+    def __init__(self, ttl: float = 60.0, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, user_id: str, command_id: str) -> bool:
+        """Whether a command ID was recorded and has not expired"""
+        self._expire()
+        if (user_id, command_id) in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def record(self, user_id: str, command_id: str):
+        self._expire()
+        self._seen[(user_id, command_id)] = time.monotonic() + self.ttl
+        while len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+
+    def _expire(self):
+        now = time.monotonic()
+        # Entries are in insertion order, so expired ones are at the front
+        while self._seen:
+            key, expires_at = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            del self._seen[key]
+
+Command = Tuple[WebSocket, object]
+
+class CommandDebouncer:
+    """
+    Runs a user's check-in/check-out command straight away, then holds any
+    further commands for a short window and runs only their net effect, so
+    flapping between the two costs one transaction and one broadcast per
+    window instead of one per tap.
+    """
+
+    def __init__(
+        self,
+        window: float,
+        execute: Callable[[WebSocket, object], Awaitable[bool]],
+        on_success: Callable[[str, List[object]], None] = None
+    ):
+        self.window = window
+        self.execute = execute
+        # Called with the user and every message a successful command stood for
+        self.on_success = on_success
+        self._pending: Dict[str, List[Command]] = {}
+        # Users whose window is open, until it closes
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._running: Set[asyncio.Task] = set()
+        # user_id -> [lock, runs holding or waiting for it]; one user's commands never overlap
+        self._locks: Dict[str, list] = {}
+        self.collapsed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def submit(self, user_id: str, websocket: WebSocket, message):
+        """Run a command now, or hold it if it follows another one within the window"""
+        if user_id in self._timers:
+            self._pending.setdefault(user_id, []).append((websocket, message))
+            return
+        self._timers[user_id] = asyncio.get_running_loop().call_later(self.window, self._fire, user_id)
+        await self._run(user_id, [(websocket, message)])
+
+    def _fire(self, user_id: str):
+        self._timers.pop(user_id, None)
+        if user_id not in self._pending:
+            return
+        task = asyncio.create_task(self.flush(user_id))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def flush(self, user_id: str):
+        """Run a user's held commands now, e.g. before their connection goes away"""
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        commands = self._pending.pop(user_id, None)
+        if not commands:
+            return
+        self.collapsed += len(commands) - 1
+        await self._run(user_id, commands)
+
+    def discard(self, user_id: str, websocket: WebSocket):
+        """Drop the held commands that came in on a socket that has gone away"""
+        commands = self._pending.get(user_id)
+        if not commands:
+            return
+        remaining = [command for command in commands if command[0] is not websocket]
+        if remaining:
+            self._pending[user_id] = remaining
+        else:
+            del self._pending[user_id]
+
+    async def _run(self, user_id: str, commands: List[Command]):
+        websocket, message = net_effect(commands)
+        entry = self._locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                succeeded = await self.execute(websocket, message)
+            if succeeded and self.on_success is not None:
+                self.on_success(user_id, [message for _, message in commands])
+        except Exception as e:
+            logger.error(f"Error running debounced command for {user_id}: {e}")
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+def net_effect(commands: List[Command]) -> Command:
+    """
+    Single command with the same outcome as running commands in order.
+    The last command decides where the user ends up. A check-out that
+    follows a collapsed check-in leaves whatever room the user is really
+    in, and stays quiet if that turns out to be none.
+    """
+    websocket, message = commands[-1]
+    if isinstance(message, CheckoutMessage) and any(isinstance(m, CheckinMessage) for _, m in commands[:-1]):
+        message = CheckoutMessage(id=message.id, room_name=None, auto=True)
+    return websocket, message
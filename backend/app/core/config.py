@@ -27,6 +27,42 @@ class Settings(BaseSettings):
     backend_url: str = Field(default="http://localhost:8000", env="BACKEND_URL")
     frontend_url: str = Field(default="http://localhost:3000", env="FRONTEND_URL")
 
+    # WebSocket settings
+    ws_send_queue_size: int = Field(default=256, env="WS_SEND_QUEUE_SIZE")
+    ws_send_timeout: float = Field(default=5.0, env="WS_SEND_TIMEOUT")
+    ws_slow_feed_cap: int = Field(default=50, env="WS_SLOW_FEED_CAP")
+    ws_replay_window: int = Field(default=1000, env="WS_REPLAY_WINDOW")
+    ws_batch_window_ms: int = Field(default=0, env="WS_BATCH_WINDOW_MS")
+    ws_presence_interval: float = Field(default=2.0, env="WS_PRESENCE_INTERVAL")
+    ws_heartbeat_interval: float = Field(default=25.0, env="WS_HEARTBEAT_INTERVAL")
+    ws_idle_timeout: float = Field(default=75.0, env="WS_IDLE_TIMEOUT")
+    ws_command_debounce_ms: int = Field(default=250, env="WS_COMMAND_DEBOUNCE_MS")
+    ws_command_id_ttl: float = Field(default=60.0, env="WS_COMMAND_ID_TTL")
+    broadcast_backplane: str = Field(default="postgres", env="BROADCAST_BACKPLANE")
+    broadcast_channel: str = Field(default="beacons_events", env="BROADCAST_CHANNEL")
+
+    # Recent events kept in memory per room for the room activity endpoint
+    room_activity_size: int = Field(default=50, env="ROOM_ACTIVITY_SIZE")
+
+    # Occupancy history rollups
+    rollup_flush_interval: float = Field(default=60.0, env="ROLLUP_FLUSH_INTERVAL")
+    rollup_5m_retention_days: int = Field(default=14, env="ROLLUP_5M_RETENTION_DAYS")
+    rollup_1h_retention_days: int = Field(default=180, env="ROLLUP_1H_RETENTION_DAYS")
+
+    # Occupancy forecast, refitted from the hourly rollups
+    forecast_refit_interval: float = Field(default=3600.0, env="FORECAST_REFIT_INTERVAL")
+    forecast_history_days: int = Field(default=56, env="FORECAST_HISTORY_DAYS")
+    forecast_half_life_days: float = Field(default=14.0, env="FORECAST_HALF_LIFE_DAYS")
+
+    # Authenticated user cache settings
+    principal_cache_size: int = Field(default=1024, env="PRINCIPAL_CACHE_SIZE")
+    principal_cache_ttl: float = Field(default=60.0, env="PRINCIPAL_CACHE_TTL")
+
+    # Activity log write-behind settings
+    activity_log_batch_size: int = Field(default=100, env="ACTIVITY_LOG_BATCH_SIZE")
+    activity_log_flush_ms: int = Field(default=10, env="ACTIVITY_LOG_FLUSH_MS")
+    activity_log_max_pending: int = Field(default=10000, env="ACTIVITY_LOG_MAX_PENDING")
+
     class Config:
         env_file = ".env.prod"
         env_file_encoding = "utf-8"
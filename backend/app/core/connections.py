@@ -0,0 +1,181 @@
+import time
+import asyncio
+from typing import Dict, List, Set, Iterator, Optional, Callable, Awaitable
+
+from fastapi import WebSocket
+
+class Connection:
+    """
+    State for one websocket: who it belongs to, its subscribed topics, its
+    bounded outbound queue and writer task, and traffic counters.
+    Broadcasts only enqueue here, the writer task is the only thing that
+    waits on the network for this client.
+
+    Once the queue fills up the connection is lagging: further broadcasts
+    are folded into the pending_* catch-up state by the manager instead of
+    being queued, and sent as one frame after the queue drains.
+    """
+    __slots__ = (
+        "websocket", "user_id", "username", "codec", "queue", "send_timeout", "writer", "topics",
+        "connected_at", "last_activity", "messages_sent", "bytes_sent", "messages_received", "bytes_received",
+        "lagging", "pending_events", "pending_occupancy", "pending_presence", "pending_seq", "resync"
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_size: int,
+        send_timeout: float,
+        codec: str,
+        user_id: str = None,
+        username: str = None
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.username = username
+        self.codec = codec
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self.send_timeout = send_timeout
+        self.writer: Optional[asyncio.Task] = None
+        self.topics: Set[str] = set()
+        self.connected_at = self.last_activity = time.monotonic()
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.stop_lagging()
+
+    def start(
+        self,
+        on_failure: Callable[["Connection", Exception], Awaitable[None]],
+        on_drained: Callable[["Connection"], object]
+    ):
+        """
+        Start the writer. on_failure is called if a send fails; on_drained is
+        called once a lagging connection's queue is empty and returns the
+        catch-up frame to send.
+        """
+        self.writer = asyncio.create_task(self._run(on_failure, on_drained))
+
+    def offer(self, frame) -> bool:
+        """Queue a frame without blocking, returns False if the queue is full"""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def stop(self):
+        """Cancel the writer task unless we are running inside it"""
+        if self.writer and not self.writer.done() and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+    def start_lagging(self):
+        self.lagging = True
+        self.pending_events: List[Dict] = []
+        self.pending_occupancy: Dict[str, int] = {}
+        self.pending_presence: Optional[Dict] = None
+        self.pending_seq: Optional[int] = None
+        self.resync = False
+
+    def stop_lagging(self):
+        """Leave lagging mode, releasing the catch-up state"""
+        self.lagging = False
+        self.pending_events = None
+        self.pending_occupancy = None
+        self.pending_presence = None
+        self.pending_seq = None
+        self.resync = False
+
+    def received(self, size: int):
+        """Count an inbound message of size bytes; only traffic from the client counts as activity"""
+        self.messages_received += 1
+        self.bytes_received += size
+        self.last_activity = time.monotonic()
+
+    async def _send(self, frame):
+        size = await asyncio.wait_for(frame.send(self.websocket, self.codec), timeout=self.send_timeout)
+        self.messages_sent += 1
+        self.bytes_sent += size
+
+    async def _run(self, on_failure, on_drained):
+        while True:
+            frame = await self.queue.get()
+            try:
+                await self._send(frame)
+                if self.lagging and self.queue.empty():
+                    # Backlog written, everything conflated meanwhile goes out as one frame
+                    await self._send(on_drained(self))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Dead or stalled client, hand it to the manager's eviction policy
+                await on_failure(self, e)
+                return
+            finally:
+                self.queue.task_done()
+
+class ConnectionRegistry:
+    """
+    Every connection on this worker, by socket and by user, so adding,
+    removing and finding a connection or all of a user's open tabs is O(1).
+    """
+
+    def __init__(self):
+        self._by_socket: Dict[WebSocket, Connection] = {}
+        self._by_user: Dict[str, Set[Connection]] = {}
+
+    def __len__(self):
+        return len(self._by_socket)
+
+    def __contains__(self, websocket: WebSocket):
+        return websocket in self._by_socket
+
+    def __iter__(self) -> Iterator[Connection]:
+        return iter(self._by_socket.values())
+
+    def get(self, websocket: WebSocket) -> Optional[Connection]:
+        return self._by_socket.get(websocket)
+
+    def add(self, connection: Connection):
+        self._by_socket[connection.websocket] = connection
+        if connection.user_id is not None:
+            self._by_user.setdefault(connection.user_id, set()).add(connection)
+
+    def remove(self, websocket: WebSocket) -> Optional[Connection]:
+        """Drop a connection and return it, or None if it was not registered"""
+        connection = self._by_socket.pop(websocket, None)
+        if connection is not None:
+            self._unindex(connection)
+        return connection
+
+    def for_user(self, user_id: str) -> Set[Connection]:
+        return self._by_user.get(user_id, set())
+
+    def user_count(self) -> int:
+        """Distinct users with at least one open connection"""
+        return len(self._by_user)
+
+    def _unindex(self, connection: Connection):
+        connections = self._by_user.get(connection.user_id)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self._by_user[connection.user_id]
+
+    def idle(self, idle_for: float) -> List[Connection]:
+        """Connections the client has not sent anything on for idle_for seconds"""
+        cutoff = time.monotonic() - idle_for
+        return [connection for connection in self if connection.last_activity <= cutoff]
+
+    def stats(self) -> Dict:
+        return {
+            "connections": len(self._by_socket),
+            "users": len(self._by_user),
+            "messages_sent": sum(c.messages_sent for c in self),
+            "bytes_sent": sum(c.bytes_sent for c in self),
+            "messages_received": sum(c.messages_received for c in self),
+            "bytes_received": sum(c.bytes_received for c in self),
+            "queued": sum(c.queue.qsize() for c in self),
+            "lagging": sum(1 for c in self if c.lagging)
+        }
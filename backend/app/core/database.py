@@ -1,8 +1,11 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
 
+# Sync engine, for alembic, the data loading scripts and the scheduled jobs
 engine = create_engine(
     settings.database_url,
     pool_size=10,
@@ -12,6 +15,20 @@ engine = create_engine(
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def async_database_url(database_url: str) -> str:
+    """The same database through asyncpg, whichever sync driver DATABASE_URL names"""
+    return make_url(database_url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+# Async engine, for request handlers and the websocket manager so queries don't block the event loop
+async_engine = create_async_engine(
+    async_database_url(settings.database_url),
+    pool_size=10,
+    max_overflow=20,
+    pool_timeout=30,
+)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -20,3 +37,7 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
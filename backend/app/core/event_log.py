@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.occupancy import ActivityEvent
+
+logger = logging.getLogger(__name__)
+
+class ActivityEventWriter:
+    """
+    Write-behind buffer for the activity_events log (REQ-7).
+    Check-in handlers queue the row and move on; a single writer task
+    collects rows for up to flush_interval seconds (or until batch_size are
+    waiting) and stores them with one bulk INSERT.
+    The buffer is bounded, so a stalled database slows producers down
+    instead of growing memory without limit.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession],
+        batch_size: int = 100,
+        flush_interval: float = 0.01,
+        max_pending: int = 10000
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._batch_ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.written_count = 0
+        self.failed_count = 0
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    async def add(self, row: Dict):
+        """Queue an ActivityEvent row (column -> value), waiting if the buffer is full"""
+        await self._queue.put(row)
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Write everything still buffered, then stop the writer task"""
+        if self._task is None:
+            while not self._queue.empty():
+                await self._write(self._take())
+            return
+        self._stopping = True
+        self._batch_ready.set()
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._stopping = False
+
+    def _take(self, first: Dict = None) -> List[Dict]:
+        rows = [] if first is None else [first]
+        while len(rows) < self.batch_size and not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        return rows
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            # Give the batch a moment to fill unless it already has
+            if not self._stopping and self._queue.qsize() < self.batch_size - 1:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self._write(self._take(first))
+
+    async def _write(self, rows: List[Dict]):
+        try:
+            await self._insert(rows)
+            self.written_count += len(rows)
+        except Exception as e:
+            self.failed_count += len(rows)
+            logger.error(f"Error writing {len(rows)} activity events: {e}")
+        finally:
+            for _ in rows:
+                self._queue.task_done()
+
+    async def _insert(self, rows: List[Dict]):
+        db = self.session_factory()
+        try:
+            await db.execute(insert(ActivityEvent), rows)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        finally:
+            await db.close()
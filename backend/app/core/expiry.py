@@ -0,0 +1,120 @@
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Dict, Tuple, Iterable, Optional, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+class ExpiryEngine:
+    """
+    Process-wide check-in expiry scheduler (REQ-5).
+    Active check-ins are kept in a min-heap keyed by expiry time, so the engine
+    sleeps until the next real expiry instead of rescanning room_occupancy.
+    Check-outs and re-check-ins replace a user's entry lazily: stale heap
+    entries are skipped when they reach the top.
+    """
+
+    def __init__(
+        self,
+        on_expire: Callable[[List[str]], Awaitable[None]],
+        batch_size: int = 100,
+        retry_delay: float = 60.0
+    ):
+        self.on_expire = on_expire
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._heap: List[Tuple[float, str]] = []
+        # user_id -> expiry timestamp of that user's live heap entry
+        self._entries: Dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, user_id: str, expiry_time: datetime):
+        """Track (or move) a user's active check-in"""
+        expires_at = expiry_time.timestamp()
+        self._entries[user_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, user_id))
+        self._compact()
+        # Only wake the loop if this is now the earliest expiry
+        if self._heap[0] == (expires_at, user_id):
+            self._wakeup.set()
+
+    def cancel(self, user_id: str):
+        """Forget a user's check-in, its heap entry is dropped when it surfaces"""
+        self._entries.pop(user_id, None)
+
+    def load(self, checkins: Iterable[Tuple[str, datetime]]):
+        """Replace the heap with the given (user_id, expiry_time) pairs"""
+        self._entries = {user_id: expiry_time.timestamp() for user_id, expiry_time in checkins}
+        self._heap = [(expires_at, user_id) for user_id, expires_at in self._entries.items()]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def next_expiry(self) -> Optional[float]:
+        """Timestamp of the earliest live check-in, or None if there are none"""
+        self._drop_stale_head()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> List[str]:
+        """Remove and return up to batch_size users whose check-ins have expired by now"""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            expires_at, user_id = heapq.heappop(self._heap)
+            if self._entries.get(user_id) == expires_at:
+                del self._entries[user_id]
+                due.append(user_id)
+        return due
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _drop_stale_head(self):
+        while self._heap and self._entries.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Lazy deletion leaves dead entries behind, rebuild once they dominate
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(expires_at, user_id) for user_id, expires_at in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            next_expiry = self.next_expiry()
+            delay = None if next_expiry is None else next_expiry - time.time()
+
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self.pop_due(time.time())
+            if due:
+                try:
+                    await self.on_expire(due)
+                except Exception as e:
+                    logger.error(f"Error expiring check-ins: {e}")
+                    # Try this batch again later rather than losing it
+                    retry_at = time.time() + self.retry_delay
+                    for user_id in due:
+                        if user_id not in self._entries:
+                            self._entries[user_id] = retry_at
+                            heapq.heappush(self._heap, (retry_at, user_id))
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.activity import get_edmonton_time
+from app.core.database import AsyncSessionLocal
+from app.core.profiles import fit_profiles
+from app.core.room_directory import RoomDirectory, room_directory
+from app.models.occupancy import OccupancyRollup
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+
+class ForecastMatrix:
+    """
+    Fitted weekday x hour profiles of every room and building. A forecast is
+    a dict lookup and an array index, whatever the size of the history.
+    """
+    __slots__ = ("rooms", "buildings", "room_profiles", "building_profiles", "fitted_at")
+
+    def __init__(
+        self,
+        rooms: List[str],
+        buildings: List[str],
+        room_profiles: np.ndarray,
+        building_profiles: np.ndarray,
+        fitted_at: datetime
+    ):
+        self.rooms = {room_name: index for index, room_name in enumerate(rooms)}
+        self.buildings = {building_name: index for index, building_name in enumerate(buildings)}
+        self.room_profiles = room_profiles
+        self.building_profiles = building_profiles
+        self.fitted_at = fitted_at
+
+    def building(self, building_name: str, at: datetime) -> Optional[float]:
+        index = self.buildings.get(building_name)
+        if index is None:
+            return None
+        return float(self.building_profiles[index, at.weekday(), at.hour])
+
+    def room(self, room_name: str, at: datetime) -> Optional[float]:
+        index = self.rooms.get(room_name)
+        if index is None:
+            return None
+        return float(self.room_profiles[index, at.weekday(), at.hour])
+
+class Forecaster:
+    """
+    Refits the forecast matrix from the hourly occupancy rollups every
+    refit_interval seconds. Rows are read here; the fit runs in a separate
+    process so it never holds up the event loop. Requests read whichever
+    matrix was fitted last.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession],
+        clock: Callable[[], datetime],
+        directory: RoomDirectory,
+        refit_interval: float = 3600.0,
+        history_days: int = 56,
+        half_life_days: float = 14.0
+    ):
+        self.session_factory = session_factory
+        self.clock = clock
+        self.directory = directory
+        self.refit_interval = refit_interval
+        self.history_days = history_days
+        self.half_life_days = half_life_days
+        self.matrix: Optional[ForecastMatrix] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.refit_interval <= 0 or (self._task is not None and not self._task.done()):
+            return
+        # A fresh interpreter rather than a fork of the running server
+        self._executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refit()
+            except Exception as e:
+                logger.error(f"Error refitting occupancy forecast: {e}")
+            await asyncio.sleep(self.refit_interval)
+
+    async def refit(self):
+        """Fit a new matrix from the history up to the last full hour"""
+        end = self.clock().replace(minute=0, second=0, microsecond=0)
+        start = end - timedelta(days=self.history_days)
+        room_names, averages, bucket_starts = await self._load(start, end)
+        if bucket_starts:
+            # Don't count hours from before the history was recorded as empty
+            start = max(start, min(bucket_starts))
+
+        # Every listed building gets a row, unlisted ones are added by name prefix
+        rooms = sorted(set(room_names))
+        buildings = list(self.directory.names)
+        building_rows: Dict[str, int] = {name: index for index, name in enumerate(buildings)}
+        building_of_room = np.empty(len(rooms), dtype=np.int64)
+        for index, room_name in enumerate(rooms):
+            building_name = self.directory.building_for(room_name)
+            if building_name not in building_rows:
+                building_rows[building_name] = len(buildings)
+                buildings.append(building_name)
+            building_of_room[index] = building_rows[building_name]
+
+        room_rows = {room_name: index for index, room_name in enumerate(rooms)}
+        arguments = (
+            np.fromiter((room_rows[room_name] for room_name in room_names), dtype=np.int64, count=len(room_names)),
+            np.array(bucket_starts, dtype="datetime64[h]").astype(np.int64),
+            np.array(averages, dtype=np.float64),
+            len(rooms),
+            building_of_room,
+            len(buildings),
+            int(np.datetime64(start, "h").astype(np.int64)),
+            int(np.datetime64(end, "h").astype(np.int64)),
+            self.half_life_days * 24
+        )
+        if self._executor is not None:
+            room_profiles, building_profiles = await asyncio.get_running_loop().run_in_executor(
+                self._executor, fit_profiles, *arguments
+            )
+        else:
+            room_profiles, building_profiles = fit_profiles(*arguments)
+        self.matrix = ForecastMatrix(rooms, buildings, room_profiles, building_profiles, end)
+        logger.info(f"Fitted occupancy forecast for {len(rooms)} rooms in {len(buildings)} buildings")
+
+    async def _load(self, start: datetime, end: datetime):
+        """Hourly rollups in [start, end), as (room names, average occupants, bucket starts)"""
+        db = self.session_factory()
+        try:
+            result = await db.execute(select(
+                OccupancyRollup.room_name,
+                OccupancyRollup.occupied_seconds,
+                OccupancyRollup.bucket_start
+            ).filter(
+                OccupancyRollup.resolution == HOUR,
+                OccupancyRollup.bucket_start >= start,
+                OccupancyRollup.bucket_start < end
+            ))
+            rows = result.all()
+        finally:
+            await db.close()
+        return (
+            [row[0] for row in rows],
+            [row[1] / HOUR for row in rows],
+            [row[2] for row in rows]
+        )
+
+forecaster = Forecaster(
+    AsyncSessionLocal,
+    lambda: get_edmonton_time().replace(tzinfo=None),
+    room_directory,
+    refit_interval=settings.forecast_refit_interval,
+    history_days=settings.forecast_history_days,
+    half_life_days=settings.forecast_half_life_days
+)
@@ -0,0 +1,143 @@
+import json
+import hashlib
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app.core.room_directory import RoomDirectory
+from app.models.occupancy import RoomCount
+
+def encode_success(message: str, data) -> bytes:
+    """Body of success_response(200, True, message, data), encoded exactly as JSONResponse does"""
+    return json.dumps(
+        {"status": True, "message": message, "data": data},
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":")
+    ).encode("utf-8")
+
+class CachedResponse:
+    """A pre-encoded response body and its strong ETag"""
+    __slots__ = ("body", "etag")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """Whether an If-None-Match header names this body (weak comparison, as RFC 9110 asks)"""
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == self.etag for tag in tags)
+
+class OccupancySnapshot:
+    """
+    Room counts behind GET /occupancy/rooms and /occupancy/buildings. Both
+    responses are built and encoded at most once per change to a count,
+    then shared by every poll until the next check-in, check-out or expiry.
+    Rooms are grouped into buildings through the room directory.
+    """
+
+    def __init__(self, directory: RoomDirectory):
+        self.directory = directory
+        # room_name -> (occupant_count, last_updated as stored in room_counts)
+        self.rooms: Dict[str, Tuple[int, datetime]] = {}
+        self.loaded = False
+        self.builds = 0
+        self._rooms_response: Optional[CachedResponse] = None
+        self._buildings_response: Optional[CachedResponse] = None
+        self._directory_version = None
+
+    def load(self, room_counts: List[RoomCount]):
+        self.rooms = {
+            room.room_name: (room.occupant_count, room.last_updated)
+            for room in room_counts
+        }
+        self.loaded = True
+        self._invalidate()
+
+    def loaded_from(self, room_counts: List[RoomCount]) -> "OccupancySnapshot":
+        """A separate snapshot of the given rows, for when this one was never loaded"""
+        snapshot = OccupancySnapshot(self.directory)
+        snapshot.load(room_counts)
+        return snapshot
+
+    def apply(self, event: Dict):
+        """Record the room count carried by a broadcast event"""
+        if not self.loaded or "current_occupancy" not in event:
+            return
+        # The count was written in the same transaction, moments before the event was stamped
+        last_updated = datetime.fromisoformat(event["timestamp"]).replace(tzinfo=None)
+        self.rooms[event["room_name"]] = (event["current_occupancy"], last_updated)
+        self._invalidate()
+
+    def rooms_response(self) -> CachedResponse:
+        if self._rooms_response is None:
+            self.builds += 1
+            self._rooms_response = CachedResponse(encode_success(
+                "Room occupancy data retrieved successfully",
+                [
+                    {
+                        "room_name": room_name,
+                        "occupant_count": count,
+                        "last_updated": last_updated.isoformat()
+                    }
+                    for room_name, (count, last_updated) in sorted(self.rooms.items())
+                    if count > 0
+                ]
+            ))
+        return self._rooms_response
+
+    def buildings_response(self) -> CachedResponse:
+        directory = self.directory
+        if self._buildings_response is None or self._directory_version != directory.version:
+            self.builds += 1
+            self._directory_version = directory.version
+            counts = [0] * len(directory)
+            updated: List[Optional[datetime]] = [None] * len(directory)
+            # Rooms whose building is not in the directory, grouped by name prefix
+            unlisted: Dict[str, list] = {}
+            for room_name, (count, last_updated) in self.rooms.items():
+                if count <= 0:
+                    continue
+                index = directory.index_for(room_name)
+                if index is None:
+                    building = unlisted.setdefault(directory.building_for(room_name), [0, last_updated])
+                    building[0] += count
+                    building[1] = max(building[1], last_updated)
+                    continue
+                counts[index] += count
+                # Use the most recent update time
+                if updated[index] is None or last_updated > updated[index]:
+                    updated[index] = last_updated
+
+            buildings = [
+                building_entry(directory.names[index], counts[index], updated[index], directory.coordinates[index])
+                for index in range(len(counts))
+                if counts[index]
+            ]
+            buildings.extend(
+                building_entry(building_name, count, last_updated, None)
+                for building_name, (count, last_updated) in unlisted.items()
+            )
+            buildings.sort(key=lambda building: building["building_name"])
+            self._buildings_response = CachedResponse(encode_success(
+                "Building occupancy data retrieved successfully",
+                buildings
+            ))
+        return self._buildings_response
+
+    def _invalidate(self):
+        self._rooms_response = None
+        self._buildings_response = None
+
+def building_entry(building_name: str, count: int, last_updated: datetime, coordinates: Optional[Tuple[float, float]]) -> Dict:
+    latitude, longitude = coordinates or (None, None)
+    return {
+        "building_name": building_name,
+        "occupant_count": count,
+        "last_updated": last_updated.isoformat(),
+        "latitude": latitude,
+        "longitude": longitude
+    }
@@ -0,0 +1,78 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.core.config import settings
+from app.models.user import User
+
+class PrincipalCache:
+    """
+    Bounded TTL/LRU cache of authenticated users keyed by token subject (the
+    email in the JWT "sub" claim), shared by get_active_user and websocket auth.
+    Only column values are stored; every hit builds its own detached User so a
+    handler can re-attach and modify it without touching other requests' copies.
+    Entries are dropped when the user changes, and expire after ttl seconds
+    so changes made by other workers are picked up too.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        # Sync dependencies run in the threadpool
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, subject: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[subject]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(subject)
+            self.hits += 1
+            values = entry[1]
+        user = User(**values)
+        make_transient_to_detached(user)
+        return user
+
+    def put(self, user: User):
+        """Cache a user loaded from the database"""
+        if self.maxsize <= 0:
+            return
+        values = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+        with self._lock:
+            self._entries[user.email] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user.email)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, subject: str):
+        with self._lock:
+            self._entries.pop(subject, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+principal_cache = PrincipalCache(settings.principal_cache_size, settings.principal_cache_ttl)
@@ -0,0 +1,50 @@
+"""
+Weekday x hour occupancy profiles, fitted with NumPy. Kept free of app
+imports so the fit can run in a separate process.
+"""
+import numpy as np
+
+WEEKDAYS = 7
+SLOTS = 24
+CELLS = WEEKDAYS * SLOTS
+
+def weekday_slot(hours: np.ndarray) -> np.ndarray:
+    """Cell (weekday * 24 + hour, Monday = 0) of hour numbers counted from 1970-01-01, a Thursday"""
+    return (hours // 24 + 3) % WEEKDAYS * SLOTS + hours % SLOTS
+
+def fit_profiles(
+    room_index: np.ndarray,
+    hours: np.ndarray,
+    averages: np.ndarray,
+    rooms: int,
+    building_of_room: np.ndarray,
+    buildings: int,
+    start_hour: int,
+    end_hour: int,
+    half_life_hours: float
+):
+    """
+    Seasonal average occupancy of every room and building for each weekday
+    and hour, over the hours in [start_hour, end_hour). An hour's weight
+    halves every half_life_hours back from the newest, and an hour without
+    a row counts as empty. Returns (room profiles, building profiles)
+    shaped (n, 7, 24).
+    """
+    # Weight of every hour in the window, newest is 1
+    grid = np.arange(start_hour, end_hour, dtype=np.int64)
+    decay = np.log(2) / half_life_hours
+    grid_weights = np.exp((grid - (end_hour - 1)) * decay)
+    denominator = np.bincount(weekday_slot(grid), weights=grid_weights, minlength=CELLS)
+
+    weights = np.exp((hours - (end_hour - 1)) * decay)
+    numerator = np.zeros((rooms, CELLS))
+    np.add.at(numerator, (room_index, weekday_slot(hours)), weights * averages)
+    room_profiles = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+    # A building's expected occupancy is the sum over its rooms
+    building_profiles = np.zeros((buildings, CELLS))
+    np.add.at(building_profiles, building_of_room, room_profiles)
+    return (
+        room_profiles.reshape(rooms, WEEKDAYS, SLOTS).astype(np.float32),
+        building_profiles.reshape(buildings, WEEKDAYS, SLOTS).astype(np.float32)
+    )
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.occupancy import OccupancyRollup, RoomCount
+
+logger = logging.getLogger(__name__)
+
+# Bucket sizes in seconds: 5 minutes, 1 hour, 1 day
+RESOLUTIONS = (300, 3600, 86400)
+RESOLUTION_NAMES = {"5m": 300, "1h": 3600, "1d": 86400}
+
+BucketKey = Tuple[int, str, datetime]
+
+def bucket_start(moment: datetime, resolution: int) -> datetime:
+    """Start of the bucket holding a (naive, local) moment; buckets are aligned to local midnight"""
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution >= 86400:
+        return day
+    offset = int((moment - day).total_seconds()) // resolution * resolution
+    return day + timedelta(seconds=offset)
+
+class RollupAccumulator:
+    """
+    Integrates every room's occupant count over time into 5 minute, hourly
+    and daily buckets, fed by the count each event carries. A bucket holds
+    occupied_seconds (count x seconds, so the average is occupied_seconds /
+    resolution) and the peak count.
+    Values only depend on event timestamps, and only grow while a bucket is
+    open, so every worker computes the same rows and writing them with
+    GREATEST is idempotent.
+    """
+
+    def __init__(self):
+        # room_name -> [count, integrated up to]
+        self.rooms: Dict[str, list] = {}
+        # open buckets -> [occupied_seconds, peak]
+        self.buckets: Dict[BucketKey, list] = {}
+        self._dirty: set = set()
+
+    def load(self, counts: Dict[str, int], now: datetime, rows: List[OccupancyRollup] = ()):
+        """Start from the current counts, continuing buckets already stored for this period"""
+        for row in rows:
+            self.buckets[(row.resolution, row.room_name, row.bucket_start)] = [float(row.occupied_seconds), row.peak]
+        for room_name, count in counts.items():
+            self.rooms[room_name] = [count, now]
+            if count:
+                self._peak(room_name, count, now)
+
+    def record(self, room_name: str, count: int, at: datetime):
+        """A room's count changed at `at`"""
+        room = self.rooms.get(room_name)
+        if room is None:
+            room = self.rooms[room_name] = [0, at]
+        self._advance(room_name, room, at)
+        room[0] = count
+        if count:
+            self._peak(room_name, count, max(at, room[1]))
+
+    def collect(self, now: datetime) -> List[Dict]:
+        """Integrate every room up to now and return the rows changed since the last call"""
+        for room_name, room in self.rooms.items():
+            self._advance(room_name, room, now)
+            # Occupied rooms show up in every bucket they span
+            if room[0]:
+                self._peak(room_name, room[0], now)
+        rows = [
+            {
+                "resolution": resolution,
+                "room_name": room_name,
+                "bucket_start": start,
+                "occupied_seconds": round(self.buckets[(resolution, room_name, start)][0]),
+                "peak": self.buckets[(resolution, room_name, start)][1]
+            }
+            for resolution, room_name, start in self._dirty
+        ]
+        self._dirty.clear()
+        return rows
+
+    def written(self, now: datetime):
+        """Forget buckets that ended before now, once nothing about them is waiting to be written"""
+        ended = [
+            key for key in self.buckets
+            if key not in self._dirty and key[2] + timedelta(seconds=key[0]) <= now
+        ]
+        for key in ended:
+            del self.buckets[key]
+        # Empty rooms have nothing left to integrate
+        for room_name in [name for name, room in self.rooms.items() if not room[0]]:
+            del self.rooms[room_name]
+
+    def failed(self, rows: List[Dict]):
+        """Collect rows again next time"""
+        self._dirty.update((row["resolution"], row["room_name"], row["bucket_start"]) for row in rows)
+
+    def _advance(self, room_name: str, room: list, until: datetime):
+        count, since = room
+        if until <= since:
+            # Out of order (another worker's clock), count it from where we are
+            return
+        if count:
+            # Split at 5 minute boundaries, each piece belongs to one bucket per resolution
+            while since < until:
+                end = min(until, bucket_start(since, RESOLUTIONS[0]) + timedelta(seconds=RESOLUTIONS[0]))
+                seconds = (end - since).total_seconds() * count
+                for resolution in RESOLUTIONS:
+                    bucket = self._bucket((resolution, room_name, bucket_start(since, resolution)))
+                    bucket[0] += seconds
+                    bucket[1] = max(bucket[1], count)
+                since = end
+        room[1] = until
+
+    def _peak(self, room_name: str, count: int, at: datetime):
+        for resolution in RESOLUTIONS:
+            bucket = self._bucket((resolution, room_name, bucket_start(at, resolution)))
+            if count > bucket[1]:
+                bucket[1] = count
+
+    def _bucket(self, key: BucketKey) -> list:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [0.0, 0]
+        self._dirty.add(key)
+        return bucket
+
+class OccupancyRollups:
+    """
+    Keeps the occupancy_rollups table current: events feed a RollupAccumulator
+    and a background task writes the changed buckets every flush_interval
+    seconds with one upsert, then drops rows past their retention.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession],
+        clock: Callable[[], datetime],
+        flush_interval: float = 60.0,
+        retention_days: Dict[int, int] = None
+    ):
+        self.session_factory = session_factory
+        self.clock = clock
+        self.flush_interval = flush_interval
+        # resolution -> days kept; resolutions without an entry are kept forever
+        self.retention_days = retention_days or {}
+        self.accumulator = RollupAccumulator()
+        self.loaded = False
+        self.written_count = 0
+        self._task: Optional[asyncio.Task] = None
+        self._last_purge: Optional[datetime] = None
+
+    async def load(self, db: AsyncSession, room_counts: List[RoomCount]):
+        """Seed from the current room counts and the stored rows of the buckets now open"""
+        now = self.clock()
+        result = await db.execute(select(OccupancyRollup).filter(
+            tuple_(OccupancyRollup.resolution, OccupancyRollup.bucket_start).in_([
+                (resolution, bucket_start(now, resolution)) for resolution in RESOLUTIONS
+            ])
+        ))
+        self.accumulator.load(
+            {room.room_name: room.occupant_count for room in room_counts},
+            now,
+            result.scalars().all()
+        )
+        self.loaded = True
+
+    def apply(self, event: Dict):
+        """Record the room count carried by a broadcast event"""
+        if not self.loaded or "current_occupancy" not in event:
+            return
+        at = datetime.fromisoformat(event["timestamp"]).replace(tzinfo=None)
+        self.accumulator.record(event["room_name"], event["current_occupancy"], at)
+
+    def start(self):
+        if self.flush_interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer after writing what has been integrated so far"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.loaded:
+            await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        now = self.clock()
+        rows = self.accumulator.collect(now)
+        db = self.session_factory()
+        try:
+            if rows:
+                await db.execute(upsert_rollups(), rows)
+            # Downsampled data stays, the finer resolutions are trimmed once an hour
+            if self._last_purge is None or now - self._last_purge >= timedelta(hours=1):
+                for resolution, days in self.retention_days.items():
+                    await db.execute(delete(OccupancyRollup).filter(
+                        OccupancyRollup.resolution == resolution,
+                        OccupancyRollup.bucket_start < now - timedelta(days=days)
+                    ))
+                self._last_purge = now
+            await db.commit()
+            self.accumulator.written(now)
+            self.written_count += len(rows)
+        except Exception as e:
+            await db.rollback()
+            self.accumulator.failed(rows)
+            logger.error(f"Error writing {len(rows)} occupancy rollups: {e}")
+        finally:
+            await db.close()
+
+def upsert_rollups():
+    """Insert rollup rows, keeping the larger value when a bucket is already stored"""
+    statement = pg_insert(OccupancyRollup)
+    return statement.on_conflict_do_update(
+        index_elements=[OccupancyRollup.resolution, OccupancyRollup.room_name, OccupancyRollup.bucket_start],
+        set_={
+            "occupied_seconds": func.greatest(OccupancyRollup.occupied_seconds, statement.excluded.occupied_seconds),
+            "peak": func.greatest(OccupancyRollup.peak, statement.excluded.peak)
+        }
+    )
@@ -0,0 +1,64 @@
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from typing import Deque, Dict, List, Optional
+
+from app.models.occupancy import ActivityEvent
+
+def activity_item(event: ActivityEvent) -> Dict:
+    """A stored activity event as returned by GET /occupancy/activity/{room_name}"""
+    return {
+        "type": event.type,
+        "username": event.username,
+        "study_topic": event.study_topic,
+        "timestamp": event.timestamp.isoformat(),
+        "message": event.message
+    }
+
+class RoomActivity:
+    """
+    The last `size` check-in/check-out events of every room, newest first,
+    kept current from the same events that update the history snapshot so
+    opening a room panel needs no database access. Entries have the shape
+    of activity_item, with timestamps as stored in activity_events.
+    """
+
+    def __init__(self, size: int = 50):
+        self.size = size
+        self.rooms: Dict[str, Deque[Dict]] = {}
+        self.loaded = False
+
+    def load(self, events: List[ActivityEvent]):
+        """Fill the rings from stored events, newest first within each room"""
+        self.rooms = {}
+        for event in events:
+            ring = self._ring(event.room_name)
+            if len(ring) < self.size:
+                ring.append(activity_item(event))
+        self.loaded = True
+
+    def apply(self, event: Dict):
+        """Record a broadcast event"""
+        if not self.loaded or event.get("type") not in ("checkin", "checkout"):
+            return
+        self._ring(event["room_name"]).appendleft({
+            "type": event["type"],
+            "username": event.get("username"),
+            "study_topic": event.get("study_topic"),
+            # Broadcasts carry local time with its offset, the table stores it naive
+            "timestamp": datetime.fromisoformat(event["timestamp"]).replace(tzinfo=None).isoformat(),
+            "message": event.get("message")
+        })
+
+    def recent(self, room_name: str, limit: int) -> Optional[List[Dict]]:
+        """A room's newest `limit` events, or None if that is more than is retained"""
+        if not self.loaded or not 0 <= limit <= self.size:
+            return None
+        ring = self.rooms.get(room_name)
+        return list(islice(ring, limit)) if ring else []
+
+    def _ring(self, room_name: str) -> Deque[Dict]:
+        ring = self.rooms.get(room_name)
+        if ring is None:
+            ring = self.rooms[room_name] = deque(maxlen=self.size)
+        return ring
@@ -0,0 +1,63 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Published on the broadcast channel by room_program_data/db_room.py after it reloads the schedules
+ROOMS_RELOADED = "rooms_reloaded"
+
+class RoomDirectory:
+    """
+    Which building every room is in, from the rooms and buildings tables,
+    with the building's coordinates. Buildings are numbered so aggregating
+    counts by building is an indexed add per room. Rooms that are not in
+    the tables (or everything, before the first load) fall back to the
+    building prefix of their name.
+    """
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.coordinates: List[Tuple[float, float]] = []
+        self.index_by_room: Dict[str, int] = {}
+        self.index_by_name: Dict[str, int] = {}
+        # Bumped on every load so cached aggregates know to rebuild
+        self.version = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self, rows: Iterable[Tuple[str, str, float, float]]):
+        """Replace the directory from (room_name, building_name, latitude, longitude) rows"""
+        names, coordinates = [], []
+        index_by_room, index_by_name = {}, {}
+        for room_name, building_name, latitude, longitude in rows:
+            index = index_by_name.get(building_name)
+            if index is None:
+                index = index_by_name[building_name] = len(names)
+                names.append(building_name)
+                coordinates.append((float(latitude), float(longitude)))
+            index_by_room[room_name] = index
+        # Swapped in whole, so readers never see a half-built directory
+        self.names, self.coordinates = names, coordinates
+        self.index_by_room, self.index_by_name = index_by_room, index_by_name
+        self.version += 1
+
+    def building_for(self, room_name: str) -> str:
+        """Building a room belongs to (e.g. "ETLC 1-001" -> "ETLC")"""
+        index = self.index_by_room.get(room_name)
+        if index is not None:
+            return self.names[index]
+        return room_name.split()[0] if " " in room_name else room_name
+
+    def rooms_in(self, building_name: str) -> List[str]:
+        """Listed rooms of a building"""
+        index = self.index_by_name.get(building_name)
+        if index is None:
+            return []
+        return [room_name for room_name, room_index in self.index_by_room.items() if room_index == index]
+
+    def index_for(self, room_name: str) -> Optional[int]:
+        """Building index of a room, also for unlisted rooms whose name prefix is a listed building"""
+        index = self.index_by_room.get(room_name)
+        if index is None:
+            index = self.index_by_name.get(self.building_for(room_name))
+        return index
+
+room_directory = RoomDirectory()
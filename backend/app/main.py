@@ -17,10 +17,29 @@ from app.routes.occupancy import router as occupancy_router
 from app.routes.demographics import router as demographics_router
 from app.utils.response import success_response, error_response
 from app.models.user import User
-from app.core.database import get_db
+from app.core.database import get_db, async_engine
 from app.models.building import Room, RoomSchedule, SingleEventSchedule, UserFavoriteRoom
 from app.core.auth import conf
-from app.core.activity import websocket_endpoint, run_expiry_checker
+from app.core.principal_cache import principal_cache
+from app.core.forecast import forecaster
+from app.core.activity import (
+    websocket_endpoint,
+    start_expiry_engine,
+    stop_expiry_engine,
+    start_backplane,
+    stop_backplane,
+    load_history_snapshot,
+    load_room_directory,
+    start_event_log,
+    start_rollups,
+    stop_rollups,
+    stop_event_log,
+    start_presence_updates,
+    stop_presence_updates,
+    start_heartbeat,
+    stop_heartbeat,
+    manager as activity_manager
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -32,15 +51,47 @@ async def lifespan(app: FastAPI):
     # Start the regular scheduler for room availability check
     scheduler.add_job(scheduled_task, 'interval', seconds=300)
     
-    # Add the check-in expiry task to the scheduler
-    scheduler.add_job(run_expiry_checker, 'interval', seconds=60)
-    
     # REQ-7: Clean old activity data (run once per hour)
     scheduler.add_job(clean_old_activity_data, 'interval', seconds=3600)
     
     scheduler.start()
     logger.info("Scheduler started.")
+
+    # Share websocket events with the other workers
+    await start_backplane()
+
+    # Room to building map with coordinates, for building topics and occupancy
+    await load_room_directory()
+
+    # Serve websocket history from memory
+    await load_history_snapshot()
+
+    # Bulk writer for the activity_events log
+    start_event_log()
+
+    # Occupancy history, downsampled from live counts
+    start_rollups()
+
+    # Weekday x hour forecast, refitted from that history in a separate process
+    forecaster.start()
+
+    # Single heap-driven expiry engine for all active check-ins
+    await start_expiry_engine()
+
+    # Aggregated presence counts instead of per-socket join/leave broadcasts
+    start_presence_updates()
+
+    # Ping quiet websocket clients and reap the ones that stopped answering
+    start_heartbeat()
     yield
+    await forecaster.stop()
+    await stop_heartbeat()
+    await stop_presence_updates()
+    await stop_expiry_engine()
+    await stop_rollups()
+    await stop_event_log()
+    await stop_backplane()
+    await async_engine.dispose()
     scheduler.shutdown()
     logger.info("Scheduler stopped.")
 
@@ -81,6 +132,14 @@ async def private_health_check(
         return error_response(401, False, "Unauthorized. Please log in.")
     return success_response(200, True, "Private health check.")
 
+@app.get("/metrics", tags=["health"])
+async def metrics(current_user: User = Depends(get_active_user)):
+    """Runtime counters for this worker"""
+    return success_response(200, True, "Metrics retrieved successfully", data={
+        "principal_cache": principal_cache.stats(),
+        "websocket": activity_manager.stats()
+    })
+
 async def send_email(subject: str, email_to: str, body: str):
     """
     4.6 Notifications
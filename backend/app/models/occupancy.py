@@ -1,6 +1,6 @@
 import uuid
 from datetime import datetime
-from sqlalchemy import Column, String, UUID, Integer, DateTime, Boolean, Text
+from sqlalchemy import Column, String, UUID, Integer, SmallInteger, DateTime, Boolean, Text, Index
 
 from app.core.database import Base
 
@@ -45,4 +45,21 @@ class ActivityEvent(Base):
     study_topic = Column(String, nullable=True)
     timestamp = Column(DateTime, nullable=False, default=datetime.now, index=True)
     expiry_time = Column(DateTime, nullable=True)
-    message = Column(Text, nullable=False)
\ No newline at end of file
+    message = Column(Text, nullable=False)
+
+class OccupancyRollup(Base):
+    """
+    Occupancy of a room over one time bucket of 5 minutes, 1 hour or 1 day,
+    kept after the check-ins and activity events behind it are gone
+    """
+    __tablename__ = "occupancy_rollups"
+
+    resolution = Column(SmallInteger, primary_key=True)  # Bucket length in seconds
+    room_name = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    occupied_seconds = Column(Integer, nullable=False, default=0)  # Occupants x seconds, average = occupied_seconds / resolution
+    peak = Column(SmallInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("idx_occupancy_rollups_bucket", "resolution", "bucket_start"),
+    )
@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select
 from datetime import datetime
 import pytz
 
-from app.core.database import get_db
+from app.core.database import get_async_db
 from app.models.occupancy import RoomOccupancy
 from app.models.user import User, Program
 from app.utils.response import success_response, error_response
@@ -21,7 +21,7 @@ def get_edmonton_time():
 @router.get("/{room_name}/demographics")
 async def get_room_demographics(
     room_name: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get program demographics for users checked into a specific room
@@ -30,11 +30,12 @@ async def get_room_demographics(
         now = get_edmonton_time()
         
         # Query active check-ins for this room
-        active_checkins = db.query(RoomOccupancy).filter(
+        result = await db.execute(select(RoomOccupancy).filter(
             RoomOccupancy.room_name == room_name,
             RoomOccupancy.is_active == True,
             RoomOccupancy.expiry_time > now.replace(tzinfo=None)
-        ).all()
+        ))
+        active_checkins = result.scalars().all()
         
         if not active_checkins:
             return success_response(
@@ -48,7 +49,7 @@ async def get_room_demographics(
         user_ids = [checkin.user_id for checkin in active_checkins]
         
         # Query users along with their program information
-        user_programs = db.query(
+        result = await db.execute(select(
             User.id,
             Program.name.label("program_name")
         ).join(
@@ -57,7 +58,8 @@ async def get_room_demographics(
             isouter=True  # Left outer join to include users without programs
         ).filter(
             User.id.in_(user_ids)
-        ).all()
+        ))
+        user_programs = result.all()
         
         # Create a mapping of program names to counts
         program_counts = {}
@@ -1,18 +1,53 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, Request, Response
+from sqlalchemy import cast, distinct, func, select
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta
 
-from app.core.database import get_db
-from app.models.occupancy import RoomOccupancy, RoomCount, ActivityEvent
+from app.core.database import get_async_db
+from app.core.activity import manager as activity_manager, get_edmonton_time, EDMONTON_TZ
+from app.core.room_activity import activity_item
+from app.core.occupancy_snapshot import CachedResponse, OccupancySnapshot
+from app.core.room_directory import room_directory
+from app.core.rollups import RESOLUTION_NAMES, bucket_start
+from app.core.forecast import forecaster
+from app.models.occupancy import RoomOccupancy, RoomCount, ActivityEvent, OccupancyRollup
 from app.utils.response import success_response, error_response
 from app.core.auth import get_active_user
-from app.models.user import User
+from app.models.user import User, Program
+from app.schemas.occupancy import RoomDetailsRequest
 
 router = APIRouter()
 
+# Range returned by /occupancy/history when no start is given, per resolution
+HISTORY_DEFAULT_SPAN = {"5m": timedelta(days=1), "1h": timedelta(days=7), "1d": timedelta(days=90)}
+# Most buckets per room one history request may cover (a week of 5 minute buckets)
+HISTORY_MAX_BUCKETS = 2016
+# Most rooms one /occupancy/rooms/details request may ask for
+ROOM_DETAILS_MAX_ROOMS = 200
+
+def cached_response(request: Request, cached: CachedResponse) -> Response:
+    """Send a materialized response, or 304 if the client already has it"""
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+    if cached.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+async def occupancy_snapshot(db: AsyncSession) -> OccupancySnapshot:
+    """The live room counts, or a one-off snapshot from room_counts if they were never loaded"""
+    snapshot = activity_manager.occupancy
+    if snapshot.loaded:
+        return snapshot
+    result = await db.execute(select(RoomCount).filter(
+        RoomCount.occupant_count > 0
+    ))
+    return snapshot.loaded_from(result.scalars().all())
+
 @router.get("/occupancy/rooms", tags=["occupancy"])
 async def get_all_occupied_rooms(
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_active_user)
 ):
     """
@@ -20,27 +55,8 @@ async def get_all_occupied_rooms(
     along with the count of occupants in each room
     """
     try:
-        # Get room counts directly from the room_counts table
-        room_counts = db.query(RoomCount).filter(
-            RoomCount.occupant_count > 0
-        ).all()
-        
-        # Convert to a list of dictionaries
-        result = [
-            {
-                "room_name": room.room_name,
-                "occupant_count": room.occupant_count,
-                "last_updated": room.last_updated.isoformat()
-            }
-            for room in room_counts
-        ]
-        
-        return success_response(
-            status_codes=200,
-            status=True,
-            message="Room occupancy data retrieved successfully",
-            data=result
-        )
+        snapshot = await occupancy_snapshot(db)
+        return cached_response(request, snapshot.rooms_response())
     except Exception as e:
         return error_response(
             status_codes=500,
@@ -50,54 +66,21 @@ async def get_all_occupied_rooms(
 
 @router.get("/occupancy/buildings", tags=["occupancy"])
 async def get_building_occupancy(
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_active_user)
 ):
     """
     Get occupancy counts for buildings by aggregating room data.
-    Since room names typically include building names (e.g., "ETLC 1-001"),
-    we extract the building prefix and aggregate by it.
+    Rooms are grouped through the room directory (the rooms and buildings
+    tables), which also gives each building its coordinates. Rooms missing
+    from the directory are grouped by the building prefix of their name
+    (e.g. "ETLC 1-001" -> "ETLC"), with null coordinates unless that
+    prefix is a listed building.
     """
     try:
-        # Get all rooms with occupants
-        rooms_with_occupants = db.query(RoomCount).filter(
-            RoomCount.occupant_count > 0
-        ).all()
-        
-        # Group by building (first part of room name)
-        building_counts = {}
-        for room in rooms_with_occupants:
-            # Extract building name from room name (assuming format like "ETLC 1-001")
-            # This is a simple implementation - adjust based on your actual room naming convention
-            building_name = room.room_name.split()[0] if ' ' in room.room_name else room.room_name
-            
-            if building_name not in building_counts:
-                building_counts[building_name] = {
-                    'count': 0,
-                    'last_updated': room.last_updated
-                }
-            
-            building_counts[building_name]['count'] += room.occupant_count
-            # Use the most recent update time
-            if room.last_updated > building_counts[building_name]['last_updated']:
-                building_counts[building_name]['last_updated'] = room.last_updated
-            
-        # Convert to a list of dictionaries
-        result = [
-            {
-                "building_name": building_name,
-                "occupant_count": data['count'],
-                "last_updated": data['last_updated'].isoformat()
-            }
-            for building_name, data in building_counts.items()
-        ]
-        
-        return success_response(
-            status_codes=200,
-            status=True,
-            message="Building occupancy data retrieved successfully",
-            data=result
-        )
+        snapshot = await occupancy_snapshot(db)
+        return cached_response(request, snapshot.buildings_response())
     except Exception as e:
         return error_response(
             status_codes=500,
@@ -108,7 +91,7 @@ async def get_building_occupancy(
 @router.get("/occupancy/room/{room_name}", tags=["occupancy"])
 async def get_room_occupancy(
     room_name: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_active_user)
 ):
     """
@@ -119,19 +102,21 @@ async def get_room_occupancy(
         now = datetime.now()
         
         # Get room count from room_counts table
-        room_count = db.query(RoomCount).filter(
+        result = await db.execute(select(RoomCount).filter(
             RoomCount.room_name == room_name
-        ).first()
+        ))
+        room_count = result.scalars().first()
         
         occupant_count = room_count.occupant_count if room_count else 0
         last_updated = room_count.last_updated.isoformat() if room_count else None
         
         # Get active check-ins for the specified room
-        active_checkins = db.query(RoomOccupancy).filter(
+        result = await db.execute(select(RoomOccupancy).filter(
             RoomOccupancy.room_name == room_name,
             RoomOccupancy.is_active == True,
             RoomOccupancy.expiry_time > now
-        ).all()
+        ))
+        active_checkins = result.scalars().all()
         
         # Get occupant details
         occupants = [
@@ -165,35 +150,134 @@ async def get_room_occupancy(
             message=f"Error retrieving room occupancy: {str(e)}"
         )
 
+@router.post("/occupancy/rooms/details", tags=["occupancy"])
+async def get_room_details(
+    body: RoomDetailsRequest,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_active_user)
+):
+    """
+    Count, occupants and program demographics of many rooms at once, either
+    the rooms listed or every room of a building. Three queries whatever the
+    number of rooms.
+    """
+    if body.building is not None:
+        room_names = room_directory.rooms_in(body.building)
+        if not room_names:
+            return error_response(
+                status_codes=404,
+                status=False,
+                message=f"Unknown building: {body.building}"
+            )
+    elif body.rooms:
+        room_names = list(dict.fromkeys(body.rooms))
+    else:
+        return error_response(
+            status_codes=400,
+            status=False,
+            message="Either rooms or building is required"
+        )
+    if len(room_names) > ROOM_DETAILS_MAX_ROOMS:
+        return error_response(
+            status_codes=400,
+            status=False,
+            message=f"At most {ROOM_DETAILS_MAX_ROOMS} rooms per request"
+        )
+
+    try:
+        now = get_edmonton_time().replace(tzinfo=None)
+        details = {
+            room_name: {
+                "room_name": room_name,
+                "occupant_count": 0,
+                "last_updated": None,
+                "occupants": [],
+                "demographics": {}
+            }
+            for room_name in room_names
+        }
+
+        result = await db.execute(select(RoomCount).filter(
+            RoomCount.room_name.in_(room_names)
+        ))
+        for room_count in result.scalars().all():
+            room = details[room_count.room_name]
+            room["occupant_count"] = room_count.occupant_count
+            room["last_updated"] = room_count.last_updated.isoformat()
+
+        result = await db.execute(select(RoomOccupancy).filter(
+            RoomOccupancy.room_name.in_(room_names),
+            RoomOccupancy.is_active == True,
+            RoomOccupancy.expiry_time > now
+        ))
+        for checkin in result.scalars().all():
+            details[checkin.room_name]["occupants"].append({
+                "user_id": checkin.user_id,
+                "username": checkin.username,
+                "study_topic": checkin.study_topic,
+                "checkin_time": checkin.checkin_time.isoformat(),
+                "expiry_time": checkin.expiry_time.isoformat()
+            })
+
+        result = await db.execute(select(
+            RoomOccupancy.room_name,
+            Program.name,
+            func.count(distinct(RoomOccupancy.user_id))
+        ).join(
+            # Check-ins keep the user id as a string; cast that side so the users primary key is used
+            User, User.id == cast(RoomOccupancy.user_id, UUID)
+        ).join(
+            Program,
+            User.program_id == Program.id,
+            isouter=True
+        ).filter(
+            RoomOccupancy.room_name.in_(room_names),
+            RoomOccupancy.is_active == True,
+            RoomOccupancy.expiry_time > now
+        ).group_by(
+            RoomOccupancy.room_name,
+            Program.name
+        ))
+        for room_name, program_name, count in result.all():
+            # Users without a program are counted as "Undeclared"
+            demographics = details[room_name]["demographics"]
+            program_name = program_name or "Undeclared"
+            demographics[program_name] = demographics.get(program_name, 0) + count
+
+        return success_response(
+            status_codes=200,
+            status=True,
+            message="Room details retrieved successfully",
+            data=list(details.values())
+        )
+    except Exception as e:
+        return error_response(
+            status_codes=500,
+            status=False,
+            message=f"Error retrieving room details: {str(e)}"
+        )
+
 @router.get("/occupancy/activity/{room_name}", tags=["occupancy"])
 async def get_room_activity(
     room_name: str,
     limit: int = 20,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_active_user)
 ):
     """
-    Get recent activity events for a specific room
+    Get recent activity events for a specific room, from memory unless
+    more are asked for than are kept per room
     """
     try:
-        # Get activity events for the specified room
-        events = db.query(ActivityEvent).filter(
-            ActivityEvent.room_name == room_name
-        ).order_by(
-            ActivityEvent.timestamp.desc()
-        ).limit(limit).all()
-        
-        # Convert to a list of dictionaries
-        result = [
-            {
-                "type": event.type,
-                "username": event.username,
-                "study_topic": event.study_topic,
-                "timestamp": event.timestamp.isoformat(),
-                "message": event.message
-            }
-            for event in events
-        ]
+        result = activity_manager.room_activity.recent(room_name, limit)
+        if result is None:
+            # Get activity events for the specified room
+            events = await db.execute(select(ActivityEvent).filter(
+                ActivityEvent.room_name == room_name
+            ).order_by(
+                ActivityEvent.timestamp.desc()
+            ).limit(limit))
+            result = [activity_item(event) for event in events.scalars().all()]
         
         return success_response(
             status_codes=200,
@@ -206,4 +290,133 @@ async def get_room_activity(
             status_codes=500,
             status=False,
             message=f"Error retrieving room activity: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+def local_time(moment: datetime) -> datetime:
+    """A query parameter as naive Edmonton time, like the stored timestamps"""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(EDMONTON_TZ)
+    return moment.replace(tzinfo=None)
+
+@router.get("/occupancy/history", tags=["occupancy"])
+async def get_occupancy_history(
+    resolution: str = "1h",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    room: Optional[str] = None,
+    building: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_active_user)
+):
+    """
+    Get occupancy history for heatmaps: per room, the average and peak number
+    of occupants in each 5 minute ("5m"), hourly ("1h") or daily ("1d")
+    bucket from start to end, for one room, one building or the whole campus
+    """
+    seconds = RESOLUTION_NAMES.get(resolution)
+    if seconds is None:
+        return error_response(
+            status_codes=400,
+            status=False,
+            message=f"Resolution must be one of {', '.join(RESOLUTION_NAMES)}"
+        )
+    end = local_time(end) if end else get_edmonton_time().replace(tzinfo=None)
+    start = local_time(start) if start else end - HISTORY_DEFAULT_SPAN[resolution]
+    if start >= end or (end - start).total_seconds() / seconds > HISTORY_MAX_BUCKETS:
+        return error_response(
+            status_codes=400,
+            status=False,
+            message=f"Range must be positive and span at most {HISTORY_MAX_BUCKETS} buckets"
+        )
+
+    try:
+        # One range scan: the primary key for a room, (resolution, bucket_start) otherwise
+        query = select(OccupancyRollup).filter(
+            OccupancyRollup.resolution == seconds,
+            OccupancyRollup.bucket_start >= bucket_start(start, seconds),
+            OccupancyRollup.bucket_start < end
+        )
+        if room:
+            query = query.filter(OccupancyRollup.room_name == room)
+        elif building:
+            rooms = room_directory.rooms_in(building)
+            if rooms:
+                query = query.filter(OccupancyRollup.room_name.in_(rooms))
+            else:
+                query = query.filter(OccupancyRollup.room_name.startswith(f"{building} ", autoescape=True))
+        result = await db.execute(query.order_by(OccupancyRollup.bucket_start))
+
+        # room_name -> [[bucket_start, average, peak], ...], oldest first
+        series = {}
+        for row in result.scalars().all():
+            series.setdefault(row.room_name, []).append([
+                row.bucket_start.isoformat(),
+                round(row.occupied_seconds / seconds, 2),
+                row.peak
+            ])
+
+        return success_response(
+            status_codes=200,
+            status=True,
+            message="Occupancy history retrieved successfully",
+            data={
+                "resolution": resolution,
+                "start": start.isoformat(),
+                "end": end.isoformat(),
+                "rooms": series
+            }
+        )
+    except Exception as e:
+        return error_response(
+            status_codes=500,
+            status=False,
+            message=f"Error retrieving occupancy history: {str(e)}"
+        )
+
+@router.get("/occupancy/forecast", tags=["occupancy"])
+async def get_occupancy_forecast(
+    building: Optional[str] = None,
+    room: Optional[str] = None,
+    at: Optional[datetime] = None,
+    current_user: User = Depends(get_active_user)
+):
+    """
+    Get the expected number of occupants of a building (or a room) at a
+    given time, from weekday x hour profiles of the occupancy history
+    """
+    if not building and not room:
+        return error_response(
+            status_codes=400,
+            status=False,
+            message="A building or a room is required"
+        )
+    matrix = forecaster.matrix
+    if matrix is None:
+        return error_response(
+            status_codes=503,
+            status=False,
+            message="Forecast is not available yet"
+        )
+
+    at = local_time(at) if at else get_edmonton_time().replace(tzinfo=None)
+    expected = matrix.room(room, at) if room else matrix.building(building, at)
+    if expected is None:
+        return error_response(
+            status_codes=404,
+            status=False,
+            message=f"No forecast for {room or building}"
+        )
+
+    return success_response(
+        status_codes=200,
+        status=True,
+        message="Occupancy forecast retrieved successfully",
+        data={
+            "building": None if room else building,
+            "room": room,
+            "at": at.isoformat(),
+            "slot_start": at.replace(minute=0, second=0, microsecond=0).isoformat(),
+            "expected_occupancy": round(expected, 2),
+            "fitted_at": matrix.fitted_at.isoformat()
+        }
+    )
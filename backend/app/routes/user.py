@@ -8,6 +8,7 @@ from app.core.database import get_db
 from app.utils.query import filter_query
 from app.utils.response import success_response, error_response
 from app.core.auth import get_active_user
+from app.core.principal_cache import principal_cache
 from app.models.user import User, Program
 from app.models.building import Room, UserFavoriteRoom
 from app.schemas.user import UserUpdate, LocationData
@@ -94,6 +95,7 @@ def update_user(
 
         db.query(User).filter(User.id == current_user.id).update(update_data, synchronize_session=False)
         db.commit()
+        principal_cache.invalidate(current_user.email)
         return success_response(200, True, "User updated successfully")
     except Exception as e:
         return error_response(500, False, str(e))
@@ -117,6 +119,7 @@ def delete_user(
     try:
         db.query(User).filter(User.id == user_id).delete()
         db.commit()
+        principal_cache.invalidate(current_user.email)
         return success_response(200, True, "User deleted")
     except Exception as e:
         return error_response(500, False, str(e))
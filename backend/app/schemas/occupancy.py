@@ -0,0 +1,6 @@
+from typing import List, Optional
+from pydantic import BaseModel
+
+class RoomDetailsRequest(BaseModel):
+    rooms: Optional[List[str]] = None
+    building: Optional[str] = None
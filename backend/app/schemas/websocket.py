@@ -0,0 +1,36 @@
+from typing import Annotated, List, Literal, Optional, Union
+from pydantic import BaseModel, Field, TypeAdapter
+
+class CheckinMessage(BaseModel):
+    type: Literal["checkin"] = "checkin"
+    # Client-chosen command ID; a repeated ID is ignored
+    id: Optional[str] = Field(default=None, max_length=64)
+    room_name: str
+    username: Optional[str] = None
+    study_topic: Optional[str] = None
+
+class CheckoutMessage(BaseModel):
+    type: Literal["checkout"] = "checkout"
+    id: Optional[str] = Field(default=None, max_length=64)
+    room_name: Optional[str] = None
+    auto: bool = False
+
+class SubscriptionMessage(BaseModel):
+    type: Literal["subscribe", "unsubscribe"]
+    buildings: List[str] = []
+    rooms: List[str] = []
+    campus: Optional[bool] = None
+    presence: bool = False
+
+class SetUsernameMessage(BaseModel):
+    type: Literal["setUsername"] = "setUsername"
+    username: str
+
+# Every message a client may send over /ws, selected by its "type" field
+InboundMessage = Annotated[
+    Union[CheckinMessage, CheckoutMessage, SubscriptionMessage, SetUsernameMessage],
+    Field(discriminator="type")
+]
+
+# Compiled once; validate_json parses and validates raw frames in a single pass
+inbound_message = TypeAdapter(InboundMessage)
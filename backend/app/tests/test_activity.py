@@ -3,16 +3,19 @@ import json
 from datetime import datetime, timedelta, timezone
 import pytz
 import uuid
+import msgpack
 import pytest
 
 from fastapi import WebSocket, WebSocketDisconnect
 from jose import jwt
+from sqlalchemy.dialects import postgresql
 
 # Import the module under test and models
 from app.core import activity
 from app.models.occupancy import RoomOccupancy, RoomCount, ActivityEvent
 from app.models.user import User
 from app.core.config import settings
+from app.schemas.websocket import CheckinMessage, CheckoutMessage, SubscriptionMessage
 
 
 # -------------------------------------------------------------------
@@ -20,18 +23,36 @@ from app.core.config import settings
 # -------------------------------------------------------------------
 
 class FakeWebSocket:
-    def __init__(self, headers=None):
+    def __init__(self, headers=None, query_params=None, subprotocols=None):
         self.sent_messages = []
         self.headers = headers or {}
+        self.query_params = query_params or {}
+        self.scope = {"subprotocols": subprotocols or []}
+        self.accepted_subprotocol = None
         self._recv_messages = []
         self.closed = False
 
-    async def accept(self):
+    async def accept(self, subprotocol=None):
+        self.accepted_subprotocol = subprotocol
         self.sent_messages.append("accepted")
 
     async def send_json(self, message):
         self.sent_messages.append(message)
 
+    async def send_text(self, message):
+        self.sent_messages.append(json.loads(message))
+
+    async def send_bytes(self, message):
+        self.sent_messages.append(msgpack.unpackb(message))
+
+    async def receive(self):
+        if self._recv_messages:
+            message = self._recv_messages.pop(0)
+            if isinstance(message, bytes):
+                return {"type": "websocket.receive", "bytes": message}
+            return {"type": "websocket.receive", "text": message}
+        return {"type": "websocket.disconnect", "code": 1000}
+
     async def receive_text(self):
         if self._recv_messages:
             return self._recv_messages.pop(0)
@@ -46,16 +67,11 @@ class FakeWebSocket:
 
 
 class FakeQuery:
+    """Result of a select on one model, whatever its filters"""
     def __init__(self, items):
         self.items = items
 
-    def filter(self, *args, **kwargs):
-        return self
-
-    def delete(self, synchronize_session=False):
-        return 1
-
-    def order_by(self, *args, **kwargs):
+    def scalars(self):
         return self
 
     def all(self):
@@ -64,6 +80,9 @@ class FakeQuery:
     def first(self):
         return self.items[0] if self.items else None
 
+    def scalar_one(self):
+        return self.items[0]
+
 
 class FakeDB:
     def __init__(self):
@@ -71,21 +90,29 @@ class FakeDB:
         self.rolled_back = False
         self.added = []
         self.queries = {}
-
-    def query(self, model):
-        # Return a FakeQuery based on preset behavior for the model.
+        self.room_counts = {}
+
+    async def execute(self, statement):
+        if statement.is_insert:
+            # Stands in for the room_counts upsert: apply the delta, clamped at zero
+            params = statement.compile(dialect=postgresql.dialect()).params
+            count = max(self.room_counts.get(params["room_name"], 0) + params["delta"], 0)
+            self.room_counts[params["room_name"]] = count
+            return FakeQuery([count])
+        # Return a FakeQuery based on preset behavior for the selected model.
+        model = statement.column_descriptions[0]["entity"]
         return self.queries.get(model, FakeQuery([]))
 
     def add(self, item):
         self.added.append(item)
 
-    def commit(self):
+    async def commit(self):
         self.committed = True
 
-    def rollback(self):
+    async def rollback(self):
         self.rolled_back = True
 
-    def close(self):
+    async def close(self):
         pass
 
 
@@ -95,6 +122,17 @@ def manager():
     return activity.ConnectionManager()
 
 
+async def flush(manager):
+    """Wait until every client's outbound queue has been written"""
+    while True:
+        for connection in list(manager.connections):
+            await connection.queue.join()
+        # Writers may have queued follow-up events (e.g. evictions) meanwhile.
+        await asyncio.sleep(0)
+        if not any(connection.queue._unfinished_tasks for connection in manager.connections):
+            return
+
+
 # -------------------------------------------------------------------
 # Tests for synchronous helper functions
 # -------------------------------------------------------------------
@@ -107,51 +145,8 @@ def test_get_edmonton_time():
     assert "MST" in etime.tzname() or "MDT" in etime.tzname()
 
 
-def test_clean_old_events_removes_old_events(monkeypatch, manager):
-    from app.core.activity import EDMONTON_TZ  # use the same timezone used in the module
-
-    # Fix "now" to a controlled datetime.
-    fixed_now = datetime(2025, 4, 10, 0, 0, 0, tzinfo=EDMONTON_TZ)
-    monkeypatch.setattr(activity, "get_edmonton_time", lambda: fixed_now)
-    
-    # Now create an "old" event (25 hours ago) and a "recent" event (1 hour ago).
-    old_time = (fixed_now - timedelta(hours=25)).isoformat()
-    recent_time = (fixed_now - timedelta(hours=1)).isoformat()
-    
-    manager.activity_feed = [
-        {"timestamp": old_time, "type": "connection", "user_id": "1"},
-        {"timestamp": recent_time, "type": "connection", "user_id": "2"},
-    ]
-    
-    # Create a fake DB that commits properly.
-    fake_db = FakeDB()
-    fake_db.queries[ActivityEvent] = FakeQuery([])
-    monkeypatch.setattr(manager, "_get_db", lambda: fake_db)
-    
-    # When _clean_old_events() is invoked, the cutoff will be fixed.
-    manager._clean_old_events()
-    
-    # The old event (older than 24 hours) should be removed.
-    assert len(manager.activity_feed) == 1
-    assert manager.activity_feed[0]["user_id"] == "2"
-
-
-def test_clean_old_events_exception(monkeypatch, manager):
-    manager.activity_feed = []
-    fake_db = FakeDB()
-
-    # Make fake_db.query raise an exception.
-    def fake_query(model):
-        raise Exception("Test exception")
-    fake_db.query = fake_query
-    monkeypatch.setattr(manager, "_get_db", lambda: fake_db)
-
-    # _clean_old_events should handle the exception (and call rollback).
-    manager._clean_old_events()
-    assert fake_db.rolled_back is True
-
-
-def test_get_activity_feed(monkeypatch, manager):
+@pytest.mark.asyncio
+async def test_get_activity_feed(monkeypatch, manager):
     now = activity.get_edmonton_time()
     event_time = now - timedelta(hours=1)
     fake_event = ActivityEvent(
@@ -168,22 +163,16 @@ def test_get_activity_feed(monkeypatch, manager):
     fake_db.queries[ActivityEvent] = FakeQuery([fake_event])
     monkeypatch.setattr(manager, "_get_db", lambda: fake_db)
 
-    # Also add an in‑memory event.
-    in_memory_event = {
-        "type": "connection",
-        "user_id": "456",
-        "username": "connUser",
-        "timestamp": now.isoformat(),
-        "message": "User connected",
-    }
-    manager.activity_feed.append(in_memory_event)
-    feed = manager._get_activity_feed(fake_db, limit=10)
-    # Expect both events (sorted with newest first)
-    assert len(feed) == 2
-    assert feed[0]["user_id"] == "456"
-
-
-def test_get_current_checkins(monkeypatch, manager):
+    feed = await manager._get_activity_feed(fake_db, limit=10)
+    # Connectivity events are no longer part of the feed
+    assert len(feed) == 1
+    assert feed[0]["user_id"] == "123"
+    # Stored local times keep their wall-clock value and offset
+    assert feed[0]["timestamp"] == event_time.isoformat()
+
+
+@pytest.mark.asyncio
+async def test_get_current_checkins(monkeypatch, manager):
     now = activity.get_edmonton_time()
     fake_checkin = RoomOccupancy(
         user_id="789",
@@ -196,54 +185,52 @@ def test_get_current_checkins(monkeypatch, manager):
     )
     fake_db = FakeDB()
     fake_db.queries[RoomOccupancy] = FakeQuery([fake_checkin])
-    checkins = manager._get_current_checkins(fake_db)
+    checkins = await manager._get_current_checkins(fake_db)
     assert len(checkins) == 1
     assert checkins[0]["user_id"] == "789"
 
 
-def test_increment_room_count(monkeypatch, manager):
-    now = activity.get_edmonton_time()
+@pytest.mark.asyncio
+async def test_update_room_count(manager):
     fake_db = FakeDB()
     # No existing record: count should become 1.
-    fake_db.queries[RoomCount] = FakeQuery([])
-    count = manager._increment_room_count(fake_db, "TestRoom")
-    assert count == 1
-
-    # Existing record with count=2: should update to 3.
-    room_obj = RoomCount(room_name="TestRoom", occupant_count=2, last_updated=now)
-    fake_db.queries[RoomCount] = FakeQuery([room_obj])
-    count = manager._increment_room_count(fake_db, "TestRoom")
-    assert count == 3
+    assert await manager._update_room_count(fake_db, "TestRoom", 1) == 1
+    assert await manager._update_room_count(fake_db, "TestRoom", 1) == 2
+    assert await manager._update_room_count(fake_db, "TestRoom", -1) == 1
 
 
-def test_decrement_room_count(monkeypatch, manager):
-    now = activity.get_edmonton_time()
+@pytest.mark.asyncio
+async def test_update_room_count_clamps_at_zero(manager):
     fake_db = FakeDB()
+    fake_db.room_counts["TestRoom"] = 0
+    assert await manager._update_room_count(fake_db, "TestRoom", -1) == 0
+    # When no record exists, the row is created with 0.
+    assert await manager._update_room_count(fake_db, "AnotherRoom", -1) == 0
 
-    # Existing record with count=1 should decrement to 0.
-    room_obj = RoomCount(room_name="TestRoom", occupant_count=1, last_updated=now)
-    fake_db.queries[RoomCount] = FakeQuery([room_obj])
-    count = manager._decrement_room_count(fake_db, "TestRoom")
-    assert count == 0
 
-    # Existing record with count already 0 remains 0.
-    room_obj = RoomCount(room_name="TestRoom", occupant_count=0, last_updated=now)
-    fake_db.queries[RoomCount] = FakeQuery([room_obj])
-    count = manager._decrement_room_count(fake_db, "TestRoom")
-    assert count == 0
+@pytest.mark.asyncio
+async def test_update_room_count_is_single_upsert(manager):
+    statements = []
+    class RecordingDB(FakeDB):
+        async def execute(self, statement):
+            statements.append(str(statement.compile(dialect=postgresql.dialect())))
+            return await super().execute(statement)
 
-    # When no record exists, should create one and return 0.
-    fake_db.queries[RoomCount] = FakeQuery([])
-    count = manager._decrement_room_count(fake_db, "AnotherRoom")
-    assert count == 0
+    await manager._update_room_count(RecordingDB(), "TestRoom", -1)
+    assert len(statements) == 1
+    sql = statements[0]
+    assert "ON CONFLICT (room_name) DO UPDATE" in sql
+    assert "greatest(room_counts.occupant_count + %(delta)s" in sql
+    assert "RETURNING room_counts.occupant_count" in sql
 
 
-def test_get_all_room_occupancy(monkeypatch, manager):
+@pytest.mark.asyncio
+async def test_get_all_room_occupancy(monkeypatch, manager):
     room1 = RoomCount(room_name="Room1", occupant_count=2, last_updated=datetime.now())
     room2 = RoomCount(room_name="Room2", occupant_count=3, last_updated=datetime.now())
     fake_db = FakeDB()
     fake_db.queries[RoomCount] = FakeQuery([room1, room2])
-    occupancy = manager._get_all_room_occupancy(fake_db)
+    occupancy = await manager._get_all_room_occupancy(fake_db)
     assert occupancy == {"Room1": 2, "Room2": 3}
 
 
@@ -267,6 +254,7 @@ async def test_connect(monkeypatch, manager):
     monkeypatch.setattr(manager, "broadcast", fake_broadcast)
 
     await manager.connect(ws, username="testuser", user_id="user123")
+    await flush(manager)
     # Check that WebSocket.accept() was called.
     assert ws.sent_messages[0] == "accepted"
     # One of the sent messages should be the history message.
@@ -276,16 +264,165 @@ async def test_connect(monkeypatch, manager):
     assert any(msg.get("type") == "connection" for msg in broadcasted)
 
 
-def test_disconnect(manager):
+@pytest.mark.asyncio
+async def test_connect_uses_history_snapshot_without_db(monkeypatch, manager):
+    manager.history.load(
+        [{"type": "checkin", "user_id": "u1", "message": "hi"}],
+        [{"user_id": "u1", "room_name": "RoomA"}],
+        {"RoomA": 1}
+    )
+    def fail_get_db():
+        raise AssertionError("connect should not hit the database")
+    monkeypatch.setattr(manager, "_get_db", fail_get_db)
+
     ws = FakeWebSocket()
-    manager.active_connections.append(ws)
-    manager.user_ids[ws] = "user123"
-    manager.usernames[ws] = "testuser"
+    await manager.connect(ws, username="testuser", user_id="user123")
+    await flush(manager)
+
+    history = [msg for msg in ws.sent_messages if isinstance(msg, dict) and msg.get("type") == "history"]
+    assert len(history) == 1
+    assert history[0]["user_id"] == "user123"
+    assert history[0]["username"] == "testuser"
+    assert history[0]["occupancy_data"] == {"RoomA": 1}
+    assert history[0]["stream"] == manager.stream_id
+    assert history[0]["feed"][0]["user_id"] == "u1"
+    # Followed by the current presence counts, not the client's own join event.
+    assert ws.sent_messages[-1] == {"type": "presence", "campus": 0, "buildings": {}}
+    # The join event is neither sequenced nor retained for replay
+    assert manager.seq == history[0]["seq"]
+    assert not manager.replay_window
+
+
+@pytest.mark.asyncio
+async def test_every_event_gets_a_sequence_number(manager):
+    ws = FakeWebSocket()
+    manager._register(ws)
+    await manager.broadcast({"type": "checkout", "user_id": "u1", "room_name": "RoomA"})
+    await manager.broadcast({"type": "checkout", "user_id": "u2", "room_name": "RoomA"})
+    await flush(manager)
+    assert [msg["seq"] for msg in ws.sent_messages] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_reconnect_with_cursor_gets_only_missed_events(monkeypatch, manager):
+    monkeypatch.setattr(manager, "_get_db", lambda: (_ for _ in ()).throw(AssertionError("no db")))
+    for n in range(5):
+        await manager.broadcast({"type": "checkout", "user_id": str(n), "room_name": "RoomA"})
+
+    ws = FakeWebSocket()
+    await manager.connect(ws, username="testuser", user_id="user123", since=3, stream=manager.stream_id)
+    await flush(manager)
+
+    replay = ws.sent_messages[1]
+    assert replay["type"] == "replay"
+    assert replay["seq"] == 5
+    assert [event["user_id"] for event in replay["events"]] == ["3", "4"]
+    assert not any(msg.get("type") == "history" for msg in ws.sent_messages[1:])
+
+
+@pytest.mark.asyncio
+async def test_reconnect_with_stale_cursor_gets_full_history(monkeypatch):
+    manager = activity.ConnectionManager(replay_window=2)
+    manager.history.load([], [], {})
+    for n in range(5):
+        await manager.broadcast({"type": "checkout", "user_id": str(n), "room_name": "RoomA"})
+
+    # Cursor older than the retained window
+    ws = FakeWebSocket()
+    await manager.connect(ws, user_id="a", since=1, stream=manager.stream_id)
+    # Cursor from another worker or a previous process
+    ws_other = FakeWebSocket()
+    await manager.connect(ws_other, user_id="b", since=5, stream="some-other-stream")
+    await flush(manager)
+
+    assert ws.sent_messages[1]["type"] == "history"
+    assert ws_other.sent_messages[1]["type"] == "history"
+
+
+def test_events_since(manager):
+    manager = activity.ConnectionManager(replay_window=3)
+    for n in range(5):
+        manager._deliver({"type": "checkout", "user_id": str(n), "room_name": "RoomA"})
+    assert manager._events_since(5) == []
+    assert [event["seq"] for event in manager._events_since(2)] == [3, 4, 5]
+    assert manager._events_since(1) is None
+    assert manager._events_since(6) is None
+    assert manager._events_since(None) is None
+
+
+def test_history_snapshot_follows_events():
+    snapshot = activity.HistorySnapshot(feed_size=2)
+    snapshot.load([], [], {})
+    now = activity.get_edmonton_time()
+    snapshot.apply({
+        "type": "checkin", "user_id": "u1", "username": "a", "room_name": "RoomA",
+        "study_topic": "Math", "timestamp": now.isoformat(),
+        "expiry_time": (now + timedelta(hours=4)).isoformat(), "current_occupancy": 1
+    })
+    body = json.loads(snapshot.body())
+    assert body["occupancy_data"] == {"RoomA": 1}
+    assert body["current_checkins"][0]["room_name"] == "RoomA"
+
+    snapshot.apply({"type": "checkout", "user_id": "u1", "room_name": "RoomA",
+                    "timestamp": now.isoformat(), "current_occupancy": 0})
+    snapshot.apply({"type": "connection", "user_id": "u2"})
+    snapshot.apply({"type": "checkin", "user_id": "u3", "room_name": "RoomB", "timestamp": now.isoformat(),
+                    "expiry_time": (now + timedelta(hours=4)).isoformat(), "current_occupancy": 1})
+    body = json.loads(snapshot.body())
+    assert body["occupancy_data"] == {"RoomA": 0, "RoomB": 1}
+    assert [checkin["user_id"] for checkin in body["current_checkins"]] == ["u3"]
+    # Bounded feed, newest first, without join/leave events.
+    assert [event["user_id"] for event in body["feed"]] == ["u3", "u1"]
+
+
+def test_history_snapshot_drops_events_older_than_the_window():
+    now = activity.get_edmonton_time()
+    clock = [now]
+    snapshot = activity.HistorySnapshot(clock=lambda: clock[0])
+    snapshot.load([
+        {"type": "checkout", "user_id": "u2", "room_name": "RoomA", "timestamp": (now - timedelta(hours=1)).isoformat()},
+        {"type": "checkout", "user_id": "u1", "room_name": "RoomA", "timestamp": (now - timedelta(hours=23)).isoformat()}
+    ], [], {})
+    body = snapshot.body()
+    assert [event["user_id"] for event in json.loads(body)["feed"]] == ["u2", "u1"]
+    assert snapshot.body() is body
+
+    # A quiet day later, nothing has been applied but the old events are gone
+    clock[0] = now + timedelta(hours=2)
+    assert [event["user_id"] for event in json.loads(snapshot.body())["feed"]] == ["u2"]
+    clock[0] = now + timedelta(hours=24)
+    snapshot.apply({"type": "checkout", "user_id": "u3", "room_name": "RoomA", "timestamp": clock[0].isoformat()})
+    assert [event["user_id"] for event in json.loads(snapshot.body())["feed"]] == ["u3"]
+
+
+def test_history_snapshot_ignores_events_until_loaded():
+    snapshot = activity.HistorySnapshot()
+    snapshot.apply({"type": "checkout", "user_id": "u2", "room_name": "RoomA", "current_occupancy": 0})
+    snapshot.load([], [], {})
+    assert json.loads(snapshot.body())["feed"] == []
+
+
+def test_history_snapshot_body_is_cached():
+    snapshot = activity.HistorySnapshot()
+    snapshot.load([], [], {"RoomA": 2})
+    assert snapshot.body() is snapshot.body()
+    message = json.loads(snapshot.render("user123", None))
+    assert message["type"] == "history"
+    assert message["user_id"] == "user123"
+    assert message["occupancy_data"] == {"RoomA": 2}
+
+
+@pytest.mark.asyncio
+async def test_disconnect(manager):
+    ws = FakeWebSocket()
+    manager._register(ws, user_id="user123", username="testuser")
     event = manager.disconnect(ws)
     assert event["type"] == "disconnection"
     assert event["user_id"] == "user123"
-    assert ws not in manager.active_connections
-    assert ws not in manager.user_ids
+    assert event["username"] == "testuser"
+    assert ws not in manager.connections
+    assert not manager.connections.for_user("user123")
+    assert manager.topics == {}
 
 
 @pytest.mark.asyncio
@@ -297,15 +434,14 @@ async def test_handle_checkin_missing_fields(monkeypatch, manager):
     ws.send_json = fake_send_json
 
     # No user_id in manager.user_ids so expecting an error.
-    await manager.handle_checkin(ws, {"room_name": "RoomA", "username": "test"})
+    await manager.handle_checkin(ws, CheckinMessage(room_name="RoomA", username="test"))
     assert any("Missing user_id" in msg.get("message", "") for msg in messages)
 
 
 @pytest.mark.asyncio
 async def test_handle_checkin_success(monkeypatch, manager):
     ws = FakeWebSocket()
-    manager.user_ids[ws] = "user123"
-    manager.usernames[ws] = "testuser"
+    manager._register(ws, user_id="user123", username="testuser")
 
     fake_db = FakeDB()
     # Simulate no active check-in for this user.
@@ -319,7 +455,7 @@ async def test_handle_checkin_success(monkeypatch, manager):
         broadcasted.append(msg)
     monkeypatch.setattr(manager, "broadcast", fake_broadcast)
 
-    await manager.handle_checkin(ws, {"room_name": "RoomA", "username": "testuser", "study_topic": "Math"})
+    await manager.handle_checkin(ws, CheckinMessage(room_name="RoomA", username="testuser", study_topic="Math"))
     # A checkin event should be broadcast.
     assert any(msg.get("type") == "checkin" for msg in broadcasted)
 
@@ -327,8 +463,7 @@ async def test_handle_checkin_success(monkeypatch, manager):
 @pytest.mark.asyncio
 async def test_handle_checkin_already_checked_in_same_room(monkeypatch, manager):
     ws = FakeWebSocket()
-    manager.user_ids[ws] = "user123"
-    manager.usernames[ws] = "testuser"
+    manager._register(ws, user_id="user123", username="testuser")
 
     checkin = RoomOccupancy(
         user_id="user123",
@@ -342,21 +477,16 @@ async def test_handle_checkin_already_checked_in_same_room(monkeypatch, manager)
     fake_db.queries[RoomOccupancy] = FakeQuery([checkin])
     monkeypatch.setattr(manager, "_get_db", lambda: fake_db)
 
-    messages = []
-    async def fake_send_json(msg):
-        messages.append(msg)
-    ws.send_json = fake_send_json
-
-    await manager.handle_checkin(ws, {"room_name": "RoomA", "username": "testuser", "study_topic": "Math"})
+    await manager.handle_checkin(ws, CheckinMessage(room_name="RoomA", username="testuser", study_topic="Math"))
+    await flush(manager)
     # Should send an info message indicating already checked in.
-    assert any("already checked into RoomA" in msg.get("message", "") for msg in messages)
+    assert any("already checked into RoomA" in msg.get("message", "") for msg in ws.sent_messages)
 
 
 @pytest.mark.asyncio
 async def test_handle_checkin_auto_checkout(monkeypatch, manager):
     ws = FakeWebSocket()
-    manager.user_ids[ws] = "user123"
-    manager.usernames[ws] = "testuser"
+    manager._register(ws, user_id="user123", username="testuser")
 
     # Existing checkin in a different room.
     checkin = RoomOccupancy(
@@ -383,7 +513,7 @@ async def test_handle_checkin_auto_checkout(monkeypatch, manager):
         broadcasted.append(msg)
     monkeypatch.setattr(manager, "broadcast", fake_broadcast)
 
-    await manager.handle_checkin(ws, {"room_name": "RoomA", "username": "testuser", "study_topic": "Math"})
+    await manager.handle_checkin(ws, CheckinMessage(room_name="RoomA", username="testuser", study_topic="Math"))
     assert checkout_called
     assert any(msg.get("type") == "checkin" for msg in broadcasted)
 
@@ -396,7 +526,7 @@ async def test_handle_checkout_missing_user(monkeypatch, manager):
         messages.append(msg)
     ws.send_json = fake_send_json
 
-    await manager.handle_checkout(ws, {"room_name": "RoomA"})
+    await manager.handle_checkout(ws, CheckoutMessage(room_name="RoomA"))
     # Expect an error about missing user_id.
     assert any("User ID not found" in msg.get("message", "") for msg in messages)
 
@@ -404,26 +534,45 @@ async def test_handle_checkout_missing_user(monkeypatch, manager):
 @pytest.mark.asyncio
 async def test_handle_checkout_no_active_checkin(monkeypatch, manager):
     ws = FakeWebSocket()
-    manager.user_ids[ws] = "user123"
-    manager.usernames[ws] = "testuser"
+    manager._register(ws, user_id="user123", username="testuser")
     fake_db = FakeDB()
     fake_db.queries[RoomOccupancy] = FakeQuery([])  # No active checkin.
     monkeypatch.setattr(manager, "_get_db", lambda: fake_db)
 
-    messages = []
-    async def fake_send_json(msg):
-        messages.append(msg)
-    ws.send_json = fake_send_json
+    await manager.handle_checkout(ws, CheckoutMessage(room_name="RoomA"))
+    await flush(manager)
+    assert any("not checked in" in msg.get("message", "") for msg in ws.sent_messages)
+
+
+@pytest.mark.asyncio
+async def test_handle_checkout_after_concurrent_expiry_does_not_decrement(monkeypatch, manager):
+    ws = FakeWebSocket()
+    manager._register(ws, user_id="user123", username="testuser")
+    fake_db = FakeDB()
+    # The expiry engine flipped the row while this checkout waited for its lock
+    fake_db.queries[RoomOccupancy] = FakeQuery([])
+    statements = []
+    execute = fake_db.execute
+    async def recording_execute(statement):
+        statements.append(statement)
+        return await execute(statement)
+    fake_db.execute = recording_execute
+    monkeypatch.setattr(manager, "_get_db", lambda: fake_db)
+    broadcasted = []
+    async def fake_broadcast(msg):
+        broadcasted.append(msg)
+    monkeypatch.setattr(manager, "broadcast", fake_broadcast)
 
-    await manager.handle_checkout(ws, {"room_name": "RoomA"})
-    assert any("not checked in" in msg.get("message", "") for msg in messages)
+    await manager.handle_checkout(ws, CheckoutMessage(auto=True))
+    assert statements[0]._for_update_arg is not None
+    assert fake_db.room_counts == {}
+    assert broadcasted == []
 
 
 @pytest.mark.asyncio
 async def test_handle_checkout_success(monkeypatch, manager):
     ws = FakeWebSocket()
-    manager.user_ids[ws] = "user123"
-    manager.usernames[ws] = "testuser"
+    manager._register(ws, user_id="user123", username="testuser")
     now = datetime.now()
     checkin = RoomOccupancy(
         user_id="user123",
@@ -444,15 +593,14 @@ async def test_handle_checkout_success(monkeypatch, manager):
         broadcasted.append(msg)
     monkeypatch.setattr(manager, "broadcast", fake_broadcast)
 
-    await manager.handle_checkout(ws, {"room_name": "RoomA"})
+    await manager.handle_checkout(ws, CheckoutMessage(room_name="RoomA"))
     assert any(msg.get("type") == "checkout" for msg in broadcasted)
 
 
 @pytest.mark.asyncio
 async def test_handle_checkout_auto_checkout_no_error(monkeypatch, manager):
     ws = FakeWebSocket()
-    manager.user_ids[ws] = "user123"
-    manager.usernames[ws] = "testuser"
+    manager._register(ws, user_id="user123", username="testuser")
     fake_db = FakeDB()
     checkin = RoomOccupancy(
         user_id="user123",
@@ -473,7 +621,7 @@ async def test_handle_checkout_auto_checkout_no_error(monkeypatch, manager):
     monkeypatch.setattr(manager, "broadcast", fake_broadcast)
 
     # Omit room_name to use the active checkin's room.
-    await manager.handle_checkout(ws, {})
+    await manager.handle_checkout(ws, CheckoutMessage())
     assert any(msg.get("type") == "checkout" for msg in broadcasted)
 
 
@@ -502,27 +650,324 @@ async def test_expire_checkins(monkeypatch, manager):
     await manager.expire_checkins()
     assert any(msg.get("type") == "checkout" for msg in broadcasted)
 
+    # Nothing is broadcast for expirations whose commit failed
+    expired.is_active = True
+    broadcasted.clear()
+    async def failing_commit():
+        raise RuntimeError("commit failed")
+    fake_db.commit = failing_commit
+    with pytest.raises(RuntimeError):
+        await manager.expire_checkins()
+    assert broadcasted == []
+    assert fake_db.rolled_back
+
 
 @pytest.mark.asyncio
 async def test_broadcast(monkeypatch, manager):
     ws_good = FakeWebSocket()
     ws_bad = FakeWebSocket()
-    async def fail_send_json(msg):
+    async def fail_send(msg):
         raise WebSocketDisconnect("Test disconnect")
-    ws_bad.send_json = fail_send_json
-    manager.active_connections = [ws_good, ws_bad]
+    ws_bad.send_text = fail_send
+    manager._register(ws_good)
+    manager._register(ws_bad, user_id="bad")
+    await manager.handle_subscription(ws_good, SubscriptionMessage(type="subscribe", presence=True))
+    await flush(manager)
+    ws_good.sent_messages.clear()
+
+    await manager.broadcast({"test": "message"})
+    await flush(manager)
 
-    # Override disconnect to simply remove the ws.
-    def fake_disconnect(ws):
-        if ws in manager.active_connections:
-            manager.active_connections.remove(ws)
-        return {"type": "disconnection", "user_id": "dummy", "username": None,
-                "timestamp": activity.get_edmonton_time().isoformat(), "message": "disconnected"}
-    monkeypatch.setattr(manager, "disconnect", fake_disconnect)
+    # ws_bad should have been evicted and the others told about it once.
+    assert ws_bad not in manager.connections
+    assert ws_bad not in manager.connections
+    assert ws_good.sent_messages[0] == {"test": "message", "seq": 1}
+    disconnections = [msg for msg in ws_good.sent_messages if msg.get("type") == "disconnection"]
+    assert len(disconnections) == 1
+    assert disconnections[0]["user_id"] == "bad"
+
+
+@pytest.mark.asyncio
+async def test_broadcast_does_not_wait_on_slow_client(manager):
+    ws_fast = FakeWebSocket()
+    ws_slow = FakeWebSocket()
+    release = asyncio.Event()
+    async def slow_send(msg):
+        await release.wait()
+    ws_slow.send_text = slow_send
+    manager._register(ws_slow)
+    manager._register(ws_fast)
+
+    await manager.broadcast({"n": 1})
+    await manager.broadcast({"n": 2})
+    await manager.connections.get(ws_fast).queue.join()
+
+    # The fast client got everything while the slow one is still stuck.
+    assert [msg["n"] for msg in ws_fast.sent_messages] == [1, 2]
+    assert ws_slow in manager.connections
+    release.set()
+    await flush(manager)
+
+
+def make_slow(ws):
+    """Hold a socket's sends until the returned event is set"""
+    release = asyncio.Event()
+    send_text = ws.send_text
+    async def slow_send(msg):
+        await release.wait()
+        await send_text(msg)
+    ws.send_text = slow_send
+    return release
+
+
+@pytest.mark.asyncio
+async def test_full_queue_conflates_instead_of_evicting():
+    manager = activity.ConnectionManager(send_queue_size=2)
+    ws_fast = FakeWebSocket()
+    ws_slow = FakeWebSocket()
+    release = make_slow(ws_slow)
+    manager._register(ws_slow, user_id="slow")
+    manager._register(ws_fast)
+
+    for n in range(6):
+        await manager.broadcast({"type": "checkout", "n": n, "user_id": f"u{n}", "room_name": "CAB 235", "current_occupancy": n + 1})
+        await manager.connections.get(ws_fast).queue.join()
+    await manager.publish_presence()
+
+    slow = manager.connections.get(ws_slow)
+    assert ws_slow in manager.connections
+    assert slow.lagging
+    assert manager.evicted_count == 0
+    assert manager.stats()["lagging"] == 1
+    assert slow.pending_occupancy == {"CAB 235": 6}
+
+    release.set()
+    await flush(manager)
+    assert not slow.lagging
+    assert [msg["n"] for msg in ws_fast.sent_messages if "n" in msg] == [0, 1, 2, 3, 4, 5]
+    # The first event was being written and two more were queued when it fell behind
+    assert [msg["n"] for msg in ws_slow.sent_messages[:3]] == [0, 1, 2]
+    catchup = ws_slow.sent_messages[3]
+    assert catchup["type"] == "catchup"
+    assert catchup["seq"] == 6
+    assert catchup["occupancy"] == {"CAB 235": 6}
+    assert [event["n"] for event in catchup["events"]] == [3, 4, 5]
+    assert all("current_occupancy" not in event for event in catchup["events"])
+    assert catchup["presence"] == {"campus": 1, "buildings": {}}
+    assert len(ws_slow.sent_messages) == 4
+
+
+@pytest.mark.asyncio
+async def test_lagging_client_past_feed_cap_is_told_to_resync():
+    manager = activity.ConnectionManager(send_queue_size=1, slow_feed_cap=3)
+    ws = FakeWebSocket()
+    release = make_slow(ws)
+    manager._register(ws)
+
+    for n in range(10):
+        await manager.broadcast({"type": "checkout", "n": n, "user_id": f"u{n}", "room_name": f"CAB {n % 2}", "current_occupancy": n})
+    connection = manager.connections.get(ws)
+    assert connection.pending_events == []
+    assert connection.resync
+
+    # Pings are not worth catching up on
+    await manager.heartbeat()
+
+    release.set()
+    await flush(manager)
+    catchup = ws.sent_messages[-1]
+    assert catchup == {"type": "catchup", "seq": 10, "events": [], "occupancy": {"CAB 0": 8, "CAB 1": 9}, "resync": True}
+    assert manager.stats()["lagged"] == 1
+
+
+@pytest.mark.asyncio
+async def test_lagging_client_conflates_batches():
+    manager = activity.ConnectionManager(send_queue_size=1, batch_window_ms=1000)
+    ws = FakeWebSocket()
+    release = make_slow(ws)
+    manager._register(ws)
+
+    for n in range(3):
+        for room in ("CAB 235", "ETLC 1-001"):
+            await manager.broadcast({"type": "checkout", "n": n, "user_id": f"u{n}", "room_name": room, "current_occupancy": n})
+        manager._flush_batch()
+
+    release.set()
+    await flush(manager)
+    catchup = ws.sent_messages[-1]
+    assert catchup["type"] == "catchup"
+    assert catchup["occupancy"] == {"CAB 235": 2, "ETLC 1-001": 2}
+    # The first batch filled the queue before the writer ran, the rest were conflated
+    assert ws.sent_messages[0]["type"] == "batch"
+    assert [event["n"] for event in catchup["events"]] == [1, 1, 2, 2]
+
+
+@pytest.mark.asyncio
+async def test_broadcast_evicts_send_timeout(monkeypatch):
+    manager = activity.ConnectionManager(send_timeout=0.01)
+    ws = FakeWebSocket()
+    async def hanging_send(msg):
+        await asyncio.Event().wait()
+    ws.send_text = hanging_send
+    manager._register(ws)
 
     await manager.broadcast({"test": "message"})
-    # ws_bad should have been removed.
-    assert ws_bad not in manager.active_connections
+    await asyncio.wait_for(manager.connections.get(ws).writer, timeout=1)
+
+    assert ws not in manager.connections
+    assert manager.evicted_count == 1
+
+
+@pytest.mark.asyncio
+async def test_disconnect_twice_returns_none(manager):
+    ws = FakeWebSocket()
+    manager._register(ws, user_id="user123")
+    assert manager.disconnect(ws) is not None
+    assert manager.disconnect(ws) is None
+
+
+@pytest.mark.asyncio
+async def test_topic_subscriptions_route_events(manager):
+    ws_campus = FakeWebSocket()
+    ws_building = FakeWebSocket()
+    ws_room = FakeWebSocket()
+    for ws in (ws_campus, ws_building, ws_room):
+        manager._register(ws)
+    await manager.handle_subscription(ws_building, SubscriptionMessage(type="subscribe", buildings=["CAB"], campus=False))
+    await manager.handle_subscription(ws_room, SubscriptionMessage(type="subscribe", rooms=["ETLC 1-001"], campus=False))
+    await flush(manager)
+    assert ws_building.sent_messages[-1] == {"type": "subscriptions", "topics": ["building:CAB"]}
+
+    await manager.broadcast({"type": "checkout", "user_id": "u1", "room_name": "CAB 235"})
+    await manager.broadcast({"type": "checkout", "user_id": "u2", "room_name": "ETLC 1-001"})
+    await manager.broadcast({"type": "connection", "user_id": "u3", "timestamp": activity.get_edmonton_time().isoformat()})
+    await flush(manager)
+
+    def received(ws):
+        return [msg["user_id"] for msg in ws.sent_messages if msg.get("type") != "subscriptions"]
+    # Join/leave events only reach presence subscribers
+    assert received(ws_campus) == ["u1", "u2"]
+    assert received(ws_building) == ["u1"]
+    assert received(ws_room) == ["u2"]
+
+
+@pytest.mark.asyncio
+async def test_unsubscribe_and_disconnect_clean_topic_index(manager):
+    ws = FakeWebSocket()
+    manager._register(ws)
+    await manager.handle_subscription(ws, SubscriptionMessage(type="subscribe", buildings=["CAB"]))
+    assert manager.connections.get(ws).topics == {"campus", "building:CAB"}
+
+    await manager.handle_subscription(ws, SubscriptionMessage(type="unsubscribe", campus=True))
+    assert manager.connections.get(ws).topics == {"building:CAB"}
+    assert "campus" not in manager.topics
+
+    manager.disconnect(ws)
+    assert manager.topics == {}
+    assert ws not in manager.connections
+
+
+@pytest.mark.asyncio
+async def test_broadcast_encodes_once(monkeypatch, manager):
+    sockets = [FakeWebSocket() for _ in range(5)]
+    for ws in sockets:
+        manager._register(ws)
+
+    dumps_calls = []
+    real_dumps = json.dumps
+    def counting_dumps(*args, **kwargs):
+        dumps_calls.append(args)
+        return real_dumps(*args, **kwargs)
+    monkeypatch.setattr(activity.json, "dumps", counting_dumps)
+
+    await manager.broadcast({"type": "checkout", "user_id": "u1", "room_name": "RoomA"})
+    await flush(manager)
+
+    assert len(dumps_calls) == 1
+    assert all(ws.sent_messages[0]["user_id"] == "u1" for ws in sockets)
+
+
+@pytest.mark.asyncio
+async def test_batch_window_coalesces_events():
+    manager = activity.ConnectionManager(batch_window_ms=20)
+    ws_campus = FakeWebSocket()
+    ws_building = FakeWebSocket()
+    ws_room = FakeWebSocket()
+    for ws in (ws_campus, ws_building, ws_room):
+        manager._register(ws)
+    await manager.handle_subscription(ws_building, SubscriptionMessage(type="subscribe", buildings=["CAB"], campus=False))
+    await manager.handle_subscription(ws_room, SubscriptionMessage(type="subscribe", rooms=["ETLC 1-001"], campus=False))
+    await flush(manager)
+
+    await manager.broadcast({"type": "checkin", "user_id": "u1", "room_name": "CAB 235", "current_occupancy": 1,
+                             "timestamp": "2025-01-13T10:50:00-07:00", "expiry_time": "2025-01-13T14:50:00-07:00"})
+    await manager.broadcast({"type": "checkout", "user_id": "u2", "room_name": "ETLC 1-001", "current_occupancy": 0})
+    await manager.broadcast({"type": "checkout", "user_id": "u3", "room_name": "CAB 235", "current_occupancy": 0})
+    await flush(manager)
+    assert ws_campus.sent_messages == []
+
+    await asyncio.sleep(0.05)
+    await flush(manager)
+
+    batch = ws_campus.sent_messages[-1]
+    assert batch["type"] == "batch"
+    assert [event["user_id"] for event in batch["events"]] == ["u1", "u2", "u3"]
+    assert [event["seq"] for event in batch["events"]] == [1, 2, 3]
+    assert batch["occupancy"] == {"CAB 235": 0, "ETLC 1-001": 0}
+    assert all("current_occupancy" not in event for event in batch["events"])
+    assert [event["user_id"] for event in ws_building.sent_messages[-1]["events"]] == ["u1", "u3"]
+    # A single event is sent as it is
+    assert ws_room.sent_messages[-1]["user_id"] == "u2"
+    assert ws_room.sent_messages[-1]["current_occupancy"] == 0
+    assert manager.replay_window[0]["current_occupancy"] == 1
+
+
+@pytest.mark.asyncio
+async def test_connect_flushes_pending_batch():
+    manager = activity.ConnectionManager(batch_window_ms=1000)
+    manager.history.load([], [], {})
+    ws_old = FakeWebSocket()
+    manager._register(ws_old)
+    await manager.broadcast({"type": "checkout", "user_id": "u1", "room_name": "RoomA", "current_occupancy": 0})
+
+    ws_new = FakeWebSocket()
+    await manager.connect(ws_new, user_id="u2")
+    await flush(manager)
+
+    assert ws_old.sent_messages[0]["user_id"] == "u1"
+    assert ws_new.sent_messages[1]["type"] == "history"
+    assert ws_new.sent_messages[1]["occupancy_data"] == {"RoomA": 0}
+    assert all(message.get("user_id") != "u1" for message in ws_new.sent_messages[2:])
+    manager._flush_batch()
+
+
+@pytest.mark.asyncio
+async def test_msgpack_subprotocol(manager):
+    manager.history.load([], [], {"RoomA": 1})
+    ws_json = FakeWebSocket()
+    ws_msgpack = FakeWebSocket(subprotocols=["msgpack"])
+    await manager.connect(ws_json, user_id="a")
+    await manager.connect(ws_msgpack, user_id="b")
+    await flush(manager)
+
+    encoded = []
+    async def record_bytes(message):
+        encoded.append(message)
+    ws_msgpack.send_bytes = record_bytes
+    await manager.broadcast({"type": "checkout", "user_id": "u1", "room_name": "RoomA"})
+    await flush(manager)
+
+    assert ws_json.accepted_subprotocol is None
+    assert ws_msgpack.accepted_subprotocol == "msgpack"
+    assert ws_msgpack.sent_messages[1]["type"] == "history"
+    assert ws_msgpack.sent_messages[1]["occupancy_data"] == {"RoomA": 1}
+    assert msgpack.unpackb(encoded[-1])["user_id"] == "u1"
+    assert ws_json.sent_messages[-1]["user_id"] == "u1"
+
+
+def test_negotiate_codec_without_msgpack(monkeypatch):
+    monkeypatch.setattr(activity, "msgpack", None)
+    assert activity.negotiate_codec(FakeWebSocket(subprotocols=["msgpack"])) == activity.JSON_CODEC
 
 
 @pytest.mark.asyncio
@@ -554,8 +999,7 @@ async def test_websocket_endpoint_authenticated(monkeypatch):
 
     fake_db = FakeDB()
     fake_db.queries[User] = FakeQuery([fake_user])
-    # Monkey-patch SessionLocal in the activity module.
-    monkeypatch.setattr(activity, "SessionLocal", lambda: fake_db)
+    monkeypatch.setattr(activity.manager, "_get_db", lambda: fake_db)
 
     # Queue several messages:
     ws.queue_message("ping")
@@ -572,13 +1016,14 @@ async def test_websocket_endpoint_authenticated(monkeypatch):
     ws.queue_message("invalid json")  # This should be skipped
 
     # Override connect so it simply records a history message.
-    async def fake_connect(websocket, username=None, user_id=None):
+    async def fake_connect(websocket, username=None, user_id=None, **kwargs):
         websocket.sent_messages.append({"type": "history", "user_id": user_id})
+        return activity.manager._register(websocket, user_id=user_id, username=username)
     monkeypatch.setattr(activity.manager, "connect", fake_connect)
 
     await activity.websocket_endpoint(ws)
     # When the connection is terminated (via WebSocketDisconnect), the websocket should be closed.
-    assert ws not in activity.manager.active_connections
+    assert ws not in activity.manager.connections
 
 
 @pytest.mark.asyncio
@@ -587,7 +1032,114 @@ async def test_websocket_endpoint_unauthenticated(monkeypatch):
     ws = FakeWebSocket(headers={"cookie": ""})
     fake_db = FakeDB()
     fake_db.queries[User] = FakeQuery([])  # No user found.
-    monkeypatch.setattr(activity, "SessionLocal", lambda: fake_db)
+    monkeypatch.setattr(activity.manager, "_get_db", lambda: fake_db)
     await activity.websocket_endpoint(ws)
     # Expect the websocket to be closed with an unauthorized error.
     assert ws.closed is True
+
+
+@pytest.mark.asyncio
+async def test_publish_presence_sends_deltas_only(manager):
+    ws1 = FakeWebSocket()
+    ws2 = FakeWebSocket()
+    for ws, user_id in ((ws1, "u1"), (ws2, "u2")):
+        manager._register(ws, user_id=user_id)
+    await manager.handle_subscription(ws1, SubscriptionMessage(type="subscribe", buildings=["CAB"]))
+    await manager.handle_subscription(ws2, SubscriptionMessage(type="subscribe", buildings=["CAB"]))
+    await flush(manager)
+    ws1.sent_messages.clear()
+
+    await manager.publish_presence()
+    await flush(manager)
+    assert ws1.sent_messages == [{"type": "presence", "campus": 2, "buildings": {"CAB": 2}}]
+
+    # Nothing changed, nothing sent
+    await manager.publish_presence()
+    await flush(manager)
+    assert len(ws1.sent_messages) == 1
+
+    # A building that empties out is reported once as zero
+    await manager.handle_subscription(ws2, SubscriptionMessage(type="unsubscribe", buildings=["CAB"]))
+    await manager.handle_subscription(ws1, SubscriptionMessage(type="unsubscribe", buildings=["CAB"]))
+    await flush(manager)
+    ws1.sent_messages.clear()
+    await manager.publish_presence()
+    await flush(manager)
+    assert ws1.sent_messages == [{"type": "presence", "campus": 2, "buildings": {"CAB": 0}}]
+    assert manager.presence == {"campus": 2, "buildings": {}}
+
+
+@pytest.mark.asyncio
+async def test_presence_counts_distinct_users(manager):
+    for _ in range(3):
+        ws = FakeWebSocket()
+        manager._register(ws, user_id="u1")
+    assert manager._local_presence() == {"campus": 1, "buildings": {}}
+
+
+def test_decode_inbound_messages(manager):
+    connection = activity.Connection(FakeWebSocket(), 10, 1.0, activity.JSON_CODEC, "u1")
+    message = manager.decode(connection, '{"type": "checkin", "room_name": "CAB 235", "study_topic": "Math"}')
+    assert message == CheckinMessage(room_name="CAB 235", study_topic="Math")
+    assert manager.decode(connection, b'{"type": "checkout"}') == CheckoutMessage()
+    assert manager.decode(connection, '{"type": "unsubscribe", "rooms": ["CAB 235"]}').rooms == ["CAB 235"]
+
+    for raw in ("invalid json", '{"type": "checkin"}', '{"type": "dance"}', '{"room_name": "CAB 235"}', "[]"):
+        with pytest.raises(ValueError):
+            manager.decode(connection, raw)
+
+
+def test_decode_msgpack_frames(manager):
+    connection = activity.Connection(FakeWebSocket(), 10, 1.0, activity.MSGPACK_CODEC, "u1")
+    raw = msgpack.packb({"type": "setUsername", "username": "newname"})
+    assert manager.decode(connection, raw).username == "newname"
+    with pytest.raises(ValueError):
+        manager.decode(connection, b"\xc1")
+
+
+@pytest.mark.asyncio
+async def test_websocket_endpoint_rejects_malformed_frames(monkeypatch):
+    ws = FakeWebSocket(query_params={"token": "t"})
+    fake_user = User(id=uuid.uuid4(), email="test@example.com", username="testuser", password="pass")
+    monkeypatch.setattr(activity.jwt, "decode", lambda *args, **kwargs: {"sub": fake_user.email})
+    monkeypatch.setattr(activity.principal_cache, "get", lambda email: fake_user)
+
+    sent = []
+    async def fake_send_personal(websocket, message):
+        sent.append(message)
+    dispatched = []
+    async def fake_dispatch(websocket, message):
+        dispatched.append(message)
+    async def fake_connect(websocket, username=None, user_id=None, **kwargs):
+        return activity.manager._register(websocket, user_id=user_id, username=username)
+    monkeypatch.setattr(activity.manager, "connect", fake_connect)
+    monkeypatch.setattr(activity.manager, "send_personal", fake_send_personal)
+    monkeypatch.setattr(activity.manager, "dispatch", fake_dispatch)
+
+    ws.queue_message("ping")
+    ws.queue_message('{"type": "checkout", "room_name": "CAB 235"}')
+    ws.queue_message("not json")
+    await activity.websocket_endpoint(ws)
+
+    assert dispatched == [CheckoutMessage(room_name="CAB 235")]
+    assert [json.loads(message) for message in sent] == [{"type": "error", "message": "Malformed message"}]
+
+
+@pytest.mark.asyncio
+async def test_websocket_endpoint_cleans_up_after_handler_error(monkeypatch):
+    ws = FakeWebSocket(query_params={"token": "t"})
+    fake_user = User(id=uuid.uuid4(), email="test@example.com", username="testuser", password="pass")
+    monkeypatch.setattr(activity.jwt, "decode", lambda *args, **kwargs: {"sub": fake_user.email})
+    monkeypatch.setattr(activity.principal_cache, "get", lambda email: fake_user)
+
+    async def fake_connect(websocket, username=None, user_id=None, **kwargs):
+        return activity.manager._register(websocket, user_id=user_id, username=username)
+    async def failing_dispatch(websocket, message):
+        raise RuntimeError("handler failed")
+    monkeypatch.setattr(activity.manager, "connect", fake_connect)
+    monkeypatch.setattr(activity.manager, "dispatch", failing_dispatch)
+
+    ws.queue_message('{"type": "checkout"}')
+    await activity.websocket_endpoint(ws)
+    assert ws not in activity.manager.connections
+    assert not activity.manager.connections.for_user(str(fake_user.id))
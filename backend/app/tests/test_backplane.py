@@ -0,0 +1,153 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from app.core import activity
+from app.core.backplane import Backplane, InProcessBus, InProcessBackplane, PostgresBackplane, create_backplane
+from app.schemas.websocket import SubscriptionMessage
+from app.tests.test_activity import FakeWebSocket, flush
+
+
+async def make_worker(bus):
+    manager = activity.ConnectionManager()
+    await manager.attach_backplane(InProcessBackplane(bus))
+    return manager
+
+
+@pytest.mark.asyncio
+async def test_broadcast_reaches_clients_on_other_workers():
+    bus = InProcessBus()
+    worker_a = await make_worker(bus)
+    worker_b = await make_worker(bus)
+    ws_a = FakeWebSocket()
+    ws_b = FakeWebSocket()
+    worker_a._register(ws_a)
+    worker_b._register(ws_b)
+
+    event = {"type": "checkout", "user_id": "u1", "room_name": "RoomA", "current_occupancy": 0}
+    await worker_a.broadcast(event)
+    await asyncio.sleep(0)
+    await flush(worker_a)
+    await flush(worker_b)
+
+    # Each client sees the event exactly once, no echo back to the sender.
+    assert ws_a.sent_messages == [event]
+    assert ws_b.sent_messages == [event]
+
+
+@pytest.mark.asyncio
+async def test_remote_checkin_updates_local_expiry_engine():
+    bus = InProcessBus()
+    worker_a = await make_worker(bus)
+    worker_b = await make_worker(bus)
+
+    expiry_time = activity.get_edmonton_time() + timedelta(hours=4)
+    await worker_a.broadcast({
+        "type": "checkin",
+        "user_id": "u1",
+        "room_name": "RoomA",
+        "expiry_time": expiry_time.isoformat()
+    })
+    await asyncio.sleep(0)
+    assert len(worker_b.expiry) == 1
+
+    await worker_a.broadcast({"type": "checkout", "user_id": "u1", "room_name": "RoomA"})
+    await asyncio.sleep(0)
+    assert len(worker_b.expiry) == 0
+
+
+@pytest.mark.asyncio
+async def test_connection_events_stay_on_their_worker():
+    bus = InProcessBus()
+    worker_a = await make_worker(bus)
+    worker_b = await make_worker(bus)
+    ws_local = FakeWebSocket()
+    ws_default = FakeWebSocket()
+    ws_remote = FakeWebSocket()
+    worker_a._register(ws_local)
+    worker_a._register(ws_default)
+    worker_b._register(ws_remote)
+    await worker_a.handle_subscription(ws_local, SubscriptionMessage(type="subscribe", presence=True))
+    await worker_b.handle_subscription(ws_remote, SubscriptionMessage(type="subscribe", presence=True))
+    published = []
+    original_publish = worker_a.backplane.publish
+    async def record_publish(message):
+        published.append(message)
+        await original_publish(message)
+    worker_a.backplane.publish = record_publish
+
+    await worker_a.broadcast({
+        "type": "connection",
+        "user_id": "u1",
+        "timestamp": activity.get_edmonton_time().isoformat()
+    })
+    await asyncio.sleep(0)
+    await flush(worker_a)
+    await flush(worker_b)
+    joins = [msg for msg in ws_local.sent_messages if msg.get("type") == "connection"]
+    assert [msg["user_id"] for msg in joins] == ["u1"]
+    assert "seq" not in joins[0]
+    assert not [msg for msg in ws_default.sent_messages if msg.get("type") == "connection"]
+    # Other workers only see the aggregated presence reports
+    assert published == []
+    assert not [msg for msg in ws_remote.sent_messages if msg.get("type") == "connection"]
+
+
+@pytest.mark.asyncio
+async def test_presence_reports_are_summed_across_workers():
+    bus = InProcessBus()
+    worker_a = await make_worker(bus)
+    worker_b = await make_worker(bus)
+    ws_a = FakeWebSocket()
+    worker_a._register(ws_a, user_id="u1")
+    ws_b = FakeWebSocket()
+    worker_b._register(ws_b, user_id="u2")
+
+    await worker_a.publish_presence()
+    await asyncio.sleep(0)
+    await worker_b.publish_presence()
+    await asyncio.sleep(0)
+    await flush(worker_a)
+    await flush(worker_b)
+    assert worker_b.presence["campus"] == 2
+    assert ws_b.sent_messages[-1] == {"type": "presence", "campus": 2, "buildings": {}}
+
+
+@pytest.mark.asyncio
+async def test_detached_worker_stops_receiving():
+    bus = InProcessBus()
+    worker_a = await make_worker(bus)
+    worker_b = await make_worker(bus)
+    ws_b = FakeWebSocket()
+    worker_b._register(ws_b)
+
+    await worker_b.detach_backplane()
+    await worker_a.broadcast({"type": "checkout", "user_id": "u1", "room_name": "RoomA"})
+    await asyncio.sleep(0)
+    await flush(worker_b)
+    assert ws_b.sent_messages == []
+
+
+def test_postgres_backplane_strips_driver_from_url():
+    backplane = PostgresBackplane("postgresql+psycopg2://user:secret@db:5432/beacons", "events")
+    assert backplane.dsn == "postgresql://user:secret@db:5432/beacons"
+
+
+def test_create_backplane():
+    assert isinstance(create_backplane("memory", "", "events"), InProcessBackplane)
+    assert create_backplane("none", "", "events") is None
+    with pytest.raises(ValueError):
+        create_backplane("redis", "", "events")
+
+
+def test_backplane_requires_publish():
+    class Incomplete(Backplane):
+        async def start(self, on_message):
+            await super().start(on_message)
+
+        async def stop(self):
+            await super().stop()
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,196 @@
+import asyncio
+
+import pytest
+
+from app.core import activity
+from app.core.commands import RecentCommands, CommandDebouncer, net_effect
+from app.schemas.websocket import CheckinMessage, CheckoutMessage
+from app.tests.test_activity import FakeWebSocket
+
+
+def test_recent_commands_flags_recorded_ids():
+    recent = RecentCommands(ttl=60)
+    assert not recent.seen("u1", "c1")
+    # Only IDs recorded after their command ran are duplicates
+    assert not recent.seen("u1", "c1")
+    recent.record("u1", "c1")
+    assert recent.seen("u1", "c1")
+    # IDs are per user
+    assert not recent.seen("u2", "c1")
+    assert recent.duplicates == 1
+
+
+def test_recent_commands_expire_and_stay_bounded():
+    recent = RecentCommands(ttl=0)
+    recent.record("u1", "c1")
+    assert not recent.seen("u1", "c1")
+
+    recent = RecentCommands(ttl=60, maxsize=2)
+    for command_id in ("c1", "c2", "c3"):
+        recent.record("u1", command_id)
+    assert len(recent) == 2
+    assert not recent.seen("u1", "c1")
+
+
+def test_net_effect_keeps_last_command():
+    ws = FakeWebSocket()
+    commands = [
+        (ws, CheckinMessage(room_name="CAB 235")),
+        (ws, CheckoutMessage(room_name="CAB 235")),
+        (ws, CheckinMessage(room_name="ETLC 1-001")),
+    ]
+    assert net_effect(commands) == (ws, CheckinMessage(room_name="ETLC 1-001"))
+
+
+def test_net_effect_of_checkin_then_checkout_leaves_any_room_quietly():
+    ws = FakeWebSocket()
+    _, message = net_effect([
+        (ws, CheckinMessage(room_name="CAB 235")),
+        (ws, CheckoutMessage(room_name="CAB 235", id="c2")),
+    ])
+    assert message == CheckoutMessage(room_name=None, auto=True, id="c2")
+
+    # A lone checkout is left as sent
+    _, message = net_effect([(ws, CheckoutMessage(room_name="CAB 235"))])
+    assert message == CheckoutMessage(room_name="CAB 235")
+
+
+@pytest.mark.asyncio
+async def test_debouncer_runs_first_command_then_net_effect_of_follow_ups():
+    executed = []
+
+    async def execute(websocket, message):
+        executed.append(message)
+        return True
+
+    debouncer = CommandDebouncer(0.01, execute)
+    ws = FakeWebSocket()
+    await debouncer.submit("u1", ws, CheckinMessage(room_name="CAB 235"))
+    await debouncer.submit("u2", ws, CheckoutMessage())
+    # The first command of a window is not delayed
+    assert executed == [CheckinMessage(room_name="CAB 235"), CheckoutMessage()]
+
+    await debouncer.submit("u1", ws, CheckoutMessage(room_name="CAB 235"))
+    await debouncer.submit("u1", ws, CheckinMessage(room_name="ETLC 1-001"))
+    assert len(executed) == 2
+    await asyncio.sleep(0.05)
+    assert executed[2:] == [CheckinMessage(room_name="ETLC 1-001")]
+    assert debouncer.collapsed == 1
+    assert len(debouncer) == 0
+
+    # The window has closed, the next command runs immediately again
+    await debouncer.submit("u1", ws, CheckoutMessage())
+    assert executed[3:] == [CheckoutMessage()]
+
+
+@pytest.mark.asyncio
+async def test_debouncer_drops_commands_of_a_closed_socket():
+    executed = []
+
+    async def execute(websocket, message):
+        executed.append(message)
+        return True
+
+    debouncer = CommandDebouncer(1, execute)
+    tab1, tab2 = FakeWebSocket(), FakeWebSocket()
+    await debouncer.submit("u1", tab1, CheckinMessage(room_name="CAB 235"))
+    await debouncer.submit("u1", tab1, CheckoutMessage())
+    debouncer.discard("u1", tab1)
+    assert len(debouncer) == 0
+
+    await debouncer.submit("u1", tab1, CheckoutMessage())
+    await debouncer.submit("u1", tab2, CheckinMessage(room_name="CAB 235"))
+    debouncer.discard("u1", tab1)
+    await debouncer.flush("u1")
+    assert executed == [CheckinMessage(room_name="CAB 235"), CheckinMessage(room_name="CAB 235")]
+
+
+@pytest.mark.asyncio
+async def test_debouncer_runs_one_users_commands_in_turn():
+    running = []
+    overlaps = []
+
+    async def execute(websocket, message):
+        if running:
+            overlaps.append(message)
+        running.append(message)
+        await asyncio.sleep(0.01)
+        running.remove(message)
+        return True
+
+    debouncer = CommandDebouncer(1, execute)
+    ws = FakeWebSocket()
+    first = asyncio.create_task(debouncer.submit("u1", ws, CheckinMessage(room_name="CAB 235")))
+    await asyncio.sleep(0)
+    await debouncer.submit("u1", ws, CheckoutMessage())
+    await asyncio.gather(first, debouncer.flush("u1"))
+    assert overlaps == []
+
+
+@pytest.mark.asyncio
+async def test_manager_drops_repeated_command_ids(monkeypatch):
+    manager = activity.ConnectionManager(command_debounce_ms=0)
+    ws = FakeWebSocket()
+    manager._register(ws, user_id="u1")
+    handled = []
+    results = [False, True]
+
+    async def fake_handle_checkin(websocket, data):
+        handled.append(data)
+        return results.pop(0) if results else True
+    monkeypatch.setattr(manager, "handle_checkin", fake_handle_checkin)
+
+    message = CheckinMessage(room_name="CAB 235", id="c1")
+    # The first attempt fails, so its retry runs
+    await manager.dispatch(ws, message)
+    await manager.dispatch(ws, message)
+    await manager.dispatch(ws, message)
+    await manager.dispatch(ws, CheckinMessage(room_name="CAB 235"))
+    assert handled == [message, message, CheckinMessage(room_name="CAB 235")]
+    assert manager.stats()["duplicate_commands"] == 1
+
+
+@pytest.mark.asyncio
+async def test_manager_debounces_commands_per_user(monkeypatch):
+    manager = activity.ConnectionManager(command_debounce_ms=1000)
+    ws = FakeWebSocket()
+    manager._register(ws, user_id="u1")
+    handled = []
+
+    async def fake_handle_checkout(websocket, data):
+        handled.append(data)
+        return True
+    async def fake_handle_checkin(websocket, data):
+        handled.append(data)
+        return True
+    monkeypatch.setattr(manager, "handle_checkout", fake_handle_checkout)
+    monkeypatch.setattr(manager, "handle_checkin", fake_handle_checkin)
+
+    await manager.dispatch(ws, CheckinMessage(room_name="CAB 235", id="c1"))
+    assert handled == [CheckinMessage(room_name="CAB 235", id="c1")]
+    await manager.dispatch(ws, CheckoutMessage(room_name="CAB 235", id="c2"))
+    await manager.dispatch(ws, CheckinMessage(room_name="CAB 235", id="c3"))
+    assert len(handled) == 1
+    await manager.debouncer.flush("u1")
+    assert handled[1:] == [CheckinMessage(room_name="CAB 235", id="c3")]
+    # Every command the net effect stood for counts as carried out
+    assert manager.recent_commands.seen("u1", "c2")
+
+
+@pytest.mark.asyncio
+async def test_disconnect_drops_held_commands(monkeypatch):
+    manager = activity.ConnectionManager(command_debounce_ms=1000)
+    ws = FakeWebSocket()
+    manager._register(ws, user_id="u1")
+    handled = []
+
+    async def fake_handle_checkout(websocket, data):
+        handled.append(data)
+        return True
+    monkeypatch.setattr(manager, "handle_checkout", fake_handle_checkout)
+
+    await manager.dispatch(ws, CheckoutMessage())
+    await manager.dispatch(ws, CheckoutMessage())
+    manager.disconnect(ws)
+    await manager.debouncer.flush("u1")
+    assert handled == [CheckoutMessage()]
@@ -0,0 +1,112 @@
+import time
+import asyncio
+
+import pytest
+
+from app.core import activity
+from app.core.connections import Connection, ConnectionRegistry
+from app.tests.test_activity import FakeWebSocket, flush
+
+
+def make_connection(user_id=None):
+    return Connection(FakeWebSocket(), 10, 1.0, activity.JSON_CODEC, user_id)
+
+
+def test_registry_indexes_connections_by_user():
+    registry = ConnectionRegistry()
+    tab1, tab2, other = make_connection("u1"), make_connection("u1"), make_connection("u2")
+    for connection in (tab1, tab2, other):
+        registry.add(connection)
+
+    assert len(registry) == 3
+    assert registry.user_count() == 2
+    assert registry.for_user("u1") == {tab1, tab2}
+    assert registry.get(other.websocket) is other
+
+    assert registry.remove(tab1.websocket) is tab1
+    assert registry.remove(tab1.websocket) is None
+    assert registry.for_user("u1") == {tab2}
+    registry.remove(tab2.websocket)
+    assert registry.user_count() == 1
+    assert tab2.websocket not in registry
+
+
+def test_connection_has_no_instance_dict():
+    assert not hasattr(make_connection(), "__dict__")
+
+
+@pytest.mark.asyncio
+async def test_connection_counts_traffic():
+    manager = activity.ConnectionManager()
+    ws = FakeWebSocket()
+    connection = manager._register(ws, user_id="u1")
+    await manager.send_personal(ws, {"type": "ping"})
+    await manager.send_personal(ws, '{"type":"pong"}')
+    await flush(manager)
+    connection.received(12)
+
+    assert connection.messages_sent == 2
+    assert connection.bytes_sent == len('{"type":"ping"}') + len('{"type":"pong"}')
+    assert connection.messages_received == 1
+    assert connection.bytes_received == 12
+    stats = manager.connections.stats()
+    assert stats["connections"] == 1
+    assert stats["users"] == 1
+    assert stats["messages_sent"] == 2
+
+
+@pytest.mark.asyncio
+async def test_send_to_user_reaches_every_tab():
+    manager = activity.ConnectionManager()
+    tab1, tab2, other = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    manager._register(tab1, user_id="u1")
+    manager._register(tab2, user_id="u1")
+    manager._register(other, user_id="u2")
+
+    await manager.send_to_user("u1", {"type": "notice"})
+    await flush(manager)
+    assert tab1.sent_messages == tab2.sent_messages == [{"type": "notice"}]
+    assert other.sent_messages == []
+
+
+def test_rename_updates_all_tabs():
+    manager = activity.ConnectionManager()
+    connections = [
+        Connection(FakeWebSocket(), 10, 1.0, activity.JSON_CODEC, "u1", "old") for _ in range(2)
+    ]
+    for connection in connections:
+        manager.connections.add(connection)
+
+    manager.rename("u1", "new")
+    assert [connection.username for connection in connections] == ["new", "new"]
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_pings_quiet_clients_and_reaps_idle_ones():
+    manager = activity.ConnectionManager(heartbeat_interval=10, idle_timeout=30)
+    quiet, dead, active = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    manager._register(quiet, user_id="quiet")
+    manager._register(dead, user_id="dead")
+    manager._register(active, user_id="active")
+    now = time.monotonic()
+    manager.connections.get(quiet).last_activity = now - 15
+    manager.connections.get(dead).last_activity = now - 60
+
+    await manager.heartbeat()
+    await flush(manager)
+    await asyncio.sleep(0)
+
+    assert quiet.sent_messages == [{"type": "ping"}]
+    assert active.sent_messages == []
+    assert dead not in manager.connections
+    assert dead.closed
+    assert manager.reaped_count == 1
+    assert manager.evicted_count == 0
+    assert manager.stats()["reaped"] == 1
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_can_be_disabled():
+    manager = activity.ConnectionManager(heartbeat_interval=0)
+    manager.start_heartbeat()
+    assert manager._heartbeat_task is None
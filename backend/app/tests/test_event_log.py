@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from app.core.event_log import ActivityEventWriter
+
+
+class RecordingSession:
+    def __init__(self, batches, fail=False):
+        self.batches = batches
+        self.fail = fail
+
+    async def execute(self, statement, rows):
+        if self.fail:
+            raise RuntimeError("db down")
+        self.batches.append([row["user_id"] for row in rows])
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def row(user_id):
+    return {"type": "checkin", "user_id": user_id, "room_name": "RoomA", "message": "hi"}
+
+
+@pytest.mark.asyncio
+async def test_writer_batches_rows_within_interval():
+    batches = []
+    writer = ActivityEventWriter(lambda: RecordingSession(batches), flush_interval=0.02)
+    writer.start()
+    for user_id in "abc":
+        await writer.add(row(user_id))
+
+    await asyncio.sleep(0.1)
+    await writer.stop()
+
+    assert batches == [["a", "b", "c"]]
+    assert writer.written_count == 3
+
+
+@pytest.mark.asyncio
+async def test_writer_flushes_full_batch_without_waiting():
+    batches = []
+    writer = ActivityEventWriter(lambda: RecordingSession(batches), batch_size=2, flush_interval=10)
+    writer.start()
+    for user_id in "abcd":
+        await writer.add(row(user_id))
+
+    await asyncio.wait_for(writer._queue.join(), timeout=1)
+    await writer.stop()
+
+    assert batches == [["a", "b"], ["c", "d"]]
+
+
+@pytest.mark.asyncio
+async def test_stop_flushes_buffered_rows():
+    batches = []
+    writer = ActivityEventWriter(lambda: RecordingSession(batches), flush_interval=10)
+    writer.start()
+    await writer.add(row("a"))
+    await writer.stop()
+    assert batches == [["a"]]
+
+    # Rows queued without a running writer are written on stop too
+    idle = ActivityEventWriter(lambda: RecordingSession(batches))
+    await idle.add(row("b"))
+    await idle.stop()
+    assert batches == [["a"], ["b"]]
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_counted_and_writer_keeps_running():
+    batches = []
+    sessions = [RecordingSession(batches, fail=True)]
+    writer = ActivityEventWriter(lambda: sessions.pop() if sessions else RecordingSession(batches), flush_interval=0)
+    writer.start()
+    await writer.add(row("a"))
+    await asyncio.wait_for(writer._queue.join(), timeout=1)
+    await writer.add(row("b"))
+    await writer.stop()
+
+    assert writer.failed_count == 1
+    assert batches == [["b"]]
+
+
+@pytest.mark.asyncio
+async def test_add_waits_when_buffer_is_full():
+    writer = ActivityEventWriter(lambda: RecordingSession([]), max_pending=1)
+    await writer.add(row("a"))
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(writer.add(row("b")), timeout=0.05)
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.core import activity
+from app.core.expiry import ExpiryEngine
+from app.models.occupancy import RoomOccupancy
+from app.schemas.websocket import CheckinMessage, CheckoutMessage
+
+
+async def no_op(user_ids):
+    pass
+
+
+def at(seconds_from_now):
+    return datetime.fromtimestamp(time.time() + seconds_from_now)
+
+
+def test_pop_due_returns_only_expired_users():
+    engine = ExpiryEngine(no_op)
+    engine.schedule("a", at(-10))
+    engine.schedule("b", at(-5))
+    engine.schedule("c", at(60))
+
+    assert engine.pop_due(time.time()) == ["a", "b"]
+    assert len(engine) == 1
+
+
+def test_pop_due_respects_batch_size():
+    engine = ExpiryEngine(no_op, batch_size=2)
+    for user_id in "abc":
+        engine.schedule(user_id, at(-1))
+
+    assert len(engine.pop_due(time.time())) == 2
+    assert len(engine.pop_due(time.time())) == 1
+
+
+def test_cancel_and_reschedule_skip_stale_entries():
+    engine = ExpiryEngine(no_op)
+    engine.schedule("a", at(-10))
+    engine.schedule("b", at(-10))
+    engine.cancel("a")
+    # Re-check-in moves b's expiry into the future
+    engine.schedule("b", at(60))
+
+    assert engine.pop_due(time.time()) == []
+    assert engine.next_expiry() == pytest.approx(at(60).timestamp(), abs=1)
+
+
+def test_load_replaces_entries():
+    engine = ExpiryEngine(no_op)
+    engine.schedule("old", at(-1))
+    engine.load([("a", at(30)), ("b", at(10))])
+
+    assert len(engine) == 2
+    assert engine.next_expiry() == pytest.approx(at(10).timestamp(), abs=1)
+
+
+@pytest.mark.asyncio
+async def test_engine_sleeps_until_next_expiry():
+    expired = []
+    done = asyncio.Event()
+
+    async def on_expire(user_ids):
+        expired.extend(user_ids)
+        done.set()
+
+    engine = ExpiryEngine(on_expire)
+    engine.start()
+    engine.schedule("late", at(60))
+    engine.schedule("soon", at(0.05))
+
+    await asyncio.wait_for(done.wait(), timeout=1)
+    await engine.stop()
+
+    assert expired == ["soon"]
+
+
+@pytest.mark.asyncio
+async def test_engine_retries_failed_batch():
+    calls = []
+
+    async def on_expire(user_ids):
+        calls.append(list(user_ids))
+        if len(calls) == 1:
+            raise RuntimeError("db down")
+
+    engine = ExpiryEngine(on_expire, retry_delay=0.01)
+    engine.schedule("a", at(-1))
+    engine.start()
+
+    for _ in range(100):
+        if len(calls) == 2:
+            break
+        await asyncio.sleep(0.01)
+    await engine.stop()
+
+    assert calls == [["a"], ["a"]]
+
+
+@pytest.mark.asyncio
+async def test_checkin_and_checkout_update_engine(monkeypatch):
+    from app.tests.test_activity import FakeDB, FakeQuery, FakeWebSocket
+
+    manager = activity.ConnectionManager()
+    ws = FakeWebSocket()
+    manager._register(ws, user_id="user123", username="testuser")
+
+    fake_db = FakeDB()
+    fake_db.queries[RoomOccupancy] = FakeQuery([])
+    monkeypatch.setattr(manager, "_get_db", lambda: fake_db)
+    await manager.handle_checkin(ws, CheckinMessage(room_name="RoomA"))
+    assert len(manager.expiry) == 1
+
+    now = datetime.now()
+    checkin = RoomOccupancy(
+        user_id="user123",
+        room_name="RoomA",
+        is_active=True,
+        checkin_time=now,
+        expiry_time=now + timedelta(hours=4),
+        username="testuser"
+    )
+    fake_db.queries[RoomOccupancy] = FakeQuery([checkin])
+    await manager.handle_checkout(ws, CheckoutMessage(room_name="RoomA"))
+    assert len(manager.expiry) == 0
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from app.core.forecast import Forecaster, ForecastMatrix
+from app.core.profiles import fit_profiles, weekday_slot
+from app.core.room_directory import RoomDirectory
+from app.tests.test_activity import FakeDB, FakeQuery
+
+MONDAY = datetime(2026, 3, 2)
+
+
+def hour_number(moment):
+    return int(np.datetime64(moment, "h").astype(np.int64))
+
+
+def test_weekday_slot_matches_datetime():
+    moment = datetime(2026, 3, 5, 14)
+    assert weekday_slot(np.array([hour_number(moment)]))[0] == moment.weekday() * 24 + 14
+
+
+def test_profiles_are_decayed_seasonal_averages():
+    start, end = hour_number(MONDAY - timedelta(weeks=2)), hour_number(MONDAY)
+    # Room 0 had 4 people on Monday 14:00 two weeks ago and 2 last week, room 1 had 1 last week
+    hours = np.array([
+        hour_number(MONDAY - timedelta(weeks=2) + timedelta(hours=14)),
+        hour_number(MONDAY - timedelta(weeks=1) + timedelta(hours=14)),
+        hour_number(MONDAY - timedelta(weeks=1) + timedelta(hours=14)),
+    ])
+    rooms, buildings = fit_profiles(
+        np.array([0, 0, 1]), hours, np.array([4.0, 2.0, 1.0]), 2,
+        np.array([0, 0]), 1, start, end, half_life_hours=7 * 24
+    )
+    # The older week weighs half as much
+    assert rooms[0, 0, 14] == pytest.approx((4 * 0.5 + 2) / 1.5)
+    # Weeks without a row count as empty
+    assert rooms[1, 0, 14] == pytest.approx(1 / 1.5)
+    assert buildings[0, 0, 14] == pytest.approx(rooms[0, 0, 14] + rooms[1, 0, 14])
+    assert rooms[0, 1, 14] == 0
+    assert rooms.shape == (2, 7, 24) and rooms.dtype == np.float32
+
+
+@pytest.mark.asyncio
+async def test_refit_builds_a_matrix_from_hourly_rollups():
+    directory = RoomDirectory()
+    directory.load([("CAB 239", "CAB", 53.5, -113.5), ("ETLC 1-001", "ETLC", 53.5, -113.5)])
+    db = FakeDB()
+    statements = []
+
+    async def execute(statement):
+        statements.append(statement)
+        # Occupied every Monday 14:00 for two weeks
+        return FakeQuery([
+            ("CAB 239", 7200, MONDAY - timedelta(weeks=2) + timedelta(hours=14)),
+            ("CAB 239", 7200, MONDAY - timedelta(weeks=1) + timedelta(hours=14)),
+            ("TORY 2-58", 3600, MONDAY - timedelta(weeks=1) + timedelta(hours=14)),
+        ])
+    db.execute = execute
+    forecaster = Forecaster(lambda: db, lambda: MONDAY + timedelta(minutes=30), directory)
+
+    await forecaster.refit()
+    matrix = forecaster.matrix
+    tomorrow_2pm = MONDAY + timedelta(weeks=1, hours=14, minutes=20)
+    assert matrix.building("CAB", tomorrow_2pm) == pytest.approx(2.0)
+    assert matrix.room("CAB 239", tomorrow_2pm) == pytest.approx(2.0)
+    # Listed buildings without history forecast empty, unknown ones have no forecast
+    assert matrix.building("ETLC", tomorrow_2pm) == 0
+    assert matrix.building("TORY", tomorrow_2pm) > 0
+    assert matrix.building("SUB", tomorrow_2pm) is None
+    assert matrix.fitted_at == MONDAY
+    # History started two weeks ago, the rest of the window is not counted
+    assert "bucket_start < " in str(statements[0])
+
+
+def test_matrix_lookup_is_by_weekday_and_hour():
+    profiles = np.zeros((1, 7, 24), dtype=np.float32)
+    profiles[0, 3, 9] = 5
+    matrix = ForecastMatrix(["CAB 239"], ["CAB"], profiles, profiles, MONDAY)
+    assert matrix.building("CAB", datetime(2026, 3, 5, 9, 59)) == 5
+    assert matrix.room("CAB 239", datetime(2026, 3, 5, 10)) == 0
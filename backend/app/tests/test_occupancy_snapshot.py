@@ -0,0 +1,82 @@
+import json
+from datetime import datetime
+
+from fastapi.responses import JSONResponse
+
+from app.core.occupancy_snapshot import OccupancySnapshot, CachedResponse, encode_success
+from app.core.room_directory import RoomDirectory
+from app.models.occupancy import RoomCount
+
+
+def loaded_snapshot(directory=None):
+    snapshot = OccupancySnapshot(directory or RoomDirectory())
+    snapshot.load([
+        RoomCount(room_name="CAB 239", occupant_count=2, last_updated=datetime(2026, 3, 2, 9, 0)),
+        RoomCount(room_name="CAB 345", occupant_count=3, last_updated=datetime(2026, 3, 2, 10, 0)),
+        RoomCount(room_name="ETLC 1-001", occupant_count=0, last_updated=datetime(2026, 3, 2, 8, 0)),
+    ])
+    return snapshot
+
+
+def test_encoding_matches_json_response():
+    data = [{"room_name": "CAB 239", "occupant_count": 2, "note": "café"}]
+    expected = JSONResponse(content={"status": True, "message": "ok", "data": data}).body
+    assert encode_success("ok", data) == expected
+
+
+def test_responses_are_built_once_per_change():
+    snapshot = loaded_snapshot()
+    rooms = snapshot.rooms_response()
+    assert snapshot.rooms_response() is rooms
+    assert [room["room_name"] for room in json.loads(rooms.body)["data"]] == ["CAB 239", "CAB 345"]
+
+    buildings = json.loads(snapshot.buildings_response().body)["data"]
+    assert buildings == [{
+        "building_name": "CAB", "occupant_count": 5, "last_updated": "2026-03-02T10:00:00",
+        "latitude": None, "longitude": None
+    }]
+    assert snapshot.builds == 2
+
+    # Events without a count (e.g. presence) leave the cache alone
+    snapshot.apply({"type": "connection", "user_id": "u1", "timestamp": "2026-03-02T11:00:00-07:00"})
+    assert snapshot.rooms_response() is rooms
+
+    snapshot.apply({"type": "checkin", "room_name": "ETLC 1-001", "timestamp": "2026-03-02T11:00:00-07:00", "current_occupancy": 1})
+    updated = snapshot.rooms_response()
+    assert updated.etag != rooms.etag
+    assert json.loads(updated.body)["data"][-1] == {
+        "room_name": "ETLC 1-001", "occupant_count": 1, "last_updated": "2026-03-02T11:00:00"
+    }
+
+
+def test_if_none_match_comparison():
+    cached = CachedResponse(b"{}")
+    assert cached.matches(cached.etag)
+    assert cached.matches(f'"stale", W/{cached.etag}')
+    assert cached.matches("*")
+    assert not cached.matches('"stale"')
+    assert not cached.matches(None)
+
+
+def test_buildings_are_grouped_through_the_directory():
+    directory = RoomDirectory()
+    directory.load([
+        ("CAB 239", "CAB", 53.5267, -113.5248),
+        ("ETLC 1-001", "ETLC", 53.5273, -113.5291),
+    ])
+    snapshot = loaded_snapshot(directory)
+    snapshot.apply({"type": "checkin", "room_name": "ETLC 1-001", "timestamp": "2026-03-02T11:00:00-07:00", "current_occupancy": 1})
+    snapshot.apply({"type": "checkin", "room_name": "Library", "timestamp": "2026-03-02T11:00:00-07:00", "current_occupancy": 4})
+
+    buildings = json.loads(snapshot.buildings_response().body)["data"]
+    # CAB 345 is not listed but its prefix is, an unknown building keeps no coordinates
+    assert [(b["building_name"], b["occupant_count"], b["latitude"]) for b in buildings] == [
+        ("CAB", 5, 53.5267), ("ETLC", 1, 53.5273), ("Library", 4, None)
+    ]
+
+    # Reloading the directory rebuilds the buildings response
+    cached = snapshot.buildings_response()
+    directory.load([("CAB 239", "CAB", 53.5, -113.5)])
+    rebuilt = json.loads(snapshot.buildings_response().body)["data"]
+    assert snapshot.buildings_response() is not cached
+    assert rebuilt[0]["latitude"] == 53.5
@@ -0,0 +1,95 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+from jose import jwt
+from sqlalchemy import inspect
+
+from app.core import auth
+from app.core.config import settings
+from app.core.principal_cache import PrincipalCache
+from app.models.user import User
+from app.routes import user as user_routes
+from app.schemas.user import UserUpdate
+
+
+def make_user(email="cached@ualberta.ca"):
+    return User(id=uuid.uuid4(), email=email, username="cached", password="hash", active=True)
+
+
+def make_token(email):
+    payload = {"sub": email, "exp": datetime.now(timezone.utc) + timedelta(minutes=5)}
+    return jwt.encode(payload, settings.secret_key, algorithm=settings.algorithm)
+
+
+def test_hit_returns_detached_copy():
+    cache = PrincipalCache()
+    user = make_user()
+    cache.put(user)
+
+    first = cache.get(user.email)
+    second = cache.get(user.email)
+    assert first is not second
+    assert first.id == user.id and first.username == "cached"
+    assert inspect(first).detached
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 0
+
+
+def test_miss_expiry_and_invalidate():
+    cache = PrincipalCache(ttl=0)
+    user = make_user()
+    cache.put(user)
+    assert cache.get(user.email) is None
+    assert len(cache) == 0
+
+    cache = PrincipalCache()
+    cache.put(user)
+    cache.invalidate(user.email)
+    assert cache.get(user.email) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PrincipalCache(maxsize=2)
+    a, b, c = make_user("a@ualberta.ca"), make_user("b@ualberta.ca"), make_user("c@ualberta.ca")
+    cache.put(a)
+    cache.put(b)
+    cache.get(a.email)
+    cache.put(c)
+
+    assert cache.get(b.email) is None
+    assert cache.get(a.email) is not None
+    assert cache.get(c.email) is not None
+
+
+def test_get_active_user_skips_lookup_on_hit(monkeypatch):
+    cache = PrincipalCache()
+    monkeypatch.setattr(auth, "principal_cache", cache)
+    user = make_user()
+    lookups = []
+    def fake_filter_query(db, model, filters):
+        lookups.append(model)
+        return [user]
+    monkeypatch.setattr(auth, "filter_query", fake_filter_query)
+
+    token = make_token(user.email)
+    assert auth.get_active_user(token, db=MagicMock()) is user
+    cached = auth.get_active_user(token, db=MagicMock())
+
+    assert cached.id == user.id
+    assert lookups == [User]
+    assert cache.stats() == {"size": 1, "maxsize": 1024, "ttl": 60.0, "hits": 1, "misses": 1}
+
+
+def test_update_user_invalidates_entry(monkeypatch):
+    cache = PrincipalCache()
+    monkeypatch.setattr(user_routes, "principal_cache", cache)
+    user = make_user()
+    cache.put(user)
+    monkeypatch.setattr(user_routes, "filter_query", lambda db, model, filters: [user] if len(filters) == 1 else [])
+
+    response = user_routes.update_user(UserUpdate(username="renamed"), db=MagicMock(), current_user=user)
+
+    assert response.status_code == 200
+    assert len(cache) == 0
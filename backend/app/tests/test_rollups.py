@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.core.rollups import RollupAccumulator, OccupancyRollups, bucket_start
+from app.models.occupancy import OccupancyRollup, RoomCount
+from app.tests.test_activity import FakeDB, FakeQuery
+
+T0 = datetime(2026, 3, 2, 9, 58)
+
+
+def rows_by_key(rows):
+    return {(row["resolution"], row["room_name"], row["bucket_start"]): (row["occupied_seconds"], row["peak"]) for row in rows}
+
+
+def test_bucket_start_aligns_to_local_midnight():
+    moment = datetime(2026, 3, 2, 13, 47, 12)
+    assert bucket_start(moment, 300) == datetime(2026, 3, 2, 13, 45)
+    assert bucket_start(moment, 3600) == datetime(2026, 3, 2, 13, 0)
+    assert bucket_start(moment, 86400) == datetime(2026, 3, 2)
+
+
+def test_counts_are_integrated_into_every_resolution():
+    accumulator = RollupAccumulator()
+    accumulator.record("CAB 239", 2, T0)
+    accumulator.record("CAB 239", 1, T0 + timedelta(minutes=4))
+    rows = rows_by_key(accumulator.collect(T0 + timedelta(minutes=6)))
+
+    # 2 occupants for 2 minutes before 10:00, then 2 for 2 minutes and 1 for 2 minutes after it
+    assert rows[(300, "CAB 239", datetime(2026, 3, 2, 9, 55))] == (240, 2)
+    assert rows[(300, "CAB 239", datetime(2026, 3, 2, 10, 0))] == (360, 2)
+    assert rows[(3600, "CAB 239", datetime(2026, 3, 2, 9, 0))] == (240, 2)
+    assert rows[(3600, "CAB 239", datetime(2026, 3, 2, 10, 0))] == (360, 2)
+    assert rows[(86400, "CAB 239", datetime(2026, 3, 2))] == (600, 2)
+
+
+def test_collect_returns_changed_rows_and_forgets_ended_buckets():
+    accumulator = RollupAccumulator()
+    accumulator.record("CAB 239", 1, T0)
+    accumulator.record("CAB 239", 0, T0 + timedelta(minutes=1))
+    assert len(accumulator.collect(T0 + timedelta(minutes=1))) == 3
+    accumulator.written(T0 + timedelta(minutes=10))
+    assert accumulator.collect(T0 + timedelta(minutes=20)) == []
+    assert accumulator.rooms == {}
+    # The day is still open
+    assert list(accumulator.buckets) == [(86400, "CAB 239", datetime(2026, 3, 2))]
+    accumulator.written(datetime(2026, 3, 3))
+    assert accumulator.buckets == {}
+
+
+def test_failed_rows_are_collected_again():
+    accumulator = RollupAccumulator()
+    accumulator.record("CAB 239", 1, T0)
+    rows = accumulator.collect(T0 + timedelta(minutes=1))
+    accumulator.failed(rows)
+    accumulator.written(T0 + timedelta(days=2))
+    assert rows_by_key(accumulator.collect(T0 + timedelta(minutes=1))) == rows_by_key(rows)
+
+
+def test_load_continues_stored_buckets():
+    accumulator = RollupAccumulator()
+    stored = OccupancyRollup(resolution=3600, room_name="CAB 239", bucket_start=datetime(2026, 3, 2, 9), occupied_seconds=1000, peak=3)
+    accumulator.load({"CAB 239": 1}, T0, [stored])
+    rows = rows_by_key(accumulator.collect(T0 + timedelta(minutes=1)))
+    assert rows[(3600, "CAB 239", datetime(2026, 3, 2, 9))] == (1060, 3)
+
+
+def test_workers_seeing_the_same_events_compute_the_same_rows():
+    events = [("CAB 239", 1, T0), ("CAB 239", 3, T0 + timedelta(seconds=90)), ("ETLC 1-001", 1, T0 + timedelta(minutes=3))]
+    first, second = RollupAccumulator(), RollupAccumulator()
+    for room_name, count, at in events:
+        first.record(room_name, count, at)
+    # The other worker flushes at a different moment in between
+    second.record(*events[0])
+    second.collect(T0 + timedelta(seconds=30))
+    for event in events[1:]:
+        second.record(*event)
+    end = T0 + timedelta(minutes=8)
+    first_rows = rows_by_key(first.collect(end))
+    second_rows = rows_by_key(second.collect(end))
+    assert first_rows == second_rows
+
+
+@pytest.mark.asyncio
+async def test_flush_upserts_changed_buckets():
+    db = FakeDB()
+    statements = []
+
+    async def execute(statement, rows=None):
+        statements.append((statement, rows))
+        return FakeQuery([])
+    db.execute = execute
+    now = [T0]
+    rollups = OccupancyRollups(lambda: db, lambda: now[0], retention_days={300: 14})
+    await rollups.load(db, [RoomCount(room_name="CAB 239", occupant_count=2)])
+    now[0] = T0 + timedelta(minutes=1)
+    await rollups.flush()
+
+    upsert, rows = statements[1]
+    assert len(rows) == 3 and all(row["occupied_seconds"] == 120 for row in rows)
+    assert rollups.written_count == 3
+    # Retention is applied on the first flush
+    assert "DELETE FROM occupancy_rollups" in str(statements[2][0])
+    sql = str(upsert.compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (resolution, room_name, bucket_start) DO UPDATE" in sql
+    assert "greatest(occupancy_rollups.occupied_seconds, excluded.occupied_seconds)" in sql
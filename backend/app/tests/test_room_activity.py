@@ -0,0 +1,85 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.core import activity
+from app.core.room_activity import RoomActivity
+from app.models.occupancy import ActivityEvent
+from app.tests.test_activity import FakeDB, FakeQuery
+
+
+def stored_event(room_name, minutes_ago, type="checkin"):
+    return ActivityEvent(
+        id=uuid.uuid4(),
+        type=type,
+        user_id="u1",
+        username="user",
+        room_name=room_name,
+        study_topic=None,
+        timestamp=datetime(2026, 3, 2, 12, 0) - timedelta(minutes=minutes_ago),
+        message=f"{type} {minutes_ago}"
+    )
+
+
+def test_recent_serves_newest_first_within_retention():
+    rooms = RoomActivity(size=3)
+    assert rooms.recent("CAB 235", 1) is None
+
+    rooms.load([stored_event("CAB 235", minutes) for minutes in range(5)] + [stored_event("ETLC 1-001", 0)])
+    assert [event["message"] for event in rooms.recent("CAB 235", 3)] == ["checkin 0", "checkin 1", "checkin 2"]
+    assert rooms.recent("CAB 235", 4) is None
+    assert rooms.recent("TORY 2-58", 3) == []
+    assert rooms.recent("ETLC 1-001", 3)[0]["timestamp"] == "2026-03-02T12:00:00"
+
+
+def test_apply_keeps_rings_bounded_and_in_stored_format():
+    rooms = RoomActivity(size=2)
+    rooms.load([])
+    for n in range(3):
+        rooms.apply({
+            "type": "checkout",
+            "user_id": "u1",
+            "room_name": "CAB 235",
+            "timestamp": f"2026-03-02T12:0{n}:00-07:00",
+            "message": f"checkout {n}",
+            "current_occupancy": 0
+        })
+    rooms.apply({"type": "connection", "user_id": "u1", "timestamp": "2026-03-02T12:00:00-07:00"})
+
+    assert rooms.recent("CAB 235", 2) == [
+        {"type": "checkout", "username": None, "study_topic": None, "timestamp": "2026-03-02T12:02:00", "message": "checkout 2"},
+        {"type": "checkout", "username": None, "study_topic": None, "timestamp": "2026-03-02T12:01:00", "message": "checkout 1"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_manager_warms_and_feeds_room_activity():
+    manager = activity.ConnectionManager()
+    db = FakeDB()
+    statements = []
+    execute = db.execute
+
+    async def recording_execute(statement):
+        statements.append(statement)
+        if "row_number" in str(statement):
+            return FakeQuery([stored_event("CAB 235", 1)])
+        return await execute(statement)
+    db.execute = recording_execute
+    manager._get_db = lambda: db
+
+    await manager._load_history()
+    assert manager.room_activity.loaded
+    sql = str(statements[-1].compile(dialect=postgresql.dialect()))
+    assert "PARTITION BY activity_events.room_name" in sql
+
+    await manager.broadcast({
+        "type": "checkout",
+        "user_id": "u2",
+        "room_name": "CAB 235",
+        "timestamp": "2026-03-02T12:05:00-07:00",
+        "message": "left",
+        "current_occupancy": 0
+    })
+    assert [event["message"] for event in manager.room_activity.recent("CAB 235", 2)] == ["left", "checkin 1"]
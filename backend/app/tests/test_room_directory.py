@@ -0,0 +1,54 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.core import activity
+from app.core.room_directory import RoomDirectory, ROOMS_RELOADED
+from app.tests.test_activity import FakeDB, FakeQuery
+
+
+def test_directory_maps_rooms_to_numbered_buildings():
+    directory = RoomDirectory()
+    assert directory.building_for("CAB 239") == "CAB"
+
+    directory.load([
+        ("CAB 239", "CAB", Decimal("53.526700"), Decimal("-113.524800")),
+        ("CAB 345", "CAB", Decimal("53.526700"), Decimal("-113.524800")),
+        ("Van Vliet Pool", "VVC", Decimal("53.524000"), Decimal("-113.527000")),
+    ])
+    assert len(directory) == 2
+    assert directory.index_for("CAB 345") == directory.index_for("CAB 239") == 0
+    assert directory.building_for("Van Vliet Pool") == "VVC"
+    assert directory.coordinates[1] == (53.524, -113.527)
+    # Unlisted rooms fall back to their prefix, and to that building's index if it is listed
+    assert directory.index_for("CAB 999") == 0
+    assert directory.index_for("TORY 2-58") is None
+    assert directory.building_for("TORY 2-58") == "TORY"
+
+
+@pytest.mark.asyncio
+async def test_manager_loads_directory_and_reloads_on_notice(monkeypatch):
+    monkeypatch.setattr(activity, "room_directory", RoomDirectory())
+    manager = activity.ConnectionManager()
+    db = FakeDB()
+    statements = []
+
+    async def execute(statement):
+        statements.append(statement)
+        return FakeQuery([("CAB 239", "CAB", 53.5, -113.5)])
+    db.execute = execute
+    manager._get_db = lambda: db
+
+    await manager.load_room_directory()
+    assert activity.room_directory.building_for("CAB 239") == "CAB"
+    sql = str(statements[0].compile(dialect=postgresql.dialect()))
+    assert "JOIN buildings ON rooms.building_id = buildings.id" in sql
+
+    manager._on_remote_event({"type": ROOMS_RELOADED})
+    for task in list(manager._background):
+        await task
+    assert len(statements) == 2
+    assert activity.room_directory.version == 2
+    # The notice itself is not an event for clients
+    assert manager.seq == 0
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta, timezone
 
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, AsyncMock
 
 from jose import jwt
 
@@ -18,7 +18,7 @@ from app.core.auth import (
     verify_password
 )
 from app.core.config import settings
-from app.core.database import get_db, Base
+from app.core.database import get_db, get_async_db, Base
 from app.models.user import User, Program
 from app.models.building import Room, UserFavoriteRoom
 from app.models.occupancy import RoomCount, RoomOccupancy, ActivityEvent
@@ -43,8 +43,34 @@ def override_get_db():
     fake_db = MagicMock()
     yield fake_db
 
+def override_get_async_db():
+    """Default get_async_db override, every query returns no rows."""
+    yield fake_async_db(lambda statement: [])
+
+def fake_async_db(rows_for):
+    """
+    AsyncSession stand-in: execute() returns a result holding rows_for(statement),
+    readable through .scalars().all()/.first() or .all().
+    """
+    def execute(statement, *args, **kwargs):
+        rows = rows_for(statement)
+        result = MagicMock()
+        result.all.return_value = rows
+        result.scalars.return_value.all.return_value = rows
+        result.scalars.return_value.first.return_value = rows[0] if rows else None
+        return result
+
+    fake_db = MagicMock()
+    fake_db.execute = AsyncMock(side_effect=execute)
+    return fake_db
+
+def selected_table(statement):
+    """Table name of the model a select statement reads"""
+    return statement.column_descriptions[0]["entity"].__tablename__
+
 app.dependency_overrides[get_active_user] = override_get_active_user
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 client = TestClient(app)
 
@@ -837,19 +863,12 @@ def test_room_demographics_no_active_checkins(monkeypatch):
     Test a scenario where there are no active checkins for the specified room.
     We expect the code to return an empty list and a success message.
     """
-    def mock_query(model):
-        mock_q = MagicMock()
-        if model.__tablename__ == "room_occupancy":
-            # Return [] to simulate no active checkins
-            mock_q.filter.return_value.all.return_value = []
-        return mock_q
-
-    fake_db = MagicMock()
-    fake_db.query.side_effect = mock_query
-    app.dependency_overrides[get_db] = lambda: fake_db
+    # Every query returns [] to simulate no active checkins
+    fake_db = fake_async_db(lambda statement: [])
+    app.dependency_overrides[get_async_db] = lambda: fake_db
 
     response = client.get("/rooms/CAB 239/demographics")
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
 
     assert response.status_code == 200, response.text
     data = response.json()
@@ -886,27 +905,19 @@ def test_room_demographics_with_active_checkins(monkeypatch):
         program_id=fake_program.id
     )
 
-    def mock_query(*args, **kwargs):
-        # If more than one argument is given, we're likely selecting multiple columns.
-        if len(args) > 1:
-            fake_obj = MagicMock()
-            fake_obj.join.return_value.filter.return_value.all.return_value = [
-                (user_with_program.id, fake_program.name)
-            ]
-            return fake_obj
-        else:
-            model = args[0]
-            mock_q = MagicMock()
-            if hasattr(model, "__tablename__") and model.__tablename__ == "room_occupancy":
-                mock_q.filter.return_value.all.return_value = [active_checkin]
-            return mock_q
+    def mock_execute(statement):
+        # If more than one column is selected, it's the user/program lookup.
+        if len(statement.column_descriptions) > 1:
+            return [(user_with_program.id, fake_program.name)]
+        if selected_table(statement) == "room_occupancy":
+            return [active_checkin]
+        return []
 
-    fake_db = MagicMock()
-    fake_db.query.side_effect = mock_query
-    app.dependency_overrides[get_db] = lambda: fake_db
+    fake_db = fake_async_db(mock_execute)
+    app.dependency_overrides[get_async_db] = lambda: fake_db
 
     response = client.get("/rooms/CAB 239/demographics")
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
 
     assert response.status_code == 200, response.text
     data = response.json()
@@ -934,19 +945,17 @@ def test_get_occupancy_rooms(monkeypatch):
         last_updated=datetime.now()
     )
 
-    def mock_query(model):
-        mock_q = MagicMock()
-        if model.__tablename__ == "room_counts":
+    def mock_execute(statement):
+        if selected_table(statement) == "room_counts":
             # Return a list with one RoomCount that has occupant_count=2
-            mock_q.filter.return_value.all.return_value = [fake_room_count]
-        return mock_q
+            return [fake_room_count]
+        return []
 
-    fake_db = MagicMock()
-    fake_db.query.side_effect = mock_query
+    fake_db = fake_async_db(mock_execute)
 
-    app.dependency_overrides[get_db] = lambda: fake_db
+    app.dependency_overrides[get_async_db] = lambda: fake_db
     response = client.get("/api/occupancy/rooms")
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
 
     assert response.status_code == 200, response.text
     data = response.json()
@@ -977,21 +986,19 @@ def test_get_occupancy_buildings(monkeypatch):
         last_updated=datetime.now()
     )
 
-    def mock_query(model):
-        mock_q = MagicMock()
-        if model.__tablename__ == "room_counts":
-            mock_q.filter.return_value.all.return_value = [
+    def mock_execute(statement):
+        if selected_table(statement) == "room_counts":
+            return [
                 fake_room_count_1,
                 fake_room_count_2
             ]
-        return mock_q
+        return []
 
-    fake_db = MagicMock()
-    fake_db.query.side_effect = mock_query
+    fake_db = fake_async_db(mock_execute)
 
-    app.dependency_overrides[get_db] = lambda: fake_db
+    app.dependency_overrides[get_async_db] = lambda: fake_db
     response = client.get("/api/occupancy/buildings")
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
 
     assert response.status_code == 200, response.text
     data = response.json()
@@ -1003,6 +1010,44 @@ def test_get_occupancy_buildings(monkeypatch):
     assert data["data"][0]["occupant_count"] == 5
 
 
+def test_get_occupancy_served_from_snapshot_with_etag(monkeypatch):
+    """
+    Once the room counts are loaded, both endpoints are served from memory,
+    and a poll naming the current ETag gets 304 until a count changes.
+    """
+    from app.core.activity import manager as activity_manager
+    from app.core.occupancy_snapshot import OccupancySnapshot
+    from app.core.room_directory import RoomDirectory
+
+    snapshot = OccupancySnapshot(RoomDirectory())
+    snapshot.load([RoomCount(room_name="CAB 239", occupant_count=2, last_updated=datetime.now())])
+    monkeypatch.setattr(activity_manager, "occupancy", snapshot)
+
+    queried = []
+    fake_db = fake_async_db(lambda statement: queried.append(statement) or [])
+    app.dependency_overrides[get_async_db] = lambda: fake_db
+    first = client.get("/api/occupancy/buildings")
+    etag = first.headers["etag"]
+    unchanged = client.get("/api/occupancy/buildings", headers={"If-None-Match": etag})
+    snapshot.apply({
+        "type": "checkin",
+        "room_name": "CAB 239",
+        "timestamp": datetime.now().isoformat(),
+        "current_occupancy": 3
+    })
+    changed = client.get("/api/occupancy/buildings", headers={"If-None-Match": etag})
+    app.dependency_overrides[get_async_db] = override_get_async_db
+
+    assert first.status_code == 200, first.text
+    assert first.json()["data"][0]["occupant_count"] == 2
+    assert unchanged.status_code == 304
+    assert unchanged.content == b""
+    assert changed.status_code == 200
+    assert changed.json()["data"][0]["occupant_count"] == 3
+    assert changed.headers["etag"] != etag
+    assert queried == []
+
+
 # ---------------------------
 # GET /api/occupancy/room/{room_name}
 # ---------------------------
@@ -1026,20 +1071,18 @@ def test_get_occupancy_room(monkeypatch):
         expiry_time=datetime.now() + timedelta(minutes=50),
     )
 
-    def mock_query(model):
-        mock_q = MagicMock()
-        if model.__tablename__ == "room_counts":
-            mock_q.filter.return_value.first.return_value = fake_room_count
-        elif model.__tablename__ == "room_occupancy":
-            mock_q.filter.return_value.all.return_value = [fake_room_occupancy]
-        return mock_q
+    def mock_execute(statement):
+        if selected_table(statement) == "room_counts":
+            return [fake_room_count]
+        elif selected_table(statement) == "room_occupancy":
+            return [fake_room_occupancy]
+        return []
 
-    fake_db = MagicMock()
-    fake_db.query.side_effect = mock_query
+    fake_db = fake_async_db(mock_execute)
 
-    app.dependency_overrides[get_db] = lambda: fake_db
+    app.dependency_overrides[get_async_db] = lambda: fake_db
     response = client.get("/api/occupancy/room/CAB 239")
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
 
     assert response.status_code == 200, response.text
     data = response.json()
@@ -1069,18 +1112,16 @@ def test_get_occupancy_activity(monkeypatch):
         message="User checked in"
     )
 
-    def mock_query(model):
-        mock_q = MagicMock()
-        if model.__tablename__ == "activity_events":
-            mock_q.filter.return_value.order_by.return_value.limit.return_value.all.return_value = [fake_activity]
-        return mock_q
+    def mock_execute(statement):
+        if selected_table(statement) == "activity_events":
+            return [fake_activity]
+        return []
 
-    fake_db = MagicMock()
-    fake_db.query.side_effect = mock_query
+    fake_db = fake_async_db(mock_execute)
 
-    app.dependency_overrides[get_db] = lambda: fake_db
+    app.dependency_overrides[get_async_db] = lambda: fake_db
     response = client.get("/api/occupancy/activity/CAB 239")
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
 
     assert response.status_code == 200, response.text
     data = response.json()
@@ -1092,6 +1133,178 @@ def test_get_occupancy_activity(monkeypatch):
     assert data["data"][0]["study_topic"] == "Calculus"
 
 
+def test_get_occupancy_activity_from_memory(monkeypatch):
+    """
+    Recent room activity is served from the in-memory ring, and only a
+    limit larger than the ring goes to the database.
+    """
+    from app.core.activity import manager as activity_manager
+    from app.core.room_activity import RoomActivity
+
+    rooms = RoomActivity(size=5)
+    rooms.load([])
+    rooms.apply({
+        "type": "checkin",
+        "user_id": "test_user_id",
+        "username": "test_user",
+        "room_name": "CAB 239",
+        "study_topic": "Calculus",
+        "timestamp": "2026-03-02T12:00:00-07:00",
+        "message": "User checked in"
+    })
+    monkeypatch.setattr(activity_manager, "room_activity", rooms)
+
+    queried = []
+    fake_db = fake_async_db(lambda statement: queried.append(statement) or [])
+    app.dependency_overrides[get_async_db] = lambda: fake_db
+    response = client.get("/api/occupancy/activity/CAB 239?limit=5")
+    larger = client.get("/api/occupancy/activity/CAB 239?limit=6")
+    app.dependency_overrides[get_async_db] = override_get_async_db
+
+    assert response.status_code == 200, response.text
+    assert response.json()["data"] == [{
+        "type": "checkin",
+        "username": "test_user",
+        "study_topic": "Calculus",
+        "timestamp": "2026-03-02T12:00:00",
+        "message": "User checked in"
+    }]
+    assert larger.json()["data"] == []
+    assert len(queried) == 1
+
+
+
+# ---------------------------
+# GET /api/occupancy/history
+# ---------------------------
+
+def test_get_occupancy_history(monkeypatch):
+    """
+    History is read with one range query and grouped into a series per room.
+    """
+    from app.models.occupancy import OccupancyRollup
+
+    rows = [
+        OccupancyRollup(resolution=3600, room_name="CAB 239", bucket_start=datetime(2026, 3, 2, 9), occupied_seconds=5400, peak=2),
+        OccupancyRollup(resolution=3600, room_name="CAB 239", bucket_start=datetime(2026, 3, 2, 10), occupied_seconds=3600, peak=1),
+    ]
+    statements = []
+
+    def mock_execute(statement):
+        statements.append(statement)
+        return rows if selected_table(statement) == "occupancy_rollups" else []
+
+    fake_db = fake_async_db(mock_execute)
+    app.dependency_overrides[get_async_db] = lambda: fake_db
+    response = client.get("/api/occupancy/history", params={
+        "resolution": "1h",
+        "room": "CAB 239",
+        "start": "2026-03-02T09:30:00",
+        "end": "2026-03-02T11:00:00"
+    })
+    invalid = client.get("/api/occupancy/history", params={"resolution": "1w"})
+    too_long = client.get("/api/occupancy/history", params={
+        "resolution": "5m", "start": "2026-01-01T00:00:00", "end": "2026-03-01T00:00:00"
+    })
+    app.dependency_overrides[get_async_db] = override_get_async_db
+
+    assert response.status_code == 200, response.text
+    data = response.json()["data"]
+    assert data["rooms"] == {"CAB 239": [["2026-03-02T09:00:00", 1.5, 2], ["2026-03-02T10:00:00", 1.0, 1]]}
+    assert len(statements) == 1
+    # The partly covered first bucket is included
+    assert statements[0].compile().params["bucket_start_1"] == datetime(2026, 3, 2, 9)
+    assert invalid.status_code == 400
+    assert too_long.status_code == 400
+
+
+
+# ---------------------------
+# POST /api/occupancy/rooms/details
+# ---------------------------
+
+def test_get_room_details(monkeypatch):
+    """
+    Counts, occupants and demographics of several rooms come from three queries.
+    """
+    from app.core.room_directory import room_directory
+
+    now = datetime.now()
+    checkin = RoomOccupancy(
+        user_id="u1",
+        username="alice",
+        room_name="CAB 239",
+        study_topic="Math",
+        checkin_time=now,
+        expiry_time=now + timedelta(hours=1),
+        is_active=True
+    )
+
+    def mock_execute(statement):
+        if selected_table(statement) == "room_counts":
+            return [RoomCount(room_name="CAB 239", occupant_count=1, last_updated=now)]
+        if len(statement.column_descriptions) == 3:
+            # (room_name, program, users) grouped rows
+            return [("CAB 239", "Computing Science", 1), ("CAB 239", None, 2)]
+        return [checkin]
+
+    fake_db = fake_async_db(mock_execute)
+    monkeypatch.setattr(room_directory, "index_by_name", {"CAB": 0})
+    monkeypatch.setattr(room_directory, "index_by_room", {"CAB 239": 0, "CAB 345": 0})
+
+    app.dependency_overrides[get_async_db] = lambda: fake_db
+    response = client.post("/api/occupancy/rooms/details", json={"rooms": ["CAB 239", "CAB 345", "CAB 239"]})
+    by_building = client.post("/api/occupancy/rooms/details", json={"building": "CAB"})
+    unknown = client.post("/api/occupancy/rooms/details", json={"building": "SUB"})
+    missing = client.post("/api/occupancy/rooms/details", json={})
+    app.dependency_overrides[get_async_db] = override_get_async_db
+
+    assert response.status_code == 200, response.text
+    rooms = response.json()["data"]
+    assert [room["room_name"] for room in rooms] == ["CAB 239", "CAB 345"]
+    assert rooms[0]["occupant_count"] == 1
+    assert rooms[0]["occupants"][0]["username"] == "alice"
+    assert rooms[0]["demographics"] == {"Computing Science": 1, "Undeclared": 2}
+    assert rooms[1] == {
+        "room_name": "CAB 345",
+        "occupant_count": 0,
+        "last_updated": None,
+        "occupants": [],
+        "demographics": {}
+    }
+    assert by_building.json()["data"] == rooms
+    assert fake_db.execute.await_count == 6
+    assert unknown.status_code == 404
+    assert missing.status_code == 400
+
+# ---------------------------
+# GET /api/occupancy/forecast
+# ---------------------------
+
+def test_get_occupancy_forecast(monkeypatch):
+    """
+    The forecast is read from the fitted matrix for the weekday and hour asked for.
+    """
+    import numpy as np
+    from app.core.forecast import forecaster, ForecastMatrix
+
+    monkeypatch.setattr(forecaster, "matrix", None)
+    assert client.get("/api/occupancy/forecast", params={"building": "CAB"}).status_code == 503
+
+    profiles = np.zeros((1, 7, 24), dtype=np.float32)
+    profiles[0, 1, 14] = 12.345
+    monkeypatch.setattr(forecaster, "matrix", ForecastMatrix(["CAB 239"], ["CAB"], profiles, profiles, datetime(2026, 3, 2)))
+    response = client.get("/api/occupancy/forecast", params={"building": "CAB", "at": "2026-03-03T14:30:00"})
+    unknown = client.get("/api/occupancy/forecast", params={"building": "SUB"})
+    missing = client.get("/api/occupancy/forecast")
+
+    assert response.status_code == 200, response.text
+    data = response.json()["data"]
+    assert data["expected_occupancy"] == 12.35
+    assert data["slot_start"] == "2026-03-03T14:00:00"
+    assert unknown.status_code == 404
+    assert missing.status_code == 400
+
 # =============================================================================
 # HEALTH ENDPOINTS
 # =============================================================================
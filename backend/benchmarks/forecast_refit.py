@@ -0,0 +1,80 @@
+"""
+Time to refit the occupancy forecast for the whole campus: every room in
+processed_classroom_availability.json, with hourly history for the given
+number of days, and the cost of one forecast lookup afterwards.
+
+    python benchmarks/forecast_refit.py --days 56 --busy 0.3
+"""
+import argparse
+import json
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.core.profiles import fit_profiles  # noqa: E402
+
+SCHEDULE = Path(__file__).resolve().parents[1] / "room_program_data" / "processed_classroom_availability.json"
+
+
+def campus():
+    """(room names, building index of every room, building count)"""
+    with open(SCHEDULE, encoding="utf-8") as file:
+        buildings = json.load(file)
+    rooms, building_of_room = [], []
+    for index, details in enumerate(buildings.values()):
+        for room_name in details["rooms"]:
+            rooms.append(room_name)
+            building_of_room.append(index)
+    return rooms, np.array(building_of_room, dtype=np.int64), len(buildings)
+
+
+def history(rooms: int, days: int, busy: float, rng):
+    """Hourly rollup rows: a room is occupied in a fraction `busy` of daytime hours"""
+    end_hour = int(np.datetime64(datetime(2026, 3, 2), "h").astype(np.int64))
+    start_hour = end_hour - days * 24
+    hours = np.arange(start_hour, end_hour, dtype=np.int64)
+    daytime = hours[(hours % 24 >= 8) & (hours % 24 < 22)]
+    room_index = np.repeat(np.arange(rooms), len(daytime))
+    row_hours = np.tile(daytime, rooms)
+    keep = rng.random(len(row_hours)) < busy
+    averages = rng.gamma(2.0, 2.0, keep.sum())
+    return room_index[keep], row_hours[keep], averages, start_hour, end_hour
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=56)
+    parser.add_argument("--busy", type=float, default=0.3)
+    parser.add_argument("--half-life-days", type=float, default=14.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    rooms, building_of_room, buildings = campus()
+    room_index, hours, averages, start_hour, end_hour = history(len(rooms), args.days, args.busy, rng)
+
+    def refit():
+        return fit_profiles(
+            room_index, hours, averages, len(rooms), building_of_room, buildings,
+            start_hour, end_hour, args.half_life_days * 24
+        )
+
+    refit_time = min(timeit.repeat(refit, number=1, repeat=args.repeat))
+    room_profiles, building_profiles = refit()
+    lookups = 100000
+    lookup_time = timeit.timeit(lambda: float(building_profiles[7, 2, 14]), number=lookups)
+
+    print(f"rooms {len(rooms)}  buildings {buildings}  history rows {len(hours)}")
+    print(f"refit      {refit_time * 1e3:10.1f} ms")
+    print(f"lookup     {lookup_time / lookups * 1e9:10.0f} ns")
+    print(f"matrix     {(room_profiles.nbytes + building_profiles.nbytes) / 1024:10.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
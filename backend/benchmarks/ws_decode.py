@@ -0,0 +1,82 @@
+"""
+Per-message cost of decoding inbound WebSocket frames: json.loads followed
+by dict walking, against the compiled pydantic-core validator in
+app.schemas.websocket, for valid and malformed frames.
+
+    python benchmarks/ws_decode.py --messages 100000
+"""
+import argparse
+import json
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.schemas.websocket import inbound_message  # noqa: E402
+
+ROOMS = ["ETLC 1-001", "CAB 235", "CCIS 1-430", "TORY 2-58", "HC 1-2"]
+
+
+def frames(count: int):
+    """A mix of the messages the web client sends"""
+    messages = []
+    for _ in range(count):
+        kind = random.random()
+        if kind < 0.45:
+            message = {"type": "checkin", "room_name": random.choice(ROOMS), "username": "user", "study_topic": "Math"}
+        elif kind < 0.9:
+            message = {"type": "checkout", "room_name": random.choice(ROOMS)}
+        elif kind < 0.97:
+            message = {"type": "subscribe", "buildings": ["CAB"], "campus": False}
+        else:
+            message = {"type": "setUsername", "username": "newname"}
+        messages.append(json.dumps(message))
+    return messages
+
+
+def decode_dict(raw: str):
+    """The previous path: parse, then pull fields out with .get()"""
+    try:
+        data = json.loads(raw)
+        message_type = data.get("type")
+    except (ValueError, AttributeError):
+        return None
+    if message_type == "checkin":
+        return data.get("room_name"), data.get("username"), data.get("study_topic")
+    if message_type == "checkout":
+        return data.get("room_name"), data.get("auto", False)
+    if message_type in ("subscribe", "unsubscribe"):
+        return data.get("buildings") or [], data.get("rooms") or [], data.get("campus")
+    if message_type == "setUsername":
+        return data.get("username")
+    return None
+
+
+def decode_typed(raw: str):
+    try:
+        return inbound_message.validate_json(raw)
+    except ValueError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    valid = frames(args.messages)
+    malformed = ['{"type": "checkin"}', '{"type": "dance"}', "[1, 2]"] * (args.messages // 3)
+
+    print(f"{'decoder':<12}{'valid us/msg':>14}{'malformed us/msg':>18}")
+    for label, decode in (("json+dict", decode_dict), ("typed", decode_typed)):
+        valid_time = timeit.timeit(lambda: [decode(raw) for raw in valid], number=1)
+        malformed_time = timeit.timeit(lambda: [decode(raw) for raw in malformed], number=1)
+        print(f"{label:<12}{valid_time / len(valid) * 1e6:>14.2f}{malformed_time / len(malformed) * 1e6:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Frames and bytes one campus-wide client receives during a class changeover
+burst, with and without the WS_BATCH_WINDOW_MS coalescing window and with
+and without permessage-deflate.
+
+Deflate is measured the way RFC 7692 applies it with context takeover (the
+uvicorn/websockets default): one raw deflate stream per connection, flushed
+after every message, minus the 4-byte tail.
+
+    python benchmarks/ws_frames.py --events 300 --seconds 1 --window-ms 75
+"""
+import argparse
+import random
+import sys
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.core.activity import Frame, batch_frame  # noqa: E402
+
+BUILDINGS = ["ETLC", "CAB", "CCIS", "TORY", "HC", "SUB"]
+
+
+def changeover(events: int, seconds: float, rooms: int):
+    """(offset in seconds, event) pairs for a burst of check-ins and check-outs"""
+    start = datetime(2025, 1, 13, 10, 50)
+    room_names = [f"{random.choice(BUILDINGS)} {random.randint(1, 4)}-{random.randint(1, 250):03d}" for _ in range(rooms)]
+    counts = {room: random.randint(0, 20) for room in room_names}
+    burst = []
+    for seq in range(1, events + 1):
+        offset = random.uniform(0, seconds)
+        room = random.choice(room_names)
+        event_type = "checkin" if counts[room] == 0 or random.random() < 0.5 else "checkout"
+        counts[room] += 1 if event_type == "checkin" else -1
+        timestamp = start + timedelta(seconds=offset)
+        event = {
+            "type": event_type,
+            "user_id": str(uuid.uuid4()),
+            "username": f"student{random.randint(1, 5000)}",
+            "room_name": room,
+            "timestamp": timestamp.isoformat(),
+            "message": f"student checked {'into' if event_type == 'checkin' else 'out of'} {room}",
+            "current_occupancy": counts[room],
+            "seq": seq,
+        }
+        if event_type == "checkin":
+            event["study_topic"] = "Studying"
+            event["expiry_time"] = (timestamp + timedelta(hours=4)).isoformat()
+        burst.append((offset, event))
+    burst.sort(key=lambda pair: pair[0])
+    return burst
+
+
+def coalesce(burst, window: float):
+    """Payloads sent when events are held for window seconds after the first one arrives"""
+    if not window:
+        return [Frame(event).text() for _, event in burst]
+    payloads = []
+    batch, opened = [], None
+    for offset, event in burst:
+        if opened is not None and offset >= opened + window:
+            payloads.append(batch_frame(batch).text())
+            batch, opened = [], None
+        if opened is None:
+            opened = offset
+        batch.append(event)
+    if batch:
+        payloads.append(batch_frame(batch).text())
+    return payloads
+
+
+def deflated_size(payloads):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    total = 0
+    for payload in payloads:
+        data = compressor.compress(payload.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        total += len(data) - 4
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=300)
+    parser.add_argument("--seconds", type=float, default=1.0)
+    parser.add_argument("--rooms", type=int, default=40)
+    parser.add_argument("--window-ms", type=int, default=75)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    burst = changeover(args.events, args.seconds, args.rooms)
+
+    print(f"{args.events} events over {args.seconds}s across {args.rooms} rooms")
+    print(f"{'mode':<28}{'frames':>8}{'bytes':>10}{'deflated':>10}")
+    for label, window in (("per event", 0), (f"batched {args.window_ms} ms", args.window_ms / 1000)):
+        payloads = coalesce(burst, window)
+        raw = sum(len(payload.encode("utf-8")) for payload in payloads)
+        print(f"{label:<28}{len(payloads):>8}{raw:>10}{deflated_size(payloads):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""occupancy rollups
+
+Revision ID: a3f1c9e2b7d4
+Revises: 34cda533ff14
+Create Date: 2026-10-17 10:12:41.208513
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f1c9e2b7d4'
+down_revision: Union[str, None] = '34cda533ff14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('occupancy_rollups',
+    sa.Column('resolution', sa.SmallInteger(), nullable=False),
+    sa.Column('room_name', sa.String(), nullable=False),
+    sa.Column('bucket_start', sa.DateTime(), nullable=False),
+    sa.Column('occupied_seconds', sa.Integer(), nullable=False),
+    sa.Column('peak', sa.SmallInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('resolution', 'room_name', 'bucket_start')
+    )
+    op.create_index('idx_occupancy_rollups_bucket', 'occupancy_rollups', ['resolution', 'bucket_start'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_occupancy_rollups_bucket', table_name='occupancy_rollups')
+    op.drop_table('occupancy_rollups')
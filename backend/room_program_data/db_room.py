@@ -5,7 +5,7 @@ import sys
 from datetime import datetime, time
 from dotenv import load_dotenv
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -123,6 +123,16 @@ try:
     session.commit()
     print("🎉 Buildings, Rooms, and Schedules inserted successfully!")
 
+    # Tell running API workers to reload their room -> building map
+    session.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {
+            "channel": os.getenv("BROADCAST_CHANNEL", "beacons_events"),
+            "payload": json.dumps({"origin": "db_room", "event": {"type": "rooms_reloaded"}})
+        }
+    )
+    session.commit()
+
 except SQLAlchemyError as e:
     session.rollback()
     print(f"❌ Error occurred: {e}")
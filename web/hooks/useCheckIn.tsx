@@ -29,6 +29,7 @@ type FeedItem = {
   study_topic?: string;
   expiry_time?: string;
   current_occupancy?: number;
+  seq?: number;
 };
 
 
@@ -118,6 +119,12 @@ export function CheckInProvider({ children }: { children: ReactNode }) {
     timestamp: number;
   } | null>(null);
 
+  // Last event stream and sequence number seen, so a reconnect only fetches what was missed
+  const cursorRef = useRef<{ stream: string | null; seq: number | null }>({
+    stream: null,
+    seq: null,
+  });
+
   // Function to get total occupancy for a building
   const getBuildingOccupancy = (buildingName: string): number => {
     // Extract the building prefix from room names (e.g. "DM" from "DM-101")
@@ -157,9 +164,19 @@ export function CheckInProvider({ children }: { children: ReactNode }) {
       //   /iPhone|iPad|iPod/.test(navigator.userAgent);
       const token = await getAuthToken();
 
-      // Create the WebSocket URL with the token as a query parameter
+      // Create the WebSocket URL with the token, and the cursor to resume from if we have one
+      const params = new URLSearchParams();
+      if (token) {
+        params.set("token", token);
+      }
+      const { stream, seq } = cursorRef.current;
+      if (stream !== null && seq !== null) {
+        params.set("stream", stream);
+        params.set("since", String(seq));
+      }
+      const query = params.toString();
       const wsUrl = `wss://${process.env.NEXT_PUBLIC_API_DOMAIN}/ws${
-        token ? `?token=${token}` : ""
+        query ? `?${query}` : ""
       }`;
 
       console.log("Creating new WebSocket connection...");
@@ -185,13 +202,123 @@ export function CheckInProvider({ children }: { children: ReactNode }) {
         }
       };
 
+      // Apply one check-in/check-out event to the room counts, the feed and our own state
+      const handleEvent = (newEvent: FeedItem) => {
+        if (typeof newEvent.seq === "number") {
+          cursorRef.current.seq = newEvent.seq;
+        }
+
+        if (
+          newEvent.room_name &&
+          typeof newEvent.current_occupancy === "number"
+        ) {
+          const roomName = newEvent.room_name;
+          const count = newEvent.current_occupancy;
+
+          setRoomOccupancy((prev) => {
+            const updated = { ...prev };
+            updated[roomName] = count;
+            return updated;
+          });
+        }
+
+        // Only check-ins and check-outs belong in the feed
+        if (newEvent.type !== "checkin" && newEvent.type !== "checkout") {
+          return;
+        }
+
+        // Add to feed - with deduplication
+        if (isMountedRef.current) {
+          setFeedItems((prevFeed) => {
+            // Check for duplicates by comparing timestamps and user_id
+            const isDuplicate = prevFeed.some(
+              (item) =>
+                item.type === newEvent.type &&
+                item.user_id === newEvent.user_id &&
+                item.room_name === newEvent.room_name &&
+                Math.abs(
+                  new Date(item.timestamp).getTime() -
+                    new Date(newEvent.timestamp).getTime()
+                ) < 1000 // within 1 second
+            );
+
+            if (isDuplicate) return prevFeed;
+
+            const updatedFeed = [...prevFeed, newEvent];
+            return updatedFeed.sort(
+              (a, b) =>
+                new Date(b.timestamp).getTime() -
+                new Date(a.timestamp).getTime()
+            );
+          });
+
+          // Handle check-in/check-out for current user
+          if (newEvent.user_id === userId) {
+            if (newEvent.type === "checkin") {
+              setIsCheckedIn(true);
+              // CRITICAL FIX: Using room_name both as ID and name
+              setCheckedInRoom({
+                id: newEvent.room_name || "", // Use room_name as the ID since that's what backend provides
+                name: newEvent.room_name || "",
+              });
+              setStudyTopic(newEvent.study_topic || null);
+            } else if (newEvent.type === "checkout") {
+              setIsCheckedIn(false);
+              setCheckedInRoom(null);
+              setStudyTopic(null);
+            }
+          }
+        }
+      };
+
       ws.onmessage = (event: MessageEvent) => {
         try {
           const data = JSON.parse(event.data);
           console.log("WebSocket received message:", data);
 
+          // Answer server heartbeats so the connection is not reaped as idle
+          if (data.type === "ping") {
+            ws.send("pong");
+            return;
+          }
+
+          // Aggregated counts of connected users; not part of the activity feed
+          if (data.type === "presence") {
+            return;
+          }
+
+          // Updates the server conflated while this client was falling behind
+          if (data.type === "catchup") {
+            if (data.resync) {
+              // Too much was missed; reconnecting without a cursor fetches a fresh history
+              cursorRef.current = { stream: null, seq: null };
+              ws.close();
+              return;
+            }
+            if (isMountedRef.current) {
+              setRoomOccupancy((prev) => ({ ...prev, ...data.occupancy }));
+            }
+            // Same handling as live events: deduplicated, and our own check-in state follows
+            (data.events as FeedItem[]).forEach(handleEvent);
+            if (typeof data.seq === "number") {
+              cursorRef.current.seq = data.seq;
+            }
+            return;
+          }
+
+          // Events missed since our cursor, sent instead of the history on reconnect
+          if (data.type === "replay") {
+            if (isMountedRef.current && data.user_id) {
+              setUserId(data.user_id);
+            }
+            (data.events as FeedItem[]).forEach(handleEvent);
+            cursorRef.current = { stream: data.stream, seq: data.seq };
+            return;
+          }
+
           // Handle history message
           if (data.type === "history" && "feed" in data) {
+            cursorRef.current = { stream: data.stream, seq: data.seq };
             // Set the feed
             const sortedFeed = data.feed.sort(
               (a: FeedItem, b: FeedItem) =>
@@ -236,66 +363,16 @@ export function CheckInProvider({ children }: { children: ReactNode }) {
               }
             }
           }
-          // Handle individual events
-          else if ((data as FeedItem).type) {
-            const newEvent = data as FeedItem;
-
-            if (
-              newEvent.room_name &&
-              typeof newEvent.current_occupancy === "number"
-            ) {
-              const roomName = newEvent.room_name;
-              const count = newEvent.current_occupancy;
-
-              setRoomOccupancy((prev) => {
-                const updated = { ...prev };
-                updated[roomName] = count;
-                return updated;
-              });
-            }
-
-            // Add to feed - with deduplication
+          // Events the server coalesced within its batch window, with the latest room counts
+          else if (data.type === "batch") {
             if (isMountedRef.current) {
-              setFeedItems((prevFeed) => {
-                // Check for duplicates by comparing timestamps and user_id
-                const isDuplicate = prevFeed.some(
-                  (item) =>
-                    item.type === newEvent.type &&
-                    item.user_id === newEvent.user_id &&
-                    item.room_name === newEvent.room_name &&
-                    Math.abs(
-                      new Date(item.timestamp).getTime() -
-                        new Date(newEvent.timestamp).getTime()
-                    ) < 1000 // within 1 second
-                );
-
-                if (isDuplicate) return prevFeed;
-
-                const updatedFeed = [...prevFeed, newEvent];
-                return updatedFeed.sort(
-                  (a, b) =>
-                    new Date(b.timestamp).getTime() -
-                    new Date(a.timestamp).getTime()
-                );
-              });
-
-              // Handle check-in/check-out for current user
-              if (newEvent.user_id === userId) {
-                if (newEvent.type === "checkin") {
-                  setIsCheckedIn(true);
-                  // CRITICAL FIX: Using room_name both as ID and name
-                  setCheckedInRoom({
-                    id: newEvent.room_name || "", // Use room_name as the ID since that's what backend provides
-                    name: newEvent.room_name || "",
-                  });
-                  setStudyTopic(newEvent.study_topic || null);
-                } else if (newEvent.type === "checkout") {
-                  setIsCheckedIn(false);
-                  setCheckedInRoom(null);
-                  setStudyTopic(null);
-                }
-              }
+              setRoomOccupancy((prev) => ({ ...prev, ...data.occupancy }));
             }
+            (data.events as FeedItem[]).forEach(handleEvent);
+          }
+          // Handle individual events
+          else if ((data as FeedItem).type) {
+            handleEvent(data as FeedItem);
           }
           // Handle occupancy update broadcasts
           else if (
@@ -425,6 +502,7 @@ export function CheckInProvider({ children }: { children: ReactNode }) {
     // Send data to server
     const checkInData = {
       type: "checkin",
+      id: crypto.randomUUID(), // Lets the server ignore a resent frame
       room_name: roomName, // Backend expects room_name, not room_id
       study_topic: studyTopic || undefined,
       username: user?.username,
@@ -475,6 +553,7 @@ export function CheckInProvider({ children }: { children: ReactNode }) {
 
     const checkOutData = {
       type: "checkout",
+      id: crypto.randomUUID(),
     };
 
     globalWebSocket.send(JSON.stringify(checkOutData));